@@ -0,0 +1,316 @@
+"""Micro-benchmarks of the message codecs: every function of serialization.py, for each message type, and building and
+parsing the agent XML in agent.py, at realistic and worst-case sizes.
+
+Reports, for each case, the time per operation, the memory blocks an operation allocates, the peak memory it allocates
+(tracemalloc) and the memory blocks its result keeps alive. Results can be saved as a JSON baseline, and a later run
+compared to it: a case slower, or allocating more, than the baseline by more than the threshold is flagged, and the exit
+status is 1.
+
+    PYTHONPATH=source python benchmarks/codec.py --save baseline.json
+    PYTHONPATH=source python benchmarks/codec.py --compare baseline.json --threshold 0.1
+
+Timings are the best of several repeats, compare baselines taken on the same machine and Python. No baseline is checked
+in for that reason: save one from the code before a change and compare the code after it to that.
+"""
+import argparse
+import gc
+import itertools
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict
+
+from defusedxml.ElementTree import fromstring
+
+from interstate_love_song.agent import MAX_RESPONSE_BYTES, build_launch_session_request, parse_launch_session_response
+from interstate_love_song.serialization import deserialize_message, encode_element, encode_message, serialize_message
+from interstate_love_song.transport import *
+
+
+def _resources(count):
+    return [TeradiciResource("Resource number {}".format(i), str(i)) for i in range(count)]
+
+
+RESPONSES = OrderedDict(
+    [
+        ("hello", HelloResponse("broker.example.com", ["example.com"])),
+        ("hello_100_domains", HelloResponse("broker.example.com", ["domain{}.example.com".format(i) for i in range(100)])),
+        ("authenticate_success", AuthenticateSuccessResponse()),
+        ("authenticate_failed", AuthenticateFailedResponse()),
+        ("resource_list_5", GetResourceListResponse(_resources(5))),
+        ("resource_list_1000", GetResourceListResponse(_resources(1000))),
+        (
+            "allocate_success",
+            AllocateResourceSuccessResponse("10.0.0.1", "gauss.example.com", "gauss", 4172, "1234", "YWJjZA==" * 8, "0"),
+        ),
+        ("allocate_failure", AllocateResourceFailureResponse("FAILED_USER_AUTH")),
+        ("bye", ByeResponse()),
+    ]
+)
+
+_CLIENT = '<pcoip-client version="2.1">{}</pcoip-client>'
+REQUESTS = OrderedDict(
+    [
+        (
+            "hello",
+            _CLIENT.format(
+                "<hello><client-info><hostname>gauss</hostname><product-name>QueryBrokerClient"
+                "</product-name></client-info></hello>"
+            ),
+        ),
+        (
+            "authenticate",
+            _CLIENT.format(
+                '<authenticate method="password"><username>gauss</username>'
+                "<password>Disquisitiones</password><domain>example.com</domain></authenticate>"
+            ),
+        ),
+        # The largest body the broker accepts, in a password full of escapes.
+        (
+            "authenticate_64k",
+            _CLIENT.format(
+                '<authenticate method="password"><username>gauss</username><password>{}'
+                "</password><domain>example.com</domain></authenticate>"
+            ).format("&amp;&lt;" * ((65536 - 200) // 9)),
+        ),
+        ("get_resource_list", _CLIENT.format("<get-resource-list/>")),
+        ("allocate_resource", _CLIENT.format("<allocate-resource><resource-id>0</resource-id></allocate-resource>")),
+        ("bye", _CLIENT.format("<bye/>")),
+        ("bad_message", _CLIENT.format("<hello><client-info/></hello>")),
+    ]
+)
+
+_AGENT_SUCCESS = """<?xml version="1.0"?>
+<pcoip-agent version="1.0">
+    <launch-session-resp>
+        <result-id>SUCCESSFUL</result-id>
+        <session-info>
+            <ip-address>10.0.0.1</ip-address>
+            <sni>gauss</sni>
+            <port>4172</port>
+            <session-id>1234</session-id>
+            <session-tag>{}</session-tag>
+        </session-info>
+        {}
+    </launch-session-resp>
+</pcoip-agent>"""
+_AGENT_FAILURE = """<?xml version="1.0"?>
+<pcoip-agent version="1.0">
+    <launch-session-resp>
+        <result-id>FAILED_USER_AUTH</result-id>
+        <fail-reason>Failed to start the session due to user authentication failing.</fail-reason>
+    </launch-session-resp>
+</pcoip-agent>"""
+_PADDING = "<vendor-extension>{}</vendor-extension>".format("x" * 100)
+
+AGENT_RESPONSES = OrderedDict(
+    [
+        ("success", _AGENT_SUCCESS.format("YWJjZA==" * 8, "").encode("utf-8")),
+        ("failure", _AGENT_FAILURE.encode("utf-8")),
+        # The largest response allocate_session reads, mostly elements we skip.
+        (
+            "success_max_size",
+            _AGENT_SUCCESS.format(
+                "YWJjZA==" * 8, _PADDING * ((MAX_RESPONSE_BYTES - len(_AGENT_SUCCESS) - 100) // len(_PADDING))
+            ).encode("utf-8"),
+        ),
+    ]
+)
+
+
+def cases():
+    """The benchmark cases, by name, each a function that runs one operation."""
+    result = OrderedDict()
+    for name, msg in RESPONSES.items():
+        result["serialize_message/" + name] = lambda msg=msg: serialize_message(msg)
+    for name, msg in RESPONSES.items():
+        xml = serialize_message(msg)
+        result["encode_element/" + name] = lambda xml=xml: encode_element(xml)
+    for name, msg in RESPONSES.items():
+        result["encode_message/" + name] = lambda msg=msg: encode_message(msg)
+    for name, body in REQUESTS.items():
+        xml = fromstring(body)
+        result["deserialize_message/" + name] = lambda xml=xml: deserialize_message(xml)
+    for name, body in REQUESTS.items():
+        body = body.encode("utf-8")
+        # What the broker does with each request body.
+        result["parse_and_deserialize/" + name] = lambda body=body: deserialize_message(fromstring(body))
+
+    result["build_launch_session_request/typical"] = lambda: build_launch_session_request(
+        "gauss.example.com", "gauss", "Disquisitiones", "example.com", "Bobby McGee", "UNSPECIFIED"
+    )
+    result["build_launch_session_request/escaped_1k_password"] = lambda: build_launch_session_request(
+        "gauss.example.com", "gauss", "<&>\"'" * 200, "example.com", "Bobby McGee", "UNSPECIFIED"
+    )
+    # More hosts than the cache of request prefixes holds, every call misses it.
+    hostnames = itertools.cycle(["host{}.example.com".format(i) for i in range(4096)])
+    result["build_launch_session_request/uncached_host"] = lambda: build_launch_session_request(
+        next(hostnames), "gauss", "Disquisitiones", "example.com", "Bobby McGee", "UNSPECIFIED"
+    )
+    for name, body in AGENT_RESPONSES.items():
+        result["parse_launch_session_response/" + name] = lambda body=body: parse_launch_session_response(body, "0")
+    return result
+
+
+def _time_per_op(op, min_time: float, repeats: int) -> float:
+    """Nanoseconds per call, the best of repeats runs of at least min_time seconds."""
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            op()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time / 10:
+            break
+        loops *= 2
+    loops = max(1, int(loops * min_time / elapsed))
+
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(loops):
+            op()
+        best = min(best, (time.perf_counter() - start) / loops)
+    return best * 1e9
+
+
+def _allocations_per_op(op, calls: int = 20) -> float:
+    """The memory blocks a call allocates. Python keeps no count of allocations, only of the blocks in use, so that is
+    read at every call and return of a Python or C function inside the call, and the increases are added up. A block
+    allocated and freed again within one C function isn't seen, this is a lower bound. Less what the counting itself
+    allocates, measured on a call that does nothing.
+    """
+
+    def count(op):
+        last = allocated = 0
+
+        def profile(frame, event, arg):
+            nonlocal last, allocated
+            blocks = sys.getallocatedblocks()
+            if blocks > last:
+                allocated += blocks - last
+            last = blocks
+
+        gc.collect()
+        gc.disable()
+        try:
+            last = sys.getallocatedblocks()
+            sys.setprofile(profile)
+            try:
+                for _ in range(calls):
+                    op()
+            finally:
+                sys.setprofile(None)
+        finally:
+            gc.enable()
+        return allocated / calls
+
+    return max(0.0, count(op) - count(lambda: None))
+
+
+def _peak_bytes_per_op(op, repeats: int = 5) -> int:
+    """The most memory a call has allocated at once, the least of a few calls, so caches filled by the first are warm."""
+    best = None
+    for _ in range(repeats):
+        tracemalloc.start()
+        try:
+            op()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        best = peak if best is None else min(best, peak)
+    return best
+
+
+def _retained_blocks_per_op(op, calls: int = 100) -> float:
+    """The memory blocks the result of a call keeps alive."""
+    gc.collect()
+    gc.disable()
+    try:
+        before = sys.getallocatedblocks()
+        results = [op() for _ in range(calls)]
+        after = sys.getallocatedblocks()
+    finally:
+        gc.enable()
+    del results
+    return max(0.0, (after - before) / calls)
+
+
+def run(selected, min_time: float, repeats: int):
+    results = OrderedDict()
+    for name, op in selected.items():
+        op()
+        results[name] = {
+            "ns_per_op": round(_time_per_op(op, min_time, repeats), 1),
+            "allocs_per_op": round(_allocations_per_op(op), 1),
+            "peak_bytes_per_op": _peak_bytes_per_op(op),
+            "blocks_per_op": round(_retained_blocks_per_op(op), 1),
+        }
+        print(
+            "{:<56} {:>12.0f} {:>10.1f} {:>14} {:>10.1f}".format(
+                name,
+                results[name]["ns_per_op"],
+                results[name]["allocs_per_op"],
+                results[name]["peak_bytes_per_op"],
+                results[name]["blocks_per_op"],
+            )
+        )
+    return results
+
+
+def compare(results, baseline, threshold: float):
+    """The regressions of results against the baseline: (case, metric, baseline, result), where the result exceeds the
+    baseline by more than the threshold, a fraction.
+    """
+    regressions = []
+    for name, metrics in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        for metric in ("ns_per_op", "allocs_per_op", "peak_bytes_per_op"):
+            # Baselines saved before a metric was added don't have it.
+            if metric in old and metrics[metric] > old[metric] * (1 + threshold):
+                regressions.append((name, metric, old[metric], metrics[metric]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser("codec")
+    parser.add_argument("--filter", default="", help="only the cases whose name contains this")
+    parser.add_argument("--min-time", default=0.2, type=float, help="seconds each timing repeat runs at least")
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--save", metavar="FILE", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare the results to a JSON baseline")
+    parser.add_argument("--threshold", default=0.1, type=float, help="the slowdown flagged, as a fraction (0.1 = 10%%)")
+    args = parser.parse_args()
+
+    selected = OrderedDict((name, op) for name, op in cases().items() if args.filter in name)
+    print("{:<56} {:>12} {:>10} {:>14} {:>10}".format("case", "ns/op", "allocs/op", "peak B/op", "blocks/op"))
+    results = run(selected, args.min_time, args.repeats)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"python": platform.python_version(), "machine": platform.machine(), "results": results}, f, indent=2)
+        print("Saved {} cases to {}.".format(len(results), args.save))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("python") != platform.python_version():
+            print("The baseline is from Python {}, this is {}.".format(baseline.get("python"), platform.python_version()))
+        regressions = compare(results, baseline["results"], args.threshold)
+        missing = [name for name in results if name not in baseline["results"]]
+        if missing:
+            print("Not in the baseline: {}".format(", ".join(missing)))
+        for name, metric, old, new in regressions:
+            change = new / old - 1 if old else float("inf")
+            print("REGRESSION {:<56} {:<18} {:>12} -> {:>12} ({:+.0%})".format(name, metric, old, new, change))
+        if regressions:
+            sys.exit(1)
+        print("No regressions beyond {:.0%}.".format(args.threshold))
+
+
+if __name__ == "__main__":
+    main()
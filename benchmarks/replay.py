@@ -0,0 +1,149 @@
+"""Replays a traffic recording (see the recording settings) against a running broker, at the speed it was recorded or
+faster, and reports the latency of the broker and how many responses differ in status from the recorded ones.
+
+Each recorded client session is replayed by its own thread, with its own cookie or CLIENT-LOG-ID header, so the
+broker sees the same mix of clients, retries and odd messages as when it was recorded. The usernames and passwords are
+the tokens of the recording; --credentials replaces them all, for a mapper that knows a single user, like SimpleMapper,
+with a wrong password where the recorded login failed.
+
+    PYTHONPATH=source python benchmarks/replay.py 'recording.*' --url https://localhost:60443/pcoip-broker/xml --speed 10
+"""
+import argparse
+import statistics
+import threading
+import time
+from collections import Counter, OrderedDict
+from xml.etree.ElementTree import fromstring, tostring
+
+import requests
+import urllib3
+
+from interstate_love_song.recording import read_recording
+
+
+def _body(exchange, credentials) -> bytes:
+    if exchange.request is None:
+        # It wasn't XML, and may have held anything, any non-XML of the same size will do.
+        return b"x" * exchange.request_bytes
+    if credentials is None:
+        return exchange.request.encode("utf-8")
+    username, password = credentials
+    if "<result-id>AUTH_FAILED" in (exchange.response or ""):
+        # The recorded login failed, so must the replayed one, or the client's retry would find the session moved on.
+        password = "not " + password
+    xml = fromstring(exchange.request)
+    for tag, value in (("username", username), ("password", password)):
+        for element in xml.iter(tag):
+            element.text = value
+    return tostring(xml)
+
+
+def _replay_client(exchanges, args, due, results, lock):
+    """Sends the requests of one client session in order, each when it is due."""
+    http = requests.Session()
+    cookie = None
+    for exchange in exchanges:
+        when = due(exchange)
+        now = time.perf_counter()
+        if when > now:
+            time.sleep(when - now)
+        headers = {"Content-Type": "application/xml"}
+        if exchange.header_session:
+            headers["CLIENT-LOG-ID"] = exchange.client
+        elif cookie:
+            # The session cookie is Secure, requests wouldn't send it back over plain HTTP.
+            headers["Cookie"] = "JSESSIONID=" + cookie
+        sent = time.perf_counter()
+        try:
+            response = http.post(
+                args.url, data=_body(exchange, args.credentials), headers=headers, timeout=args.timeout, verify=args.verify
+            )
+            response.content
+            status = response.status_code
+            cookie = response.cookies.get("JSESSIONID") or cookie
+        except requests.RequestException:
+            status = None
+        elapsed = time.perf_counter() - sent
+        with lock:
+            results.append((elapsed, sent - when, status, exchange.status))
+
+
+def replay(exchanges, args):
+    """:returns: (latency, lag, status, recorded status) of each request, and the seconds the replay took."""
+    sessions = OrderedDict()
+    for number, exchange in enumerate(exchanges):
+        sessions.setdefault(exchange.client or number, []).append(exchange)
+    if not sessions:
+        return [], 0.0
+
+    first = min(session[0].time for session in sessions.values())
+    start = time.perf_counter()
+    speed = args.speed
+
+    def due(exchange):
+        return start + (exchange.time - first) / speed if speed > 0 else start
+
+    results, lock, threads = [], threading.Lock(), []
+    for session in sorted(sessions.values(), key=lambda session: session[0].time):
+        now = time.perf_counter()
+        if due(session[0]) > now:
+            time.sleep(due(session[0]) - now)
+        thread = threading.Thread(target=_replay_client, args=(session, args, due, results, lock), daemon=True)
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser("replay")
+    parser.add_argument("recordings", nargs="+", help="recording files or globs, e.g. 'recording.*'")
+    parser.add_argument("--url", default="https://localhost:60443/pcoip-broker/xml")
+    parser.add_argument("--speed", default=1.0, type=float, help="times faster than recorded, 0 for all at once")
+    parser.add_argument("--credentials", metavar="USER:PASSWORD", help="send these instead of the recorded tokens")
+    parser.add_argument("--timeout", default=30.0, type=float)
+    parser.add_argument("--verify", action="store_true", help="verify the certificate of the broker")
+    args = parser.parse_args()
+    if args.credentials:
+        args.credentials = tuple(args.credentials.split(":", 1))
+    if not args.verify:
+        urllib3.disable_warnings()
+
+    exchanges = list(read_recording(args.recordings))
+    recorded = exchanges[-1].time - exchanges[0].time if exchanges else 0.0
+    results, elapsed = replay(exchanges, args)
+    if not results:
+        print("Nothing to replay.")
+        return
+
+    latencies = sorted(latency for latency, _, _, _ in results)
+    lags = sorted(lag for _, lag, _, _ in results)
+    statuses = Counter(status for _, _, status, _ in results)
+    differing = sum(1 for _, _, status, recorded_status in results if status != recorded_status)
+    print(
+        "requests {}, clients {}, recorded over {:.1f}s, replayed in {:.1f}s, {:.1f} req/s".format(
+            len(results), len(set(e.client for e in exchanges if e.client)), recorded, elapsed, len(results) / elapsed
+        )
+    )
+    print("{:>10} {:>10} {:>10} {:>10} {:>10}".format("", "mean ms", "p50 ms", "p99 ms", "max ms"))
+    for name, values in (("latency", latencies), ("late by", lags)):
+        print(
+            "{:>10} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}".format(
+                name,
+                statistics.mean(values) * 1000,
+                _percentile(values, 0.5) * 1000,
+                _percentile(values, 0.99) * 1000,
+                values[-1] * 1000,
+            )
+        )
+    print("statuses {}".format(", ".join("{}: {}".format(s or "failed", n) for s, n in sorted(statuses.items(), key=str))))
+    print("differing from the recording: {}".format(differing))
+
+
+if __name__ == "__main__":
+    main()
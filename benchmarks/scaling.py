@@ -0,0 +1,434 @@
+"""Measures how the broker scales with the server, the gunicorn worker class and the number of workers.
+
+For each combination it starts the broker with `python -m interstate_love_song`, so through the runners of __main__, and
+runs simulated PCoIP clients against it for a while. Each client logs in over and over, the way the PCoIP client does:
+a QueryBrokerClient hello, a hello, authenticate, get-resource-list, allocate-resource and bye. The broker allocates
+the sessions on a stub agent, which answers after --agent-delay-ms. The SimpleMapper hashes the password of every
+login with PBKDF2, the CPU-heavy part of a login.
+
+Reports, per configuration, the logins and requests per second, the latency percentiles of the requests, the errors,
+and the CPU time and peak RSS of the broker processes, the gunicorn master and its workers, over the measured window.
+
+    PYTHONPATH=source python benchmarks/scaling.py --worker-classes gevent,sync,gthread --workers 1,2,4,8 --duration 20
+
+The stub agent listens on 127.0.0.1:60443, the port allocate_session calls, so that port must be free. RSS and CPU are
+read from /proc, Linux only.
+"""
+import argparse
+import http.server
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+import urllib3
+
+from interstate_love_song.plugins.simple import hash_pass
+
+USERNAME, PASSWORD = "bench", "bench"
+AGENT_HOST, AGENT_PORT = "127.0.0.1", 60443
+RESOURCES = 4
+
+_CLIENT = '<pcoip-client version="2.1">{}</pcoip-client>'
+_HELLO = "<hello><client-info><hostname>bench-{}</hostname><product-name>{}</product-name></client-info></hello>"
+_AUTHENTICATE = (
+    '<authenticate method="password"><username>{}</username><password>{}</password><domain>example.com</domain>'
+    "</authenticate>"
+).format(USERNAME, PASSWORD)
+_ALLOCATE = "<allocate-resource><resource-id>{}</resource-id></allocate-resource>"
+
+_AGENT_RESPONSE = b"""<?xml version="1.0"?>
+<pcoip-agent version="1.0">
+    <launch-session-resp>
+        <result-id>SUCCESSFUL</result-id>
+        <session-info>
+            <ip-address>127.0.0.1</ip-address>
+            <sni>bench</sni>
+            <port>4172</port>
+            <session-id>1234</session-id>
+            <session-tag>YWJjZA==</session-tag>
+        </session-info>
+    </launch-session-resp>
+</pcoip-agent>"""
+
+
+class _AgentHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    delay = 0.0
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if self.delay:
+            time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(_AGENT_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(_AGENT_RESPONSE)
+
+    def log_message(self, *args):
+        pass
+
+
+class _AgentServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # The brokers drop their pooled connections without closing TLS when a run ends.
+        pass
+
+
+def _run_agent(cert, key, delay, ready):
+    _AgentHandler.delay = delay
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server = _AgentServer((AGENT_HOST, AGENT_PORT), _AgentHandler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    ready.set()
+    server.serve_forever()
+
+
+def _make_certificate(directory):
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost"]
+        + ["-keyout", key, "-out", cert],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+def _write_config(directory):
+    config = {
+        "mapper": {
+            "plugin": "SimpleMapper",
+            "settings": {
+                "username": USERNAME,
+                "password_hash": hash_pass(PASSWORD),
+                "resources": [{"name": "Desktop {}".format(i), "hostname": AGENT_HOST} for i in range(RESOURCES)],
+                "domains": ["example.com"],
+            },
+        },
+        "beaker": {"type": "file", "data_dir": os.path.join(directory, "sessions")},
+        # Every simulated client is the same user from the same address, the limits would only measure themselves.
+        "rate_limit": {"enabled": False},
+        "agent": {"max_concurrent": 1024, "max_per_host": 1024, "allocation_result_ttl_seconds": 0},
+    }
+    path = os.path.join(directory, "config.json")
+    with open(path, "w") as f:
+        json.dump(config, f)
+    return path
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _start_broker(configuration, args, directory, config_path, port, log):
+    server, worker_class, workers = configuration
+    command = [sys.executable, "-m", "interstate_love_song", "--no-splash", "-s", server, "--host", "127.0.0.1"]
+    command += ["-p", str(port), "--config", config_path]
+    if args.tls:
+        command += ["--cert", args.cert, "--key", args.key]
+    else:
+        command += ["--no-ssl"]
+    if server == "gunicorn":
+        command += ["--gunicorn-worker-class", worker_class, "--gunicorn-workers", str(workers)]
+        command += ["--gunicorn-threads", str(args.threads)]
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [_SOURCE, os.environ.get("PYTHONPATH")])))
+    return subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, env=environment, cwd=directory)
+
+
+def _wait_until_ready(url, broker, timeout=30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if broker.poll() is not None:
+            raise RuntimeError("The broker exited with {}.".format(broker.returncode))
+        try:
+            if requests.get(url + "/readyz", timeout=1, verify=False).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("The broker did not get ready in {}s.".format(timeout))
+
+
+def _stop_broker(broker):
+    if broker.poll() is None:
+        broker.send_signal(signal.SIGTERM)
+        try:
+            broker.wait(10)
+        except subprocess.TimeoutExpired:
+            broker.kill()
+            broker.wait()
+
+
+def _tree(pid):
+    """The pid and the pids of all its descendants."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open("/proc/{}/stat".format(entry)) as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+            except (OSError, IndexError, ValueError):
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        pids.append(current)
+        stack.extend(children.get(current, []))
+    return pids
+
+
+def _cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/stat".format(pid)) as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime, fields 14 and 15 of stat, counting from the pid.
+        total += int(fields[11]) + int(fields[12])
+    return total / os.sysconf("SC_CLK_TCK")
+
+
+def _rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open("/proc/{}/status".format(pid)) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def _client(number, url, measure_from, deadline, latencies, counts, lock):
+    """Logs in over and over until the deadline, recording the requests that start after measure_from."""
+    http_session = requests.Session()
+    broker_url = url + "/pcoip-broker/xml"
+    while time.time() < deadline:
+        cookie = None
+        login = [
+            _HELLO.format(number, "QueryBrokerClient"),
+            _HELLO.format(number, "Bench"),
+            _AUTHENTICATE,
+            "<get-resource-list/>",
+            _ALLOCATE.format(random.randrange(RESOURCES)),
+            "<bye/>",
+        ]
+        completed = True
+        for body in login:
+            headers = {"Content-Type": "application/xml"}
+            if cookie:
+                # The session cookie is Secure, requests wouldn't send it back over plain HTTP.
+                headers["Cookie"] = "JSESSIONID=" + cookie
+            start = time.time()
+            try:
+                response = http_session.post(broker_url, data=_CLIENT.format(body), headers=headers, timeout=30, verify=False)
+                ok = response.status_code == 200 and b"FAILED" not in response.content
+                cookie = response.cookies.get("JSESSIONID") or cookie
+            except requests.RequestException:
+                ok = False
+            http_session.cookies.clear()
+            if start >= measure_from and start < deadline:
+                with lock:
+                    latencies.append(time.time() - start)
+                    counts["requests"] += 1
+                    counts["errors"] += not ok
+            if not ok:
+                completed = False
+                break
+        if completed and start >= measure_from and start < deadline:
+            with lock:
+                counts["logins"] += 1
+
+
+def _client_process(args):
+    first, clients, url, measure_from, deadline = args
+    urllib3.disable_warnings()
+    latencies, counts, lock = [], {"requests": 0, "errors": 0, "logins": 0}, threading.Lock()
+    threads = [
+        threading.Thread(target=_client, args=(first + i, url, measure_from, deadline, latencies, counts, lock), daemon=True)
+        for i in range(clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, counts
+
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float("nan")
+
+
+def measure(configuration, args, directory, config_path):
+    port = _free_port()
+    scheme = "https" if args.tls else "http"
+    url = "{}://127.0.0.1:{}".format(scheme, port)
+    log_path = os.path.join(directory, "broker-{}.log".format("-".join(map(str, configuration))))
+    with open(log_path, "wb") as log:
+        broker = _start_broker(configuration, args, directory, config_path, port, log)
+        try:
+            _wait_until_ready(url, broker)
+            now = time.time()
+            measure_from, deadline = now + 1.0 + args.warmup, now + 1.0 + args.warmup + args.duration
+            per_process = -(-args.clients // args.client_processes)
+            jobs = [
+                (i * per_process, min(per_process, args.clients - i * per_process), url, measure_from, deadline)
+                for i in range(args.client_processes)
+                if args.clients > i * per_process
+            ]
+            with multiprocessing.get_context("fork").Pool(len(jobs)) as pool:
+                pending = pool.map_async(_client_process, jobs)
+
+                time.sleep(max(0.0, measure_from - time.time()))
+                pids = _tree(broker.pid)
+                cpu_start, peak_rss = _cpu_seconds(pids), 0
+                while time.time() < deadline:
+                    pids = _tree(broker.pid)
+                    peak_rss = max(peak_rss, _rss_bytes(pids))
+                    time.sleep(min(0.5, max(0.0, deadline - time.time())))
+                cpu = _cpu_seconds(_tree(broker.pid)) - cpu_start
+                results = pending.get()
+        finally:
+            _stop_broker(broker)
+
+    latencies = sorted(latency for process_latencies, _ in results for latency in process_latencies)
+    counts = dict((key, sum(c[key] for _, c in results)) for key in ("requests", "errors", "logins"))
+    server, worker_class, workers = configuration
+    return {
+        "server": server,
+        "worker_class": worker_class,
+        "workers": workers,
+        "logins_per_second": counts["logins"] / args.duration,
+        "requests_per_second": counts["requests"] / args.duration,
+        "errors": counts["errors"],
+        "p50_ms": _percentile(latencies, 0.5) * 1000,
+        "p90_ms": _percentile(latencies, 0.9) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else float("nan"),
+        "cpu_percent": cpu / args.duration * 100,
+        "peak_rss_mib": peak_rss / 2**20,
+    }
+
+
+def _configurations(args):
+    for server in args.servers:
+        if server == "gunicorn":
+            yield from itertools.product([server], args.worker_classes, args.workers)
+        else:
+            # The other servers run in one process, they have no worker classes.
+            yield server, "-", 1
+
+
+_ROW = "{:<9} {:<8} {:>7} {:>9} {:>9} {:>7} {:>8} {:>8} {:>8} {:>8} {:>7} {:>8}"
+_SOURCE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "source")
+
+
+def _csv(convert):
+    return lambda value: [convert(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser("scaling")
+    parser.add_argument("--servers", default=["gunicorn"], type=_csv(str), help="gunicorn, cherrypy, werkzeug")
+    parser.add_argument("--worker-classes", default=["gevent", "sync", "gthread"], type=_csv(str))
+    parser.add_argument("--workers", default=[1, 2, 4], type=_csv(int))
+    parser.add_argument("--threads", default=8, type=int, help="threads per gthread worker")
+    parser.add_argument("--clients", default=32, type=int, help="simulated clients logging in at once")
+    parser.add_argument("--client-processes", default=max(1, (os.cpu_count() or 2) // 2), type=int)
+    parser.add_argument("--duration", default=10.0, type=float, help="seconds measured per configuration")
+    parser.add_argument("--warmup", default=2.0, type=float, help="seconds of load before measuring")
+    parser.add_argument("--agent-delay-ms", default=20.0, type=float, help="how long the stub agent takes to answer")
+    parser.add_argument("--tls", action="store_true", help="serve the broker over TLS, as in production")
+    parser.add_argument("--output", metavar="FILE", help="write the results as JSON")
+    args = parser.parse_args()
+
+    if shutil.which("openssl") is None:
+        parser.error("openssl is needed to make the certificate of the stub agent.")
+    urllib3.disable_warnings()
+    directory = tempfile.mkdtemp(prefix="scaling_")
+    args.cert, args.key = _make_certificate(directory)
+    config_path = _write_config(directory)
+
+    context = multiprocessing.get_context("fork")
+    ready = context.Event()
+    agent = context.Process(target=_run_agent, args=(args.cert, args.key, args.agent_delay_ms / 1000.0, ready), daemon=True)
+    agent.start()
+    if not ready.wait(10):
+        parser.error("The stub agent did not start, is {}:{} free?".format(AGENT_HOST, AGENT_PORT))
+
+    print("{} clients in {} processes, broker logs in {}".format(args.clients, args.client_processes, directory))
+    print(
+        _ROW.format(
+            "server",
+            "class",
+            "workers",
+            "logins/s",
+            "reqs/s",
+            "errors",
+            "p50 ms",
+            "p90 ms",
+            "p99 ms",
+            "max ms",
+            "cpu %",
+            "rss MiB",
+        )
+    )
+    results = []
+    try:
+        for configuration in _configurations(args):
+            try:
+                result = measure(configuration, args, directory, config_path)
+            except RuntimeError as e:
+                print("{}: {}".format(" ".join(map(str, configuration)), e))
+                continue
+            results.append(result)
+            print(
+                _ROW.format(
+                    result["server"],
+                    result["worker_class"],
+                    result["workers"],
+                    "{:.1f}".format(result["logins_per_second"]),
+                    "{:.1f}".format(result["requests_per_second"]),
+                    result["errors"],
+                    "{:.1f}".format(result["p50_ms"]),
+                    "{:.1f}".format(result["p90_ms"]),
+                    "{:.1f}".format(result["p99_ms"]),
+                    "{:.1f}".format(result["max_ms"]),
+                    "{:.0f}".format(result["cpu_percent"]),
+                    "{:.0f}".format(result["peak_rss_mib"]),
+                )
+            )
+    finally:
+        agent.terminate()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"cpus": os.cpu_count(), "arguments": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
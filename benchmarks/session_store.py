@@ -0,0 +1,91 @@
+"""Compares Beaker's own file store, the sharded file store and the SQLite store on a login-shaped workload.
+
+Each simulated login loads a session once per message and writes the way BeakerSessionSetter does: four saves and a
+removal on bye. Reports the time per store operation and the inodes left behind in data_dir.
+
+    PYTHONPATH=source python benchmarks/session_store.py --logins 2000 --workers 4
+"""
+import argparse
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from beaker.session import Session
+
+from interstate_love_song.protocol import ProtocolSession, ProtocolState
+from interstate_love_song.session import SqliteNamespaceManager, ShardedFileNamespaceManager
+
+_NAMESPACE_CLASSES = {"beaker": None, "file": ShardedFileNamespaceManager, "sqlite": SqliteNamespaceManager}
+
+
+def _options(store: str, data_dir: str):
+    options = {"type": "file", "data_dir": data_dir, "ttl": 3600, "save_accessed_time": False}
+    if _NAMESPACE_CLASSES[store]:
+        options["namespace_class"] = _NAMESPACE_CLASSES[store]
+    return options
+
+
+def _login(options) -> list:
+    """Runs one login against the store, returns the duration of each store operation."""
+    timings = []
+
+    def timed(fn):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+        return result
+
+    session = timed(lambda: Session({}, use_cookies=False, **options))
+    session_id = session.id
+    for state in list(ProtocolState)[1:]:
+        session["protocol"] = ProtocolSession("user", "secret", "example.com", state=state)
+        timed(session.save)
+        session = timed(lambda: Session({}, id=session_id, use_cookies=False, **options))
+    timed(session.namespace.remove)
+    return timings
+
+
+def _worker(args) -> list:
+    store, data_dir, logins = args
+    options = _options(store, data_dir)
+    timings = []
+    for _ in range(logins):
+        timings.extend(_login(options))
+    return timings
+
+
+def _count_inodes(path: str) -> int:
+    return sum(len(dirs) + len(files) for _, dirs, files in os.walk(path))
+
+
+def main():
+    parser = argparse.ArgumentParser("session_store")
+    parser.add_argument("--logins", default=1000, type=int, help="logins per worker")
+    parser.add_argument("--workers", default=1, type=int)
+    parser.add_argument("--data-dir", help="parent of the store directories (default: a temporary directory)")
+    args = parser.parse_args()
+
+    parent = args.data_dir or tempfile.mkdtemp(prefix="session_store_")
+    print("{:<8} {:>10} {:>10} {:>10} {:>10} {:>8}".format("store", "ops", "mean us", "p50 us", "p99 us", "inodes"))
+    for store in _NAMESPACE_CLASSES:
+        data_dir = os.path.join(parent, store)
+        os.makedirs(data_dir, exist_ok=True)
+        with multiprocessing.Pool(args.workers) as pool:
+            results = pool.map(_worker, [(store, data_dir, args.logins)] * args.workers)
+        timings = sorted(t for worker in results for t in worker)
+        print(
+            "{:<8} {:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+                store,
+                len(timings),
+                statistics.mean(timings) * 1e6,
+                timings[len(timings) // 2] * 1e6,
+                timings[int(len(timings) * 0.99)] * 1e6,
+                _count_inodes(data_dir),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
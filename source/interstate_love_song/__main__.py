@@ -7,7 +7,17 @@ from interstate_love_song._version import VERSION
 logger = logging.getLogger(__name__)
 
 
-def gunicorn_runner(wsgi, host, port, cert, key, no_ssl=False, worker_class="gevent", workers=2):
+def gunicorn_runner(
+    wsgi, host, port, cert, key, no_ssl=False, worker_class="gevent", workers=2, profile=None, worker_init=None, threads=1
+):
+    """
+    :param threads:
+        Threads per worker, for the gthread worker class.
+    :param profile:
+        (path, interval) to profile each worker with, or None.
+    :param worker_init:
+        Called without arguments in each worker, after the fork.
+    """
     from gunicorn.app.base import BaseApplication
 
     class _GunicornApp(BaseApplication):
@@ -32,6 +42,7 @@ def gunicorn_runner(wsgi, host, port, cert, key, no_ssl=False, worker_class="gev
         "log-level": "debug",
         "worker_class": worker_class,
         "workers": workers,
+        "threads": threads,
     }
     if not no_ssl:
         options.update(
@@ -41,6 +52,33 @@ def gunicorn_runner(wsgi, host, port, cert, key, no_ssl=False, worker_class="gev
             }
         )
 
+    post_fork_hooks = []
+    if worker_init:
+        post_fork_hooks.append(lambda server, worker: worker_init())
+    if profile:
+        # Each worker samples itself and writes its own file, the master does nothing worth profiling.
+        path, interval = profile
+        writers = {}
+
+        def start_profile(server, worker):
+            from .profiling import profile_until_exit
+
+            writers[worker.pid] = profile_until_exit("{}.{}".format(path, worker.pid), interval)
+
+        def worker_exit(server, worker):
+            if worker.pid in writers:
+                writers.pop(worker.pid)()
+
+        post_fork_hooks.append(start_profile)
+        options["worker_exit"] = worker_exit
+    if post_fork_hooks:
+
+        def post_fork(server, worker):
+            for hook in post_fork_hooks:
+                hook(server, worker)
+
+        options["post_fork"] = post_fork
+
     logger.info("Running gunicorn.")
     _GunicornApp(wsgi, options).run()
 
@@ -115,8 +153,17 @@ def main():
     argparser.add_argument("--key", default="selfsign.key")
     argparser.add_argument("--gunicorn-worker-class", default="gevent", help="only matters if -s gunicorn.")
     argparser.add_argument("--gunicorn-workers", default=2, type=int, help="only matters if -s gunicorn.")
+    argparser.add_argument(
+        "--gunicorn-threads", default=1, type=int, help="threads per worker, only matters with the gthread worker class."
+    )
     argparser.add_argument("--no-splash", action="store_true")
     argparser.add_argument("--no-ssl", action="store_true")
+    argparser.add_argument(
+        "--profile",
+        metavar="FILE",
+        help="Sample the server until it exits and write collapsed stacks to FILE (FILE.<pid> per gunicorn worker).",
+    )
+    argparser.add_argument("--profile-interval", default=5, type=int, help="Sampling interval in ms for --profile.")
 
     args = argparser.parse_args()
 
@@ -125,7 +172,9 @@ def main():
     else:
         logger.info("Version %s", VERSION)
 
-    logging.basicConfig(level=logging.INFO)
+    from .log import configure_logging
+
+    configure_logging(logging.INFO)
 
     if args.server in ("gunicorn",) and args.gunicorn_worker_class in ("gevent",):
         logger.info("Running gevent monkey patch all")
@@ -152,12 +201,106 @@ def main():
 
     from .http import get_falcon_api, BrokerResource, standard_protocol_creator
 
+    admission = None
+    if settings.rate_limit.enabled:
+        from .admission import AdmissionController
+
+        # Before gunicorn forks, so the workers share the buckets.
+        admission = AdmissionController(settings.rate_limit)
+        if not settings.rate_limit.client_ip_header:
+            logger.warning(
+                "Rate limiting by the peer address, behind a proxy set rate_limit.client_ip_header or all clients share "
+                "the proxy's buckets."
+            )
+
+    from .agent import AllocationLimiter, AgentConnections, AllocationCoalescer
+
+    limiter = AllocationLimiter(
+        settings.agent.max_concurrent,
+        settings.agent.max_per_host,
+        settings.agent.max_waiting,
+        settings.agent.max_waiting_per_host,
+        settings.agent.max_wait_seconds,
+    )
+    resolver = None
+    if settings.agent.dns_ttl_seconds > 0:
+        from .resolver import CachingResolver
+
+        resolver = CachingResolver(
+            settings.agent.dns_ttl_seconds,
+            settings.agent.dns_negative_ttl_seconds,
+            settings.agent.dns_refresh_ahead_seconds,
+        )
+        # Before gunicorn forks, so the workers start with the addresses.
+        resolver.prefetch(settings.mapper.hostnames)
+    connections = AgentConnections(
+        settings.agent.verify,
+        settings.agent.ca_bundle,
+        pool_connections=settings.agent.max_concurrent,
+        pool_maxsize=settings.agent.max_per_host,
+        resolver=resolver,
+    )
+
+    affinity = None
+    if settings.affinity.enabled:
+        from .affinity import HostAffinity
+
+        # Before gunicorn forks, so the workers share it.
+        affinity = HostAffinity(settings.affinity.ttl_seconds, settings.affinity.slots)
+
+    recorder = None
+    if settings.recording.path:
+        from .recording import TrafficRecorder
+
+        # Before gunicorn forks, so the workers tokenize alike.
+        recorder = TrafficRecorder(
+            settings.recording.path, settings.recording.redaction, settings.recording.key.encode("utf-8")
+        )
+        logger.info("Recording the traffic to %s.<pid>", settings.recording.path)
+
     wsgi = get_falcon_api(
-        BrokerResource(standard_protocol_creator(settings.mapper)),
+        BrokerResource(
+            standard_protocol_creator(
+                settings.mapper,
+                limiter,
+                connections,
+                affinity,
+                AllocationCoalescer(settings.agent.allocation_result_ttl_seconds),
+                settings.agent.hedge_delay_seconds,
+            ),
+            admission=admission,
+            max_body_bytes=settings.http.max_body_bytes,
+            read_timeout=settings.http.read_timeout_seconds,
+            recorder=recorder,
+        ),
         settings,
         use_fallback_sessions=args.fallback_sessions,
+        readiness_checks={"allocations": lambda: not limiter.saturated},
+        mapper=settings.mapper,
     )
 
+    profile = (args.profile, args.profile_interval / 1000.0) if args.profile else None
+    if profile and args.server != "gunicorn":
+        from .profiling import profile_until_exit
+
+        profile_until_exit(*profile)
+
+    janitor = None
+    if settings.beaker.janitor_interval > 0:
+        from .session import SessionJanitor
+
+        janitor = SessionJanitor(
+            settings.beaker.type,
+            settings.beaker.data_dir,
+            settings.beaker.ttl,
+            interval=settings.beaker.janitor_interval,
+            batch_size=settings.beaker.janitor_batch_size,
+        )
+        # Under gunicorn every worker starts one, so a worker, whose metrics we can see, sweeps and another takes over
+        # when it is recycled.
+        if args.server != "gunicorn":
+            janitor.start()
+
     if args.server == "werkzeug":
         werkzeug_runner(wsgi, args.host, args.port, args.cert, args.key, args.no_ssl)
     elif args.server == "gunicorn":
@@ -170,6 +313,9 @@ def main():
             args.no_ssl,
             worker_class=args.gunicorn_worker_class,
             workers=args.gunicorn_workers,
+            profile=profile,
+            worker_init=janitor.start if janitor else None,
+            threads=args.gunicorn_threads,
         )
     elif args.server == "cherrypy":
         cherrypy_runner(wsgi, args.host, args.port, args.cert, args.key, args.no_ssl)
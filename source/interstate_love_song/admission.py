@@ -0,0 +1,78 @@
+import logging
+import re
+from typing import Optional
+
+from .metrics import Metrics, metrics as default_metrics
+from .settings import RateLimitSettings
+from .shared import TokenBuckets, SharedTableError
+
+logger = logging.getLogger(__name__)
+
+# The request element follows the pcoip-client root within the first few hundred bytes.
+_REQUEST_TAG = re.compile(rb"<(hello|authenticate|get-resource-list|allocate-resource|bye)[\s/>]")
+_PEEK_BYTES = 1024
+
+EXPENSIVE_REQUESTS = frozenset([b"authenticate", b"allocate-resource"])
+
+
+def peek_request(body: bytes) -> Optional[bytes]:
+    """The name of the request element in a raw message, found without parsing it, or None."""
+    match = _REQUEST_TAG.search(body, 0, _PEEK_BYTES)
+    return match.group(1) if match else None
+
+
+class AdmissionController:
+    """Rate limits broker messages with token buckets shared by all the workers, so a brute forcing or misbehaving client
+    is turned away before we parse its message or hash its password.
+
+    Each client address has two budgets, one for the cheap messages (hello, get-resource-list, bye) and one for the
+    expensive ones (authenticate, which hashes a password, and allocate-resource, which calls an agent). Expensive
+    messages are also charged to the username, wherever they come from.
+
+    Create it before the server forks, so the workers share it.
+    """
+
+    def __init__(self, settings: RateLimitSettings, metrics: Metrics = default_metrics):
+        self._settings = settings
+        self._buckets = TokenBuckets(settings.slots)
+        self._metrics = metrics
+
+    @property
+    def client_ip_header(self) -> str:
+        return self._settings.client_ip_header
+
+    def _take(self, key: str, rate: float, burst: float) -> float:
+        if rate <= 0:
+            return 0.0
+        try:
+            return self._buckets.take(key, rate, burst)
+        except SharedTableError as e:
+            # Better to let everyone in than no one.
+            logger.error("Admitting without a rate limit: %s", e)
+            return 0.0
+
+    def admit_client(self, address: str, body: bytes) -> float:
+        """Charges a message to the client address.
+
+        :returns: 0 if admitted, otherwise the seconds until it would be.
+        """
+        settings = self._settings
+        if peek_request(body) in EXPENSIVE_REQUESTS:
+            wait = self._take("client!" + address, settings.client_expensive_rate, settings.client_expensive_burst)
+        else:
+            wait = self._take("client?" + address, settings.client_cheap_rate, settings.client_cheap_burst)
+        if wait:
+            self._metrics.inc("admission.rejected.client")
+            logger.info("Rejected a message from %s, over its rate limit.", address)
+        return wait
+
+    def admit_user(self, username: str) -> float:
+        """Charges an expensive message to the username.
+
+        :returns: 0 if admitted, otherwise the seconds until it would be.
+        """
+        wait = self._take("user:" + username, self._settings.user_rate, self._settings.user_burst)
+        if wait:
+            self._metrics.inc("admission.rejected.user")
+            logger.info("Rejected a message for user %s, over its rate limit.", username)
+        return wait
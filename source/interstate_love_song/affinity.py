@@ -0,0 +1,86 @@
+import logging
+import time
+from typing import Optional
+
+from .metrics import Metrics, metrics as default_metrics
+from .shared import SharedTable, SharedTableError
+
+logger = logging.getLogger(__name__)
+
+MAX_HOSTNAME_BYTES = 255
+# Stranded hosts share the table with the users' hosts, under keys no username has.
+_STRANDED_PREFIX = "\0stranded\0"
+
+
+class HostAffinity:
+    """The host each user was last allocated a session on, kept for ttl seconds in a SharedTable so all the workers see
+    it. The broker passes it to the mapper as previous_host, so a user who reconnects is sent back to the machine that
+    may still hold their session.
+
+    It also remembers, for a while, a host that allocated a user a session the broker didn't hand out, one that lost an
+    allocation race: until the agent drops that session, allocating the user another one there may fail.
+
+    Create it before the server forks, so the workers share it.
+    """
+
+    def __init__(
+        self, ttl: float = 28800.0, slots: int = 16384, metrics: Metrics = default_metrics, stranded_ttl: float = 300.0
+    ):
+        """
+        :param ttl:
+            Seconds to remember a host.
+        :param slots:
+            The number of users remembered at most, the least recently allocated are forgotten first.
+        :param stranded_ttl:
+            Seconds to remember a host holding a session the user was not handed.
+        :raises ValueError:
+            slots is not positive.
+        """
+        self._ttl = ttl
+        self._stranded_ttl = stranded_ttl
+        self._table = SharedTable(slots, "d{}s".format(MAX_HOSTNAME_BYTES))
+        self._metrics = metrics
+
+    def _put(self, key: str, hostname: str, ttl: float):
+        encoded = hostname.encode("utf-8")
+        if len(encoded) > MAX_HOSTNAME_BYTES:
+            return
+        expires = time.monotonic() + ttl
+        try:
+            self._table.update(key, lambda values, elapsed: ((expires, encoded), None))
+        except SharedTableError as e:
+            logger.error("Failed to remember the host of %s: %s", key, e)
+
+    def _get(self, key: str) -> Optional[str]:
+        try:
+            values = self._table.get(key)
+        except SharedTableError as e:
+            logger.error("Failed to recall the host of %s: %s", key, e)
+            return None
+        if values is None or values[0] <= time.monotonic():
+            return None
+        return values[1].rstrip(b"\0").decode("utf-8")
+
+    def remember(self, username: str, hostname: str):
+        self._put(username, hostname, self._ttl)
+
+    def recall(self, username: str) -> Optional[str]:
+        """The host the user was last allocated, or None if there is none or it was too long ago."""
+        hostname = self._get(username)
+        if hostname is not None:
+            self._metrics.inc("affinity.recalled")
+        return hostname
+
+    def strand(self, username: str, hostname: str):
+        """Remembers that hostname allocated the user a session they were not handed."""
+        self._put(_STRANDED_PREFIX + username, hostname, self._stranded_ttl)
+
+    def stranded(self, username: str) -> Optional[str]:
+        """The host holding a session the user was not handed, or None if there is none or it was too long ago."""
+        return self._get(_STRANDED_PREFIX + username)
+
+    def forget(self, username: str):
+        try:
+            self._table.delete(username)
+        except SharedTableError as e:
+            logger.error("Failed to forget the host of %s: %s", username, e)
@@ -1,16 +1,33 @@
+import asyncio
+import functools
+import hashlib
 import logging
+import os
+import secrets
+import threading
+import time
+from collections import Counter, OrderedDict
 from dataclasses import dataclass
 from enum import Enum
 from io import BytesIO
-from typing import Optional, Tuple
-from xml.etree.ElementTree import Element, SubElement, ElementTree, fromstring
+from typing import Optional, Tuple, Callable
+from xml.sax.saxutils import escape
 
 import requests
+from defusedxml import DefusedXmlException
+from defusedxml.ElementTree import iterparse
 from urllib3.exceptions import NewConnectionError
 
+from .metrics import Metrics, metrics as default_metrics
+from .resolver import CachingResolver
+from .tls import AgentAdapter, create_agent_ssl_context
+
 logger = logging.getLogger(__name__)
 
 REQUEST_TIMEOUT = 10.0
+# A launch-session response is a few hundred bytes.
+MAX_RESPONSE_BYTES = 65536
+_READ_CHUNK_BYTES = 8192
 
 
 class AllocateSessionStatus(Enum):
@@ -22,6 +39,7 @@ class AllocateSessionStatus(Enum):
     CONNECTION_ERROR = 100
     XML_ERROR = 101
     ENDPOINT_ERROR = 102
+    OVERLOADED = 103
 
 
 @dataclass
@@ -43,97 +61,447 @@ def allocate_session(
     client_name: str = "Bobby McGee",
     session_type: str = "UNSPECIFIED",
     timeout=REQUEST_TIMEOUT,
+    max_response_bytes=MAX_RESPONSE_BYTES,
+    connections: Optional["AgentConnections"] = None,
+    client_session_id: Optional[str] = None,
 ) -> Tuple[AllocateSessionStatus, Optional[AgentSession]]:
-    """Contacts a Teradici resource ("the agent"), and tries to acquire a session from it.
+    """Contacts a Teradici resource ("the agent"), and tries to acquire a session from it. A response larger than
+    max_response_bytes is an ENDPOINT_ERROR. The call goes through connections, by default without verifying the
+    certificate of the agent.
+
+    client_session_id identifies the client's login with the broker, for the wrappers that tell logins apart, like
+    AllocationCoalescer; the agent isn't sent it.
 
     :returns: The session on success, None on failure.
     """
 
-    def build_launch_session_xml() -> Element:
-        pcoip_agent = Element("pcoip-agent", version="1.0")
-
-        launch_session = SubElement(pcoip_agent, "launch-session")
-
-        for tag, text in [
-            ("session-type", session_type),
-            ("ip-address", "127.0.0.1"),
-            ("hostname", agent_hostname),
-        ]:
-            SubElement(launch_session, tag).text = text
-
-        logon = SubElement(launch_session, "logon", method="windows-password")
-
-        SubElement(logon, "username").text = username
-        SubElement(logon, "password").text = password
-        SubElement(logon, "domain").text = domain
-
-        for tag, text in [
-            ("client-mac", ""),
-            ("client-ip", ""),
-            ("client-name", client_name),
-            ("license-path", ""),
-            ("session-log-id", ""),
-        ]:
-            SubElement(launch_session, tag).text = text
-
-        return pcoip_agent
-
-    request_body = BytesIO()
-    et = ElementTree(build_launch_session_xml())
-    et.write(request_body, encoding="utf-8", xml_declaration=True)
-
-    def parse_xml_response(
-        response_xml: Element,
-    ) -> Tuple[AllocateSessionStatus, Optional[AgentSession]]:
-        result_id = response_xml.find("launch-session-resp/result-id")
-        if result_id is None:
-            return AllocateSessionStatus.XML_ERROR, None
-
-        if result_id.text.lower() == "successful":
-            session_info = response_xml.find("launch-session-resp/session-info")
-            if session_info is None:
-                return AllocateSessionStatus.XML_ERROR, None
-
-            session_properties = {"resource_id": str(resource_id)}
-            for property in ("ip-address", "sni", "port", "session-id", "session-tag"):
-                element = session_info.find(property)
-                if element is None:
-                    return AllocateSessionStatus.XML_ERROR, None
-
-                session_properties[property.replace("-", "_")] = element.text if property != "port" else int(element.text)
-
-            return AllocateSessionStatus.SUCCESSFUL, AgentSession(**session_properties)
-        elif result_id.text.lower() == "failed_user_auth":
-            return AllocateSessionStatus.FAILED_USER_AUTH, None
-        elif result_id.text.lower() == "failed_another_session_started":
-            return AllocateSessionStatus.FAILED_ANOTHER_SESSION_STARTED, None
-        else:
-            logger.warning("Unknown result-id: %s", result_id.text)
-            return AllocateSessionStatus.XML_ERROR, None
+    request_body = build_launch_session_request(agent_hostname, username, password, domain, client_name, session_type)
 
     try:
-        response = requests.post(
+        with (connections or default_connections).session().post(
             "https://{}:60443/pcoip-agent/xml".format(agent_hostname),
-            data=request_body.getvalue(),
-            verify=False,
+            data=request_body,
             timeout=timeout,
-        )
-
-        if response.status_code != 200:
+            stream=True,
+        ) as response:
+            if response.status_code != 200:
+                return AllocateSessionStatus.ENDPOINT_ERROR, None
+            body = _read_capped(response, max_response_bytes)
+        if body is None:
+            logger.info("The agent at %s sent more than %s bytes.", agent_hostname, max_response_bytes)
             return AllocateSessionStatus.ENDPOINT_ERROR, None
-        response_xml = fromstring(response.text)
 
-        status, agent_session = parse_xml_response(response_xml)
+        status, agent_session = parse_launch_session_response(body, resource_id)
         if not agent_session:
-            logger.info("Failure when deconstructing XML from agent at {}.".format(agent_hostname))
+            logger.info("Failure when deconstructing XML from agent at %s.", agent_hostname)
         return status, agent_session
 
-    except SyntaxError as se:
-        logger.info("Could not parse XML returned from Agent: {}".format(se))
+    except (SyntaxError, DefusedXmlException) as e:
+        logger.info("Could not parse XML returned from Agent: %s", e)
         return AllocateSessionStatus.XML_ERROR, None
     except requests.exceptions.ConnectionError as ce:
-        logger.info("Could not establish a connection to the agent host {}: {}".format(agent_hostname, ce))
+        logger.info("Could not establish a connection to the agent host %s: %s", agent_hostname, ce)
         return AllocateSessionStatus.CONNECTION_ERROR, None
     except NewConnectionError as nce:
-        logger.info("Could not establish a connection to the agent host {}.".format(agent_hostname))
+        logger.info("Could not establish a connection to the agent host %s.", agent_hostname)
         return AllocateSessionStatus.CONNECTION_ERROR, None
+    except requests.exceptions.RequestException as re:
+        logger.info("The request to the agent host %s failed: %s", agent_hostname, re)
+        return AllocateSessionStatus.CONNECTION_ERROR, None
+
+
+async def allocate_session_async(*args, **kwargs) -> Tuple[AllocateSessionStatus, Optional[AgentSession]]:
+    """allocate_session, run in the default executor of the event loop so it doesn't block it. Takes the same arguments."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(allocate_session, *args, **kwargs))
+
+
+class AgentConnections:
+    """The requests session the agents are called through, with a cached SSLContext that resumes TLS sessions, and the
+    kept alive connections. Each process gets its own on first use, nothing is shared across a fork.
+    """
+
+    def __init__(
+        self,
+        verify: bool = False,
+        ca_bundle: str = "",
+        pool_connections: int = 64,
+        pool_maxsize: int = 8,
+        resolver: Optional[CachingResolver] = None,
+        metrics: Metrics = default_metrics,
+    ):
+        """
+        :param verify:
+            Whether to verify the certificates of the agents.
+        :param ca_bundle:
+            The certificates to trust, see create_agent_ssl_context.
+        :param pool_connections:
+            The number of hosts to keep connections to.
+        :param pool_maxsize:
+            The connections to keep to a host.
+        :param resolver:
+            Looks up the agent hosts, if given, rather than the system resolver on every connection.
+        """
+        self._verify = verify
+        self._ca_bundle = ca_bundle
+        self._pool_connections = pool_connections
+        self._pool_maxsize = pool_maxsize
+        self._resolver = resolver
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._pid = None
+        self._session: Optional[requests.Session] = None
+
+    def _create_session(self) -> requests.Session:
+        context = create_agent_ssl_context(self._verify, self._ca_bundle, self._metrics)
+        session = requests.Session()
+        session.mount(
+            "https://",
+            AgentAdapter(context, self._resolver, pool_connections=self._pool_connections, pool_maxsize=self._pool_maxsize),
+        )
+        return session
+
+    def session(self) -> requests.Session:
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._session = self._create_session()
+                    self._pid = pid
+        return self._session
+
+
+default_connections = AgentConnections()
+
+
+def _text_element(tag: str, text: Optional[str]) -> str:
+    # The same as ElementTree writes it, which leaves the quotes alone in text.
+    if not text:
+        return "<{} />".format(tag)
+    if not isinstance(text, str):
+        raise TypeError("cannot serialize {!r} (type {})".format(text, type(text).__name__))
+    return "<{0}>{1}</{0}>".format(tag, escape(text))
+
+
+@functools.lru_cache(maxsize=1024)
+def _launch_session_prefix(session_type: str, agent_hostname: str) -> bytes:
+    return (
+        "<?xml version='1.0' encoding='utf-8'?>\n"
+        '<pcoip-agent version="1.0"><launch-session>'
+        + _text_element("session-type", session_type)
+        + "<ip-address>127.0.0.1</ip-address>"
+        + _text_element("hostname", agent_hostname)
+        + '<logon method="windows-password">'
+    ).encode("utf-8", "xmlcharrefreplace")
+
+
+_LAUNCH_SESSION_INFIX = "</logon><client-mac /><client-ip />"
+_LAUNCH_SESSION_SUFFIX = "<license-path /><session-log-id /></launch-session></pcoip-agent>"
+
+
+def build_launch_session_request(
+    agent_hostname: str,
+    username: str,
+    password: str,
+    domain: str,
+    client_name: str = "Bobby McGee",
+    session_type: str = "UNSPECIFIED",
+) -> bytes:
+    """The launch-session request for an agent, byte for byte what writing the equivalent ElementTree with an XML
+    declaration gives, without building the tree. The part up to the logon, which only depends on the host and session
+    type, is cached.
+    """
+    variable = "".join(
+        [
+            _text_element("username", username),
+            _text_element("password", password),
+            _text_element("domain", domain),
+            _LAUNCH_SESSION_INFIX,
+            _text_element("client-name", client_name),
+            _LAUNCH_SESSION_SUFFIX,
+        ]
+    )
+    return _launch_session_prefix(session_type, agent_hostname) + variable.encode("utf-8", "xmlcharrefreplace")
+
+
+def _read_capped(response: requests.Response, max_bytes: int) -> Optional[bytes]:
+    """The body of a streamed response, or None if it is larger than max_bytes."""
+    chunks, size = [], 0
+    for chunk in response.iter_content(_READ_CHUNK_BYTES):
+        size += len(chunk)
+        if size > max_bytes:
+            return None
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+_RESULT_ID_PATH = ("launch-session-resp", "result-id")
+_SESSION_INFO_PATH = ("launch-session-resp", "session-info")
+_SESSION_INFO_FIELDS = {
+    "ip-address": "ip_address",
+    "sni": "sni",
+    "port": "port",
+    "session-id": "session_id",
+    "session-tag": "session_tag",
+}
+
+
+def parse_launch_session_response(body: bytes, resource_id: str) -> Tuple[AllocateSessionStatus, Optional[AgentSession]]:
+    """Parses a launch-session response from the agent. The parser is defused, it refuses DTDs and entities, and the
+    document is read incrementally: only result-id and the session-info fields are kept, everything else is discarded
+    as soon as it has been read.
+
+    :raises SyntaxError: The document is not well-formed.
+    :raises DefusedXmlException: The document has forbidden constructs.
+    """
+    result_id = None
+    session_properties = {}
+    path = []
+    for event, element in iterparse(BytesIO(body), events=("start", "end"), forbid_dtd=True):
+        if event == "start":
+            path.append(element.tag)
+            continue
+        location = tuple(path[1:])
+        if location == _RESULT_ID_PATH:
+            result_id = element.text or ""
+        elif location[:-1] == _SESSION_INFO_PATH and element.tag in _SESSION_INFO_FIELDS:
+            session_properties[_SESSION_INFO_FIELDS[element.tag]] = element.text
+        path.pop()
+        element.clear()
+
+    if result_id is None:
+        return AllocateSessionStatus.XML_ERROR, None
+
+    result_id = result_id.lower()
+    if result_id == "successful":
+        if len(session_properties) != len(_SESSION_INFO_FIELDS):
+            return AllocateSessionStatus.XML_ERROR, None
+        try:
+            session_properties["port"] = int(session_properties["port"])
+        except (TypeError, ValueError):
+            return AllocateSessionStatus.XML_ERROR, None
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession(resource_id=str(resource_id), **session_properties)
+    elif result_id == "failed_user_auth":
+        return AllocateSessionStatus.FAILED_USER_AUTH, None
+    elif result_id == "failed_another_session_started":
+        return AllocateSessionStatus.FAILED_ANOTHER_SESSION_STARTED, None
+    else:
+        logger.warning("Unknown result-id: %s", result_id)
+        return AllocateSessionStatus.XML_ERROR, None
+
+
+AllocateSession = Callable[..., Tuple[AllocateSessionStatus, Optional[AgentSession]]]
+
+
+class AllocationLimiter:
+    """Bounds the agent calls a worker makes at once, in total and per agent host, so a flood of allocations to one
+    slow host can't use up the worker, or the host's capacity, for everyone else.
+
+    A call that can't run right away waits its turn, in a queue bounded in total and per host. When the queue is full,
+    or the wait too long, the call fails fast with AllocateSessionStatus.OVERLOADED instead of piling up.
+
+    Waiting uses the threading primitives, which are cooperative on a monkey patched gevent worker.
+    """
+
+    def __init__(
+        self,
+        max_concurrent: int = 64,
+        max_per_host: int = 8,
+        max_waiting: int = 256,
+        max_waiting_per_host: int = 32,
+        max_wait: float = 10.0,
+        metrics: Metrics = default_metrics,
+    ):
+        """
+        :param max_concurrent:
+            Agent calls in progress at once.
+        :param max_per_host:
+            Agent calls in progress at once to a single host.
+        :param max_waiting:
+            Calls waiting for their turn, in total.
+        :param max_waiting_per_host:
+            Calls waiting for their turn to call a single host.
+        :param max_wait:
+            Seconds a call waits for its turn at most.
+        :raises ValueError:
+            max_concurrent or max_per_host is not positive.
+        """
+        if max_concurrent <= 0 or max_per_host <= 0:
+            raise ValueError("max_concurrent and max_per_host must be positive.")
+        self._max_concurrent = max_concurrent
+        self._max_per_host = max_per_host
+        self._max_waiting = max_waiting
+        self._max_waiting_per_host = max_waiting_per_host
+        self._max_wait = max_wait
+        self._metrics = metrics
+        self._condition = threading.Condition()
+        self._active = 0
+        self._active_per_host = Counter()
+        self._waiting = 0
+        self._waiting_per_host = Counter()
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    @property
+    def saturated(self) -> bool:
+        """Whether the queue is full, every new call that has to wait is turned away."""
+        return self._waiting >= self._max_waiting
+
+    def _can_run(self, host: str) -> bool:
+        return self._active < self._max_concurrent and self._active_per_host[host] < self._max_per_host
+
+    def _update_gauges(self):
+        self._metrics.set("agent.allocations.active", self._active)
+        self._metrics.set("agent.allocations.waiting", self._waiting)
+
+    def _reject(self, host: str, reason: str) -> bool:
+        self._metrics.inc("agent.allocations.rejected")
+        logger.warning("Turned away an allocation on %s, %s.", host, reason)
+        return False
+
+    def _acquire(self, host: str) -> bool:
+        with self._condition:
+            if not self._can_run(host):
+                if self._waiting >= self._max_waiting or self._waiting_per_host[host] >= self._max_waiting_per_host:
+                    return self._reject(host, "the queue is full")
+
+                self._waiting += 1
+                self._waiting_per_host[host] += 1
+                self._update_gauges()
+                start = time.monotonic()
+                try:
+                    ready = self._condition.wait_for(lambda: self._can_run(host), self._max_wait)
+                finally:
+                    self._waiting -= 1
+                    self._waiting_per_host[host] -= 1
+                    if not self._waiting_per_host[host]:
+                        del self._waiting_per_host[host]
+                    waited = time.monotonic() - start
+                    self._metrics.inc("agent.allocations.waited")
+                    self._metrics.inc("agent.allocations.wait_seconds", waited)
+                    self._metrics.set("agent.allocations.last_wait_seconds", waited)
+                if not ready:
+                    self._update_gauges()
+                    return self._reject(host, "it waited too long")
+
+            self._active += 1
+            self._active_per_host[host] += 1
+            self._update_gauges()
+            return True
+
+    def _release(self, host: str):
+        with self._condition:
+            self._active -= 1
+            self._active_per_host[host] -= 1
+            if not self._active_per_host[host]:
+                del self._active_per_host[host]
+            self._update_gauges()
+            self._condition.notify_all()
+
+    def limit(self, allocate_session: AllocateSession) -> AllocateSession:
+        """Wraps an allocate_session function, like agent.allocate_session, in the limits."""
+
+        @functools.wraps(allocate_session)
+        def limited(resource_id, agent_hostname, *args, **kwargs):
+            if not self._acquire(agent_hostname):
+                return AllocateSessionStatus.OVERLOADED, None
+            try:
+                return allocate_session(resource_id, agent_hostname, *args, **kwargs)
+            finally:
+                self._release(agent_hostname)
+
+        return limited
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.expires = None
+
+
+class AllocationCoalescer:
+    """Coalesces duplicate allocations. PCoIP clients sometimes send an allocation again while the first is still in
+    progress, and a second launch on the agent for the same user tends to end with FAILED_ANOTHER_SESSION_STARTED.
+
+    Calls of the same login (client_session_id) for the same resource and host, with the same credentials, share the
+    result of the first one in progress, and a successful result is handed to the same calls for result_ttl seconds
+    after. Another login, even of the same user, gets its own session. Failures aren't kept, a retry
+    tries again. The calls of a worker are coalesced, not those of different workers.
+    """
+
+    def __init__(self, result_ttl: float = 5.0, metrics: Metrics = default_metrics):
+        """
+        :param result_ttl:
+            Seconds to keep handing out a successful result, 0 to only coalesce the calls in progress.
+        """
+        self._result_ttl = result_ttl
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        # By completion, the finished flights expire in order from the front.
+        self._flights: "OrderedDict[tuple, _Flight]" = OrderedDict()
+        # The key holds a digest of the password, not the password.
+        self._secret = secrets.token_bytes(16)
+
+    def _key(self, client_session_id, resource_id, agent_hostname, username, password, domain) -> tuple:
+        digest = hashlib.blake2b(str(password).encode("utf-8"), digest_size=16, key=self._secret).digest()
+        return client_session_id, str(resource_id), agent_hostname, username, domain, digest
+
+    def _expire(self, now: float):
+        while self._flights:
+            flight = next(iter(self._flights.values()))
+            if flight.expires is None or flight.expires > now:
+                return
+            self._flights.popitem(last=False)
+
+    @property
+    def in_flight(self) -> int:
+        """The calls in progress or with a kept result."""
+        return len(self._flights)
+
+    def coalesce(self, allocate_session: AllocateSession) -> AllocateSession:
+        """Wraps an allocate_session function, like agent.allocate_session."""
+
+        @functools.wraps(allocate_session)
+        def coalesced(resource_id, agent_hostname, username, password, domain, *args, **kwargs):
+            key = self._key(kwargs.get("client_session_id"), resource_id, agent_hostname, username, password, domain)
+            with self._lock:
+                now = time.monotonic()
+                self._expire(now)
+                flight = self._flights.get(key)
+                # One behind a call in progress at the front may have expired too.
+                leader = flight is None or (flight.expires is not None and flight.expires <= now)
+                if leader:
+                    self._flights.pop(key, None)
+                    flight = self._flights[key] = _Flight()
+
+            if not leader:
+                self._metrics.inc("agent.allocations.coalesced")
+                flight.done.wait()
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+
+            try:
+                flight.result = allocate_session(resource_id, agent_hostname, username, password, domain, *args, **kwargs)
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    if flight.error is None and flight.result[0] == AllocateSessionStatus.SUCCESSFUL and self._result_ttl > 0:
+                        flight.expires = time.monotonic() + self._result_ttl
+                        self._flights.move_to_end(key)
+                    else:
+                        del self._flights[key]
+                flight.done.set()
+            return flight.result
+
+        return coalesced
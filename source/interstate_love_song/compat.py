@@ -0,0 +1,63 @@
+import importlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable
+
+try:
+    import gevent
+    from gevent import monkey
+except ImportError:
+    # Looked up once: a failed import isn't cached, it would search the path again on every call.
+    gevent, monkey = None, None
+
+# Threads of the pool that runs spawned calls, when the worker isn't gevent's.
+SPAWN_POOL_SIZE = 32
+
+
+def unpatched(module: str, name: str):
+    """Returns module.name as it was before any gevent monkey patching, or as it is when gevent isn't installed.
+
+    Anything that must run on a real OS thread, and not on a greenlet, should get its primitives from here.
+    """
+    if monkey is None:
+        return getattr(importlib.import_module(module), name)
+    return monkey.get_original(module, name)
+
+
+@contextmanager
+def cooperative_timeout(seconds: float):
+    """On a monkey patched gevent worker, raises TimeoutError in the block once seconds have passed, even in the middle
+    of a blocking socket read. Elsewhere it does nothing; a blocking read on a real thread can't be interrupted, there
+    the server's own socket timeout has to do.
+    """
+    if monkey is None or not monkey.is_module_patched("socket"):
+        yield
+        return
+    with gevent.Timeout(seconds, TimeoutError):
+        yield
+
+
+_pool, _pool_pid = None, None
+_pool_lock = threading.Lock()
+
+
+def _spawn_pool() -> ThreadPoolExecutor:
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            # The threads of a pool don't survive a fork, each worker needs its own.
+            _pool, _pool_pid = ThreadPoolExecutor(SPAWN_POOL_SIZE, thread_name_prefix="spawn"), os.getpid()
+        return _pool
+
+
+def spawn(function: Callable, *args):
+    """Calls function(*args) in the background, the way the worker runs requests: on a greenlet on a monkey patched
+    gevent worker, elsewhere on a thread of a pool of SPAWN_POOL_SIZE threads per process. The result is dropped, and so
+    is any exception, function must handle its own.
+    """
+    if monkey is not None and monkey.is_module_patched("threading"):
+        gevent.spawn(function, *args)
+    else:
+        _spawn_pool().submit(function, *args)
@@ -1,40 +1,85 @@
+import functools
+import hmac
 import logging
+import math
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
-from io import BytesIO
+from copy import copy
 
 from falcon.util import compat
-from typing import Callable, Any, Optional
-from xml.etree.ElementTree import ParseError, ElementTree
+from typing import Callable, Optional, Sequence, Mapping
+from xml.etree.ElementTree import ParseError
 
 import falcon
 from defusedxml.ElementTree import fromstring
 from falcon import API
 from falcon_middleware_beaker import BeakerSessionMiddleware
-from beaker.session import SessionObject
 
 
 from ._version import VERSION
+from .admission import AdmissionController
+from .affinity import HostAffinity
+from .agent import AllocationLimiter, AgentConnections, AllocationCoalescer
+from .compat import cooperative_timeout
+from .log import configure_logging
 from .mapping import Mapper
+from .metrics import Metrics, metrics as default_metrics
+from .profiling import profile_for, DEFAULT_INTERVAL
 from .protocol import ProtocolHandler, ProtocolSession, BrokerProtocolHandler
-from .serialization import serialize_message, deserialize_message
+from .recording import TrafficRecorder
+from .serialization import serialize_message, deserialize_message, encode_message, encode_element
+from .session import SqliteNamespaceManager, ShardedFileNamespaceManager, HeaderSession
 from .settings import Settings
+from .transport import AuthenticateRequest, AllocateResourceRequest
 
 ProtocolCreator = Callable[[], ProtocolHandler]
 
+BROKER_PATH = "/pcoip-broker/xml"
+
+READ_CHUNK_BYTES = 4096
+
 logger = logging.getLogger(__name__)
 
 
-def standard_protocol_creator(mapper: Mapper):
-    """Curries a creator function with the given mapper. The creator returns a BrokerProtocolHandler."""
+def standard_protocol_creator(
+    mapper: Mapper,
+    limiter: Optional[AllocationLimiter] = None,
+    connections: Optional[AgentConnections] = None,
+    affinity: Optional[HostAffinity] = None,
+    coalescer: Optional[AllocationCoalescer] = None,
+    hedge_delay: float = 2.0,
+):
+    """Curries a creator function with the given mapper. The creator returns a BrokerProtocolHandler.
+
+    :param limiter:
+        Limits the calls to the agents, if given.
+    :param connections:
+        The agents are called through these, if given.
+    :param affinity:
+        Remembers the host each user was allocated, if given.
+    :param coalescer:
+        Coalesces duplicate allocations, if given, before they count against the limits.
+    :param hedge_delay:
+        Seconds to wait for a host of a pooled resource before also trying the next one.
+    """
 
     def creator():
-        return BrokerProtocolHandler(mapper, mapper.allocate_session)
+        allocate_session = mapper.allocate_session
+        if connections is not None:
+            allocate_session = functools.partial(allocate_session, connections=connections)
+        if limiter is not None:
+            allocate_session = limiter.limit(allocate_session)
+        if coalescer is not None:
+            allocate_session = coalescer.coalesce(allocate_session)
+        return BrokerProtocolHandler(mapper, allocate_session, affinity, hedge_delay=hedge_delay)
 
     return creator
 
 
 class SessionSetter(ABC):
-    """Sets the session data.
+    """Sets the session data. Setters are stateless and shared by all requests, the request is passed to each call.
 
     .. note::
         This seemingly unnecessary type is here solely for testing. We want to make sure the endpoint sets session data
@@ -42,87 +87,139 @@ class SessionSetter(ABC):
     """
 
     @abstractmethod
-    def set_data(self, data: Optional[ProtocolSession]):
+    def set_data(self, request, data: Optional[ProtocolSession]):
         pass
 
     @abstractmethod
-    def get_data(self):
+    def get_data(self, request):
         pass
 
 
 class BeakerSessionSetter(SessionSetter):
-    """The default session setter. Unless you are testing, you want to use this."""
-
-    def __init__(self, request):
-        self._request = request
-
-    def set_data(self, data: Optional[ProtocolSession]):
-        self._request.env["beaker.session"]["protocol"] = data
-
-    def get_data(self):
-        if "protocol" not in self._request.env["beaker.session"]:
-            return None
-        return self._request.env["beaker.session"]["protocol"]
+    """The default session setter. Unless you are testing, you want to use this.
 
+    It drives persistence itself, the session middleware never saves on its own: the session is saved only when the
+    data differs from what was loaded, removed from the store as soon as the data goes away (a bye), and left alone
+    otherwise. A QueryBrokerClient hello, which has no session before and none after, never touches the store.
+    """
 
-SessionSetterCreator = Callable[[Any], SessionSetter]
+    def get_data(self, request):
+        data = request.env["beaker.session"].get("protocol")
+        # The protocol handler mutates the session in place, keep a copy of what we loaded to compare against.
+        request.context.loaded_protocol_session = copy(data)
+        return data
 
+    def set_data(self, request, data: Optional[ProtocolSession]):
+        if data == getattr(request.context, "loaded_protocol_session", None):
+            return
 
-def beaker_session_creator(request) -> SessionSetter:
-    """Creates BeakerSessionSetters from requests.. This should be your default unless you are testing."""
-    return BeakerSessionSetter(request)
+        session = request.env["beaker.session"]
+        if data is None:
+            # Only a loaded session has a namespace, and a session that wasn't loaded has nothing to remove.
+            namespace = getattr(session, "namespace", None)
+            if namespace is not None:
+                namespace.remove()
+        else:
+            session["protocol"] = data
+            session.save()
 
 
 class BrokerResource:
-    """The HTTP endpoint for the Broker, where all the communication with a client begins."""
+    """The HTTP endpoint for the Broker, where all the communication with a client begins.
+
+    Everything the request path needs, the protocol handler, the (de)serializers and the session setter, is built once
+    when the resource is constructed; a request only allocates what its own message needs.
+    """
 
     def __init__(
         self,
         protocol_creator: ProtocolCreator,
         serialize=serialize_message,
         deserialize=deserialize_message,
-        session_setter_creator: SessionSetterCreator = beaker_session_creator,
+        session_setter: Optional[SessionSetter] = None,
+        admission: Optional[AdmissionController] = None,
+        max_body_bytes: int = 65536,
+        read_timeout: float = 10.0,
+        metrics: Metrics = default_metrics,
+        recorder: Optional[TrafficRecorder] = None,
     ):
         """
         :param protocol_creator:
-            Creates protocol handlers.
+            Creates the protocol handler. It is called once, the handler is then shared by all requests and must be
+            stateless, like BrokerProtocolHandler.
         :param serialize:
             The serialize function for messages.
         :param deserialize:
             The deserialize function for messages.
-        :param session_setter_creator:
-            Creates session setters. You don't need to touch this except when testing.
+        :param session_setter:
+            Reads and writes the session data, defaults to a BeakerSessionSetter. You don't need to touch this except
+            when testing.
+        :param admission:
+            Rate limits the messages, if given.
+        :param max_body_bytes:
+            Larger request bodies are rejected, PCoIP messages are a few hundred bytes.
+        :param read_timeout:
+            Seconds the client has to send the request body.
+        :param recorder:
+            Records the requests and responses, if given.
         :raise ValueError:
-            A parameter was not callable.
+            A parameter was not callable, or session_setter is not a SessionSetter.
         """
-        if not all(
-            map(
-                callable,
-                [protocol_creator, serialize, deserialize, session_setter_creator],
-            )
-        ):
+        if not all(map(callable, [protocol_creator, serialize, deserialize])):
             raise ValueError("A parameter was not callable.")
-        self._protocol_creator = protocol_creator
+        if session_setter is None:
+            session_setter = BeakerSessionSetter()
+        if not isinstance(session_setter, SessionSetter):
+            raise ValueError("session_setter must be a SessionSetter.")
+        self._protocol = protocol_creator()
         self._serialize = serialize
+        if serialize is serialize_message:
+            self._encode = encode_message
+        else:
+            self._encode = lambda msg: encode_element(serialize(msg))
         self._deserialize = deserialize
-        self._session_setter_creator = session_setter_creator
+        self._session_setter = session_setter
+        self._admission = admission
+        self._max_body_bytes = max_body_bytes
+        self._read_timeout = read_timeout
+        self._metrics = metrics
+        self._recorder = recorder
 
     def on_post(self, req, resp):
         """Receives an XML payload, decodes it and runs it through the protocol. This endpoint is stateful."""
-        protocol = self._protocol_creator()
-
-        session_setter = self._session_setter_creator(req)
+        if self._recorder is None:
+            self._handle(req, resp)
+        else:
+            with self._recorder.exchange(req, resp):
+                self._handle(req, resp)
 
+    def _handle(self, req, resp):
         try:
-            xml_str = req.bounded_stream.read()
+            xml_str = self._read_body(req)
+            if self._admission is not None:
+                address = _client_address(req, self._admission.client_ip_header)
+                _reject_if_waiting(self._admission.admit_client(address, xml_str))
+
+            if self._recorder is not None:
+                req.context.broker_request_body = xml_str
             xml = fromstring(xml_str)
+            if self._recorder is not None:
+                req.context.broker_request_xml = xml
 
             in_msg = self._deserialize(xml)
 
-            logger.debug("Received POST: Message: %s.", str(in_msg))
+            logger.debug("Received POST: Message: %s.", in_msg)
+
+            session_data = self._session_setter.get_data(req)
+            if self._admission is not None:
+                username = _charged_username(in_msg, session_data)
+                if username is not None:
+                    _reject_if_waiting(self._admission.admit_user(username))
 
-            new_session_data, out_msg = protocol(in_msg, session_setter.get_data())
-            session_setter.set_data(new_session_data)
+            new_session_data, out_msg = self._protocol(in_msg, session_data)
+            self._session_setter.set_data(req, new_session_data)
+            if self._recorder is not None:
+                req.context.broker_response = out_msg
 
             if out_msg is None:
                 logger.warning(
@@ -130,64 +227,254 @@ class BrokerResource:
                 )
                 raise falcon.HTTPInternalServerError(description="Unexpected message received, probably a bug.")
 
-            f = BytesIO()
-            ElementTree(self._serialize(out_msg)).write(f, encoding="utf-8", xml_declaration=True)
-
             # WE MUST RETURN A CHUNKED STREAM, OR TERADICI WILL BE VERY UNHAPPY.
             # DON'T JUST CHANGE THIS TO resp.body = blabla, AS OF 2020, IT MUST BE A CHUNKED STREAM.
             # I REPEAT. IT MUST BE A CHUNKED STREAM.
-            resp.stream = [f.getvalue()]
+            resp.stream = self._encode(out_msg)
 
             resp.content_type = falcon.MEDIA_XML
 
-            logger.debug("Responded with %s.", str(out_msg))
+            logger.debug("Responded with %s.", out_msg)
         except SyntaxError:
             raise falcon.HTTPBadRequest(description="Malformed XML.")
 
-    def on_get(self, req, resp):
-        data = """
-        <html>
-        <head>
-            <title>Interstate Love Song</title>
-            <style>
-                body {{
-                    font-family: sans-serif;
-                    height: 100%;
-                    background: lightgray;
-                    color: gray;
-                }}
-                .container {{
-                    height: 100%;
-                    display: flex;
-                    align-items: center;
-                    justify-content: center;
-                }}
-                h1 {{
-                    font-size: 2em;
-                }}
-                h2 {{
-                    position: relative;
-                    top: 1.5em;
-                    right: 1em;
-                }}
-            </style>
-        </head>
-        <body>
-            <div class="container">
-                <h1>Interstate Love Song</h1>
-                <h2>
-                    v{version}
-                </h2>
-            </div>
-        </body>
-        </html>
-        """.format(
-            version=VERSION
-        )
+    def _read_body(self, req) -> bytes:
+        """Reads the body a chunk at a time, never holding more than max_body_bytes and giving up at the deadline.
+
+        :raises falcon.HTTPPayloadTooLarge:
+        :raises falcon.HTTPError: 408, the client took too long.
+        """
+        max_bytes = self._max_body_bytes
+        if req.content_length is not None and req.content_length > max_bytes:
+            self._metrics.inc("http.rejected.too_large")
+            raise falcon.HTTPPayloadTooLarge(description="The body may not exceed {} bytes.".format(max_bytes))
+
+        deadline = time.monotonic() + self._read_timeout
+        chunks, size = [], 0
+        stream = req.bounded_stream
+        try:
+            with cooperative_timeout(self._read_timeout):
+                while True:
+                    chunk = stream.read(min(READ_CHUNK_BYTES, max_bytes + 1 - size))
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        self._metrics.inc("http.rejected.too_large")
+                        raise falcon.HTTPPayloadTooLarge(description="The body may not exceed {} bytes.".format(max_bytes))
+                    if time.monotonic() > deadline:
+                        raise TimeoutError()
+                    chunks.append(chunk)
+        except TimeoutError:
+            self._metrics.inc("http.rejected.timeout")
+            raise falcon.HTTPError(falcon.HTTP_REQUEST_TIMEOUT, description="The body took too long to arrive.")
+        return b"".join(chunks)
+
+    @property
+    def protocol(self) -> ProtocolHandler:
+        return self._protocol
 
+    def on_get(self, req, resp):
         resp.content_type = falcon.MEDIA_HTML
+        resp.data = _INDEX_HTML
+
+
+def _client_address(req, header: str) -> str:
+    """The client address, or the last one in the given header, where a proxy in front of us appends it."""
+    if header:
+        value = req.get_header(header)
+        if value:
+            return value.rsplit(",", 1)[-1].strip()
+    return req.remote_addr
+
+
+def _charged_username(msg, session: Optional[ProtocolSession]) -> Optional[str]:
+    if isinstance(msg, AuthenticateRequest):
+        return msg.username
+    if isinstance(msg, AllocateResourceRequest) and session is not None:
+        return session.username
+    return None
+
+
+def _reject_if_waiting(wait: float):
+    """:raises falcon.HTTPTooManyRequests: wait is not 0."""
+    if wait:
+        raise falcon.HTTPTooManyRequests(description="Too many requests, slow down.", retry_after=math.ceil(wait))
+
+
+_INDEX_TEMPLATE = """
+<html>
+<head>
+    <title>Interstate Love Song</title>
+    <style>
+        body {{
+            font-family: sans-serif;
+            height: 100%;
+            background: lightgray;
+            color: gray;
+        }}
+        .container {{
+            height: 100%;
+            display: flex;
+            align-items: center;
+            justify-content: center;
+        }}
+        h1 {{
+            font-size: 2em;
+        }}
+        h2 {{
+            position: relative;
+            top: 1.5em;
+            right: 1em;
+        }}
+    </style>
+</head>
+<body>
+    <div class="container">
+        <h1>Interstate Love Song</h1>
+        <h2>
+            v{version}
+        </h2>
+    </div>
+</body>
+</html>
+"""
+
+# Rendered once, it never changes while we run.
+_INDEX_HTML = _INDEX_TEMPLATE.format(version=VERSION).encode("utf-8")
+
+
+class HealthResource:
+    """Liveness probe for load balancers. It does no work at all, if we can answer, we are alive."""
+
+    BODY = b"ok\n"
+
+    def on_get(self, req, resp):
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.data = HealthResource.BODY
+
+
+ReadinessCheck = Callable[[], bool]
+
+
+class ReadinessResource:
+    """Readiness probe for load balancers. Ready when all the registered checks pass, otherwise 503 with the names of
+    the failing checks.
+    """
+
+    BODY = b"ready\n"
+
+    def __init__(self, checks: Optional[Mapping[str, ReadinessCheck]] = None):
+        """
+        :param checks:
+            The checks by name, with none we are always ready.
+        :raises ValueError:
+            A check is not callable.
+        """
+        self._checks = {}
+        for name, check in (checks or {}).items():
+            self.add_check(name, check)
+
+    def add_check(self, name: str, check: ReadinessCheck):
+        """Registers a check, replacing any check with the same name.
+
+        :raises ValueError:
+            check is not callable.
+        """
+        if not callable(check):
+            raise ValueError("check must be callable.")
+        self._checks[name] = check
+
+    def on_get(self, req, resp):
+        resp.content_type = falcon.MEDIA_TEXT
+        failing = [name for name, check in self._checks.items() if not check()]
+        if failing:
+            resp.status = falcon.HTTP_SERVICE_UNAVAILABLE
+            resp.data = "not ready: {}\n".format(", ".join(failing)).encode("utf-8")
+        else:
+            resp.data = ReadinessResource.BODY
+
+
+class PathScopedMiddleware:
+    """Runs a middleware only for requests to the given paths. Falcon 2 middleware is always global, this keeps the
+    session middleware away from the probes, so a load balancer polling us doesn't create sessions.
+    """
+
+    def __init__(self, middleware, paths: Sequence[str]):
+        self._middleware = middleware
+        self._paths = frozenset(paths)
+
+    def process_request(self, req, resp):
+        if req.path in self._paths:
+            self._middleware.process_request(req, resp)
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        if req.path in self._paths:
+            self._middleware.process_response(req, resp, resource, req_succeeded)
+
+
+def _require_admin_token(req, token: str):
+    """Checks the "Authorization: Bearer <token>" header.
+
+    :raises falcon.HTTPUnauthorized:
+    """
+    header = req.get_header("Authorization", default="")
+    scheme, _, given = header.partition(" ")
+    if scheme.lower() != "bearer" or not hmac.compare_digest(given.strip().encode("utf-8"), token.encode("utf-8")):
+        raise falcon.HTTPUnauthorized(description="Admin token required.", challenges=["Bearer"])
+
+
+class ProfileResource:
+    """Admin endpoint that samples the stacks of this worker for a while and returns them collapsed, ready for
+    flamegraph.pl or speedscope. Only one profile may run per worker at a time.
+
+    Query parameters: "seconds" (default 10) and "interval_ms" (default 5).
+    """
+
+    def __init__(self, admin_token: str, max_seconds: float = 60.0):
+        """
+        :raises ValueError:
+            admin_token is empty.
+        """
+        if not admin_token:
+            raise ValueError("An admin token is required.")
+        self._admin_token = admin_token
+        self._max_seconds = max_seconds
+        self._lock = threading.Lock()
+
+    def on_get(self, req, resp):
+        _require_admin_token(req, self._admin_token)
+
+        seconds = req.get_param_as_float("seconds", min_value=0.1, max_value=self._max_seconds, default=10.0)
+        interval_ms = req.get_param_as_int("interval_ms", min_value=1, max_value=1000, default=int(DEFAULT_INTERVAL * 1000))
+
+        if not self._lock.acquire(blocking=False):
+            raise falcon.HTTPConflict(description="A profile is already running on this worker.")
+        try:
+            logger.info("Profiling for %ss at %sms intervals.", seconds, interval_ms)
+            resp.body = profile_for(seconds, interval_ms / 1000.0)
+        finally:
+            self._lock.release()
+
+        resp.content_type = falcon.MEDIA_TEXT
 
-        resp.body = data
+
+class MetricsResource:
+    """Admin endpoint that returns the metrics of the worker that serves the request, as JSON."""
+
+    def __init__(self, admin_token: str, metrics: Metrics = default_metrics):
+        """
+        :raises ValueError:
+            admin_token is empty.
+        """
+        if not admin_token:
+            raise ValueError("An admin token is required.")
+        self._admin_token = admin_token
+        self._metrics = metrics
+
+    def on_get(self, req, resp):
+        _require_admin_token(req, self._admin_token)
+        resp.media = {"pid": os.getpid(), "metrics": self._metrics.snapshot()}
 
 
 class FallbackSessionMiddleware(BeakerSessionMiddleware):
@@ -195,25 +482,25 @@ class FallbackSessionMiddleware(BeakerSessionMiddleware):
     use this instead to track the session.
 
     .. note::
-        The PCOIP-client sends a unique header for each session, we simply use this as our session ID.
+        The PCOIP-client sends a unique header for each session, we simply use this as our session ID. A request without
+        the header gets a regular cookie session.
     """
 
     HEADER_NAME = "CLIENT-LOG-ID"
 
     def process_request(self, request, *args):
-        session_id = request.headers.get(FallbackSessionMiddleware.HEADER_NAME, None)
-        session = SessionObject(request.env, id=session_id, **self.options)
-
-        request.env[self.environ_key] = session
+        key = request.get_header(FallbackSessionMiddleware.HEADER_NAME)
+        if not key:
+            return super().process_request(request, *args)
+        request.env[self.environ_key] = HeaderSession(key, self.options)
 
     def process_response(self, request, response, resource, request_succeded):
         session = request.env.get(self.environ_key, None)
-        session.persist()
-
-        if not session:
-            return
-
-        return super(FallbackSessionMiddleware, self).process_request(request, response, resource, request_succeded)
+        if isinstance(session, HeaderSession):
+            if request_succeded or self.cookie_on_exception:
+                session.persist()
+        elif session is not None:
+            super().process_response(request, response, resource, request_succeded)
 
 
 class CookieCaseFixedResponse(falcon.Response):
@@ -239,25 +526,55 @@ def get_falcon_api(
     broker_resource: BrokerResource,
     settings: Settings = Settings(),
     use_fallback_sessions: bool = False,
+    readiness_checks: Optional[Mapping[str, ReadinessCheck]] = None,
+    mapper: Optional[Mapper] = None,
 ) -> API:
-    logging.basicConfig(level=settings.logging.level.value)
+    """
+    :param readiness_checks:
+        Checks for /readyz, besides the mapper's.
+    :param mapper:
+        The mapper of the broker, /readyz fails while it isn't ready. Without one only readiness_checks are checked.
+    """
+    configure_logging(settings.logging.level.value)
 
     beaker_settings = {
         "session.type": settings.beaker.type,
         "session.cookie_expires": True,
-        "session.auto": True,  # We got to have this on as things are currently programmed.
+        # BeakerSessionSetter decides when to write, nothing is saved unless it asks for it.
+        "session.auto": False,
+        "session.save_accessed_time": False,
         "session.key": "JSESSIONID",
         "session.secure": True,
         "session.httponly": True,
         "session.data_dir": settings.beaker.data_dir,
+        "session.ttl": settings.beaker.ttl,
     }
+    if settings.beaker.type == "sqlite":
+        beaker_settings["session.namespace_class"] = SqliteNamespaceManager
+    elif settings.beaker.type == "file":
+        beaker_settings["session.namespace_class"] = ShardedFileNamespaceManager
     beaker_middleware = None
     if not use_fallback_sessions:
         beaker_middleware = BeakerSessionMiddleware(beaker_settings)
     else:
         beaker_middleware = FallbackSessionMiddleware(beaker_settings)
 
-    api = API(middleware=beaker_middleware, response_type=CookieCaseFixedResponse)
-    api.add_route("/pcoip-broker/xml", resource=broker_resource)
+    api = API(
+        middleware=PathScopedMiddleware(beaker_middleware, [BROKER_PATH]),
+        response_type=CookieCaseFixedResponse,
+    )
+    api.add_route(BROKER_PATH, resource=broker_resource)
+
+    checks = {}
+    if mapper is not None:
+        checks["mapper"] = lambda: mapper.ready
+    checks.update(readiness_checks or {})
+    readiness = ReadinessResource(checks)
+    api.add_route("/healthz", resource=HealthResource())
+    api.add_route("/readyz", resource=readiness)
+
+    if settings.admin.token:
+        api.add_route("/admin/profile", resource=ProfileResource(settings.admin.token, settings.admin.max_profile_seconds))
+        api.add_route("/admin/metrics", resource=MetricsResource(settings.admin.token))
 
     return api
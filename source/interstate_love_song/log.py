@@ -0,0 +1,96 @@
+import atexit
+import copy
+import logging
+import os
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+from .compat import unpatched
+
+_listener: Optional[QueueListener] = None
+
+
+class _OSThreadQueueListener(QueueListener):
+    """A QueueListener that runs on a real OS thread, even on a monkey patched gevent worker. On a greenlet, writing a
+    record to a slow file or syslog socket would still stall the hub and with it every request.
+    """
+
+    def start(self):
+        self._done = unpatched("_thread", "allocate_lock")()
+        self._done.acquire()
+
+        def run():
+            try:
+                self._monitor()
+            finally:
+                self._done.release()
+
+        unpatched("_thread", "start_new_thread")(run, ())
+
+    def stop(self):
+        self.enqueue_sentinel()
+        self._done.acquire()
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """A QueueHandler that leaves the formatting to the handlers of the listener. QueueHandler formats the record, and
+    merges its arguments into the message, before it enqueues it, that is on the request greenlet; the queue never
+    leaves the process, so the record needn't be made picklable.
+
+    An argument is formatted once the listener gets to the record: one changed after the call logs as it is then.
+    """
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # A copy, the handlers after this one in the chain get the record as it was.
+        return copy.copy(record)
+
+
+def configure_logging(level):
+    """Like logging.basicConfig, except the root logger only puts records on a queue and a background thread does the
+    formatting for output and the I/O, so the request greenlet never blocks on logging.
+
+    Like basicConfig it leaves the handlers alone if the root logger already has some; the level is always set. Calling
+    it again only changes the level.
+    """
+    root = logging.getLogger()
+    root.setLevel(level)
+    if _listener is not None or root.handlers:
+        return
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+
+    queue_handler = _DeferredQueueHandler(None)
+    _start_listener(queue_handler, handler)
+    root.addHandler(queue_handler)
+
+
+def _start_listener(queue_handler: QueueHandler, *handlers: logging.Handler):
+    global _listener
+
+    # The unpatched SimpleQueue uses real locks, so put never yields and the listener thread can block on get.
+    queue_handler.queue = unpatched("queue", "SimpleQueue")()
+    _listener = _OSThreadQueueListener(queue_handler.queue, *handlers)
+    _listener.queue_handler = queue_handler
+    _listener.start()
+
+
+def _restart_listener_after_fork():
+    # Threads don't survive a fork, gunicorn workers need a listener of their own.
+    if _listener is not None:
+        _start_listener(_listener.queue_handler, *_listener.handlers)
+
+
+def stop_logging():
+    """Flushes the queued records and stops the background thread, if configure_logging started one."""
+    global _listener
+
+    if _listener is None:
+        return
+    _listener.stop()
+    logging.getLogger().removeHandler(_listener.queue_handler)
+    _listener = None
+
+
+atexit.register(stop_logging)
+os.register_at_fork(after_in_child=_restart_listener_after_fork)
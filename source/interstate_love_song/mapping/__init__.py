@@ -1 +1 @@
-from .base import MapperResult, MapperStatus, Mapper, Credentials, Resource
+from .base import MapperResult, MapperStatus, Mapper, Credentials, Resource, prefer_host
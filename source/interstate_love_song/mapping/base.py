@@ -1,7 +1,8 @@
+import asyncio
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from enum import Enum
-from typing import Tuple, Optional, Sequence, Any, Mapping
+from typing import Tuple, Optional, Sequence, Any, Mapping, List
 from ..agent import allocate_session
 
 Credentials = Tuple[str, str]
@@ -17,15 +18,26 @@ class MapperStatus(Enum):
 
 @dataclass
 class Resource:
-    """Represents a Resource (a Teradici "machine") that the user may connect to."""
+    """Represents a Resource (a Teradici "machine") that the user may connect to. A pooled resource may also be allocated
+    on one of its candidates, other hosts tried in order after hostname, each once the one before has failed or been
+    slower than the hedge delay of the protocol handler.
+    """
 
     name: str
     hostname: str
+    candidates: Sequence[str] = ()
 
 
 MapperResult = Tuple[MapperStatus, Mapping[str, Resource]]
 
 
+def prefer_host(resources: Sequence[Resource], previous_host: Optional[str]) -> List[Resource]:
+    """The resources with those on previous_host first, otherwise in the same order."""
+    if not previous_host:
+        return list(resources)
+    return sorted(resources, key=lambda resource: resource.hostname != previous_host)
+
+
 class Mapper(ABC):
     """A mapper specifies the strategy to use when assigning hosts/machines/resources to a particular user."""
 
@@ -46,6 +58,13 @@ class Mapper(ABC):
         """
         pass
 
+    async def map_async(self, credentials: Credentials, previous_host: Optional[str] = None) -> MapperResult:
+        """map for the AsyncBrokerProtocolHandler. By default map, run in the default executor of the event loop; mappers
+        that can wait without a thread override it.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.map, credentials, previous_host)
+
     def allocate_session(self, *args, **kwargs):
         """This adds the ability for plugin mappers to intercept the call to `agent.allocate_session`"""
         return allocate_session(*args, **kwargs)
@@ -62,6 +81,16 @@ class Mapper(ABC):
         """The name of this mapper."""
         pass
 
+    @property
+    def hostnames(self) -> Sequence[str]:
+        """The hostnames of all the resources the mapper may return, if it can list them. They are resolved at startup."""
+        return ()
+
+    @property
+    def ready(self) -> bool:
+        """Whether the mapper can map users, e.g. its data has loaded. Reported by the readiness probe."""
+        return True
+
     @classmethod
     def create_from_dict(cls, data: Mapping[str, Any]):
         """Create a new instance from settings"""
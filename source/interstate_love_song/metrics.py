@@ -0,0 +1,38 @@
+from typing import Dict, Union
+
+from .compat import unpatched
+
+Number = Union[int, float]
+
+
+class Metrics:
+    """Counters and gauges of this process, by dotted name. Each gunicorn worker has its own.
+
+    Updates take a real lock for a few instructions, so they are safe from greenlets and OS threads alike.
+    """
+
+    def __init__(self):
+        self._lock = unpatched("_thread", "allocate_lock")()
+        self._values: Dict[str, Number] = {}
+
+    def inc(self, name: str, value: Number = 1):
+        """Adds value to a counter, counters start at 0."""
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + value
+
+    def set(self, name: str, value: Number):
+        """Sets a gauge."""
+        with self._lock:
+            self._values[name] = value
+
+    def get(self, name: str, default: Number = 0) -> Number:
+        with self._lock:
+            return self._values.get(name, default)
+
+    def snapshot(self) -> Dict[str, Number]:
+        """A copy of all the values, sorted by name."""
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+
+metrics = Metrics()
@@ -23,10 +23,12 @@ class PluginError(Exception):
 
 def get_builtin_plugin_modules():
     """Get builtin plugins from this module"""
-    from . import simple
+    from . import simple, userfile, pool
 
     return {
         "SIMPLE": simple,
+        "USERFILE": userfile,
+        "POOL": pool,
     }
 
 
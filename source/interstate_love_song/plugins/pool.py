@@ -0,0 +1,167 @@
+import logging
+import random
+from dataclasses import dataclass
+from typing import Mapping, Any, Dict, List
+
+from interstate_love_song.agent import AllocateSessionStatus
+from interstate_love_song.mapping.base import *
+from interstate_love_song.shared import DecayingCounters, SharedTableError
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PoolMapperSettings:
+    mapper: dict
+    pools: dict
+    half_life: float = 3600.0
+    slots: int = 4096
+    fan_out: int = 2
+
+
+class PoolMapper(Mapper):
+    """Wraps another mapper, which authenticates the users and gives them their resources, and hands out pooled hosts:
+    a resource whose hostname is the name of a pool is given the least loaded host of the pool.
+
+    The load of a host is the number of sessions the broker allocated on it, halving every half_life seconds, as an
+    estimate of the sessions still open. The counts are shared by the workers if the mapper is created before the server
+    forks. Hosts less than a session apart count as equally loaded, one of them is picked at random, so a burst of logins
+    is spread over them rather than all sent to the same one. A user whose previous host is in the pool gets it back.
+
+    The next least loaded hosts, up to fan_out hosts in all, are the candidates of the resource: the broker tries the
+    next when a host fails or is slow to answer, and takes the first that allocates a session, so one slow or dead host
+    doesn't keep the user waiting.
+    """
+
+    def __init__(
+        self,
+        mapper: Mapper,
+        pools: Mapping[str, Sequence[str]],
+        half_life: float = 3600.0,
+        slots: int = 4096,
+        fan_out: int = 2,
+    ):
+        """
+        :param mapper:
+            The mapper that authenticates the users.
+        :param pools:
+            The hostnames of each pool, by pool name.
+        :param half_life:
+            Seconds for the load of a host to halve.
+        :param slots:
+            The number of hosts whose load is tracked.
+        :param fan_out:
+            The hosts of a pool that allocating a resource may try, the next when one fails or is slow.
+        :raises ValueError:
+            A pool is empty or not a list of hostnames, or half_life, slots or fan_out is not positive.
+        """
+        super().__init__()
+        if not isinstance(mapper, Mapper):
+            raise ValueError("Expected a Mapper instance.")
+        for name, hosts in pools.items():
+            if isinstance(hosts, str) or not hosts or not all(isinstance(host, str) for host in hosts):
+                raise ValueError("Pool {} must be a non-empty list of hostnames.".format(name))
+        if fan_out <= 0:
+            raise ValueError("fan_out must be positive.")
+        self._mapper = mapper
+        self._fan_out = fan_out
+        self._pools: Dict[str, List[str]] = dict((str(name), list(hosts)) for name, hosts in pools.items())
+        self._load = DecayingCounters(slots, half_life)
+
+    @property
+    def mapper(self) -> Mapper:
+        return self._mapper
+
+    @property
+    def pools(self) -> Mapping[str, Sequence[str]]:
+        return self._pools
+
+    def load(self, hostnames: Sequence[str]) -> List[float]:
+        """The load of each host."""
+        try:
+            return self._load.get_many(hostnames)
+        except SharedTableError as e:
+            logger.error("Failed to read the load of the hosts: %s", e)
+            return [0.0] * len(hostnames)
+
+    def ranked(self, pool: str) -> List[str]:
+        """The hosts of the pool, least loaded first.
+
+        :raises KeyError: There is no such pool.
+        """
+        hosts = self._pools[pool]
+        loads = self.load(hosts)
+        lightest = min(loads)
+        order = list(range(len(hosts)))
+        random.shuffle(order)
+        order.sort(key=lambda i: 0.0 if loads[i] < lightest + 1.0 else loads[i])
+        return [hosts[i] for i in order]
+
+    def least_loaded(self, pool: str) -> str:
+        """A least loaded host of the pool.
+
+        :raises KeyError: There is no such pool.
+        """
+        return self.ranked(pool)[0]
+
+    def _assign(self, resource: Resource, previous_host: Optional[str]) -> Resource:
+        if resource.hostname not in self._pools:
+            return resource
+        hosts = self.ranked(resource.hostname)
+        if previous_host in hosts:
+            hosts.remove(previous_host)
+            hosts.insert(0, previous_host)
+        return Resource(resource.name, hosts[0], tuple(hosts[1 : self._fan_out]))
+
+    def map(self, credentials: Credentials, previous_host: Optional[str] = None) -> MapperResult:
+        status, resources = self._mapper.map(credentials, previous_host)
+        if status != MapperStatus.SUCCESS:
+            return status, resources
+        return status, dict((key, self._assign(resource, previous_host)) for key, resource in resources.items())
+
+    def allocate_session(self, resource_id, agent_hostname, *args, **kwargs):
+        status, agent_session = self._mapper.allocate_session(resource_id, agent_hostname, *args, **kwargs)
+        if status == AllocateSessionStatus.SUCCESSFUL:
+            try:
+                self._load.add(agent_hostname)
+            except SharedTableError as e:
+                logger.error("Failed to count a session on %s: %s", agent_hostname, e)
+        return status, agent_session
+
+    @property
+    def hostnames(self) -> Sequence[str]:
+        hostnames = []
+        for hostname in self._mapper.hostnames:
+            hostnames.extend(self._pools.get(hostname, [hostname]))
+        for hosts in self._pools.values():
+            hostnames.extend(hosts)
+        return list(dict.fromkeys(hostnames))
+
+    @property
+    def ready(self) -> bool:
+        return self._mapper.ready
+
+    @property
+    def domains(self):
+        return self._mapper.domains
+
+    @property
+    def name(self):
+        return "PoolMapper"
+
+    @classmethod
+    def create_from_dict(cls, data: Mapping[str, Any]):
+        from interstate_love_song.plugins import create_plugin_from_settings
+        from interstate_love_song.settings import load_dict_into_dataclass, SettingsError
+
+        settings = load_dict_into_dataclass(PoolMapperSettings, data)
+        try:
+            return cls(
+                create_plugin_from_settings(settings.mapper),
+                settings.pools,
+                settings.half_life,
+                settings.slots,
+                settings.fan_out,
+            )
+        except ValueError as e:
+            raise SettingsError(str(e))
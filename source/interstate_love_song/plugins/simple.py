@@ -63,6 +63,10 @@ class SimpleMapper(Mapper):
     def resources(self) -> Sequence[Resource]:
         return self._resources
 
+    @property
+    def hostnames(self) -> Sequence[str]:
+        return [resource.hostname for resource in self._resources]
+
     def map(self, credentials: Credentials, previous_host: Optional[str] = None) -> MapperResult:
         usr, psw = credentials
         if not isinstance(usr, str) or not isinstance(psw, str):
@@ -72,7 +76,7 @@ class SimpleMapper(Mapper):
             if self._resources:
                 return (
                     MapperStatus.SUCCESS,
-                    dict((str(k), v) for k, v in enumerate(self.resources)),
+                    dict((str(k), v) for k, v in enumerate(prefer_host(self.resources, previous_host))),
                 )
             else:
                 return MapperStatus.NO_MACHINE, {}
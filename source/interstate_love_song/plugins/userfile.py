@@ -0,0 +1,252 @@
+import argparse
+import dataclasses
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from typing import Mapping, Any, Dict, List, Tuple
+
+from interstate_love_song.compat import spawn
+from interstate_love_song.mapping.base import *
+from interstate_love_song.plugins.simple import hash_pass
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class FileMapperSettings:
+    path: str
+    domains: Sequence[str] = dataclasses.field(default_factory=lambda: [])
+    reload_interval: float = 5.0
+
+
+@dataclass
+class _User:
+    salt: str
+    password_hash: str
+    resources: Dict[str, Resource]
+
+
+def _load_resources(items) -> List[Resource]:
+    from interstate_love_song.settings import load_dict_into_dataclass
+
+    return [load_dict_into_dataclass(Resource, item) for item in items]
+
+
+def load_user_table(
+    data: Mapping[str, Any], previous: Optional[Tuple[Mapping[str, Any], Dict[str, _User]]] = None
+) -> Dict[str, _User]:
+    """Builds the user table from the parsed user file, see FileMapper for the format. Each user gets the resources of
+    their groups, then their own, without duplicates, already in the form map returns.
+
+    :param previous:
+        The parsed user file and the table of the last load, if any. A user whose entry and groups are the same in both
+        files keeps their entry of the previous table, only the others are built again.
+    :raises SettingsError: The data is malformed.
+    """
+    from interstate_love_song.settings import SettingsError
+
+    previous_data, previous_table = previous or ({}, {})
+    try:
+        raw_groups, previous_groups = data.get("groups", {}), previous_data.get("groups", {})
+        changed_groups = set(
+            name for name in set(raw_groups) | set(previous_groups) if raw_groups.get(name) != previous_groups.get(name)
+        )
+        # The changed groups are checked even when no user is in them, the others are loaded when a user needs them.
+        groups = dict(
+            (name, _load_resources(raw_groups[name].get("resources", []))) for name in changed_groups & set(raw_groups)
+        )
+        previous_users = previous_data.get("users", {})
+        table = {}
+        for username, user in data["users"].items():
+            kept = previous_table.get(username)
+            if kept is not None and previous_users.get(username) == user and changed_groups.isdisjoint(user.get("groups", [])):
+                table[username] = kept
+                continue
+            resources = []
+            for group in user.get("groups", []):
+                if group not in groups:
+                    groups[group] = _load_resources(raw_groups[group].get("resources", []))
+                resources.extend(groups[group])
+            resources.extend(_load_resources(user.get("resources", [])))
+            unique = list(dict.fromkeys((r.name, r.hostname) for r in resources))
+            table[username] = _User(
+                str(user["salt"]),
+                str(user["password_hash"]),
+                dict((str(k), Resource(name, hostname)) for k, (name, hostname) in enumerate(unique)),
+            )
+        return table
+    except KeyError as e:
+        raise SettingsError("Missing {} in the user file.".format(e))
+    except (AttributeError, TypeError) as e:
+        raise SettingsError("Malformed user file: {}".format(e))
+
+
+class FileMapper(Mapper):
+    """Maps many users, each with their own salted password hash and resources, read from a JSON file:
+
+        {
+            "groups": {"<group>": {"resources": [{"name": ?, "hostname": ?}, ...]}, ...},
+            "users": {"<username>": {"salt": ?, "password_hash": ?, "groups": [?], "resources": [?]}, ...}
+        }
+
+    The file is indexed in memory by username. It is checked for changes at most every reload_interval seconds, when
+    map is called, and reloaded if its modification time or size changed. The check and the reload run in the
+    background, the call goes on with the users we have: only the users whose entry or groups changed are built again,
+    and the new table replaces the old one at once. A file that fails to load leaves the users we have in place. Until
+    a file has loaded there is nothing to serve, and map waits for the load.
+
+    An unknown username is rejected without hashing the password, but only after waiting as long as checking a
+    password takes, so the response time doesn't tell which usernames exist.
+    """
+
+    def __init__(self, path: str, domains: Sequence[str], reload_interval: float = 5.0):
+        """
+        :param path:
+            The user file.
+        :param domains:
+            A list of valid domains.
+        :param reload_interval:
+            Seconds between checks for a changed file.
+        """
+        super().__init__()
+        self._path = str(path)
+        self._domains = list(domains)
+        self._reload_interval = reload_interval
+        self._users: Optional[Dict[str, _User]] = None
+        # The parsed file the users were built from, to tell which changed on the next load.
+        self._data: Mapping[str, Any] = {}
+        self._stamp = None
+        self._next_check = 0.0
+        # Held by the load in progress, there is only ever one.
+        self._reload_lock = threading.Lock()
+        self._hash_seconds = self._time_hash()
+        with self._reload_lock:
+            self._reload()
+
+    @staticmethod
+    def _time_hash() -> float:
+        start = time.perf_counter()
+        hash_pass("", "")
+        return time.perf_counter() - start
+
+    def _reload(self):
+        self._next_check = time.monotonic() + self._reload_interval
+        try:
+            stat = os.stat(self._path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+            if stamp == self._stamp:
+                return
+            with open(self._path, "r") as f:
+                data = json.load(f)
+            users = load_user_table(data, (self._data, self._users or {}))
+        except Exception as e:
+            logger.error("Failed to load the user file %s: %s", self._path, e)
+            return
+        # A single assignment, requests on other greenlets or threads see either the old table or the new one.
+        self._users = users
+        self._data = data
+        self._stamp = stamp
+        logger.info("Loaded %s users from %s.", len(users), self._path)
+
+    def _reload_in_background(self):
+        try:
+            self._reload()
+        finally:
+            self._reload_lock.release()
+
+    @property
+    def ready(self) -> bool:
+        return self._users is not None
+
+    @property
+    def users(self) -> int:
+        """The number of users loaded."""
+        return len(self._users or ())
+
+    @property
+    def hostnames(self) -> Sequence[str]:
+        users = self._users or {}
+        return list(dict.fromkeys(r.hostname for user in users.values() for r in user.resources.values()))
+
+    def map(self, credentials: Credentials, previous_host: Optional[str] = None) -> MapperResult:
+        usr, psw = credentials
+        if not isinstance(usr, str) or not isinstance(psw, str):
+            raise ValueError("username and password must be strings.")
+
+        if time.monotonic() >= self._next_check:
+            if self._users is None:
+                with self._reload_lock:
+                    self._reload()
+            elif self._reload_lock.acquire(blocking=False):
+                spawn(self._reload_in_background)
+        if self._users is None:
+            return MapperStatus.INTERNAL_ERROR, {}
+
+        user = self._users.get(usr)
+        if user is None:
+            time.sleep(self._hash_seconds)
+            return MapperStatus.AUTHENTICATION_FAILED, {}
+
+        start = time.perf_counter()
+        authenticated = hmac.compare_digest(hash_pass(psw, user.salt), user.password_hash)
+        # Follow the actual cost, it changes with the load on the host.
+        self._hash_seconds = 0.8 * self._hash_seconds + 0.2 * (time.perf_counter() - start)
+
+        if not authenticated:
+            return MapperStatus.AUTHENTICATION_FAILED, {}
+        if not user.resources:
+            return MapperStatus.NO_MACHINE, {}
+        if previous_host:
+            return MapperStatus.SUCCESS, dict(
+                (str(k), v) for k, v in enumerate(prefer_host(user.resources.values(), previous_host))
+            )
+        return MapperStatus.SUCCESS, dict(user.resources)
+
+    @property
+    def domains(self):
+        return self._domains
+
+    @property
+    def name(self):
+        return "FileMapper"
+
+    @classmethod
+    def create_from_dict(cls, data: Mapping[str, Any]):
+        from interstate_love_song.settings import load_dict_into_dataclass
+
+        settings = load_dict_into_dataclass(FileMapperSettings, data)
+        return cls(settings.path, settings.domains, settings.reload_interval)
+
+
+def set_user(data: Mapping[str, Any], username: str, password: str, groups: Sequence[str] = ()):
+    """Adds or replaces a user in the parsed user file, with a new random salt. Their own resources are kept."""
+    salt = secrets.token_hex(16)
+    user = data.setdefault("users", {}).setdefault(username, {})
+    user.update({"salt": salt, "password_hash": hash_pass(password, salt), "groups": list(groups)})
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser("userfile")
+    parser.add_argument("USERFILE")
+    parser.add_argument("USERNAME")
+    parser.add_argument("PASSWORD")
+    parser.add_argument("--group", action="append", default=[], help="may be given more than once")
+
+    args = parser.parse_args()
+
+    data = {"groups": {}, "users": {}}
+    if os.path.exists(args.USERFILE):
+        with open(args.USERFILE, "r") as f:
+            data = json.load(f)
+    set_user(data, args.USERNAME, args.PASSWORD, args.group)
+
+    # Replace the file in one step, a running FileMapper must never read half of it.
+    tmp = "{}.tmp".format(args.USERFILE)
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp, args.USERFILE)
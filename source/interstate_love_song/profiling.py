@@ -0,0 +1,132 @@
+import atexit
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from typing import Callable
+
+from .compat import unpatched
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 0.005
+
+
+def _frame_label(frame) -> str:
+    code = frame.f_code
+    return "{} ({}:{})".format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
+
+
+class StackSampler:
+    """Periodically samples the Python stacks of every thread in the process and aggregates them as collapsed stacks,
+    the input format of flamegraph.pl and speedscope.
+
+    On a gevent worker all greenlets share the main thread, so every sample is the greenlet that was running at that
+    moment, or the hub when the worker is idle.
+    """
+
+    def __init__(self, interval: float = DEFAULT_INTERVAL):
+        """
+        :param interval:
+            Seconds between samples.
+        :raises ValueError:
+            interval is not positive.
+        """
+        if interval <= 0:
+            raise ValueError("interval must be positive.")
+        self._interval = interval
+        # The sampler has to run on a real OS thread, a greenlet would only get to run when the request greenlets
+        # yield, and then there is nothing interesting left to sample.
+        self._start_new_thread = unpatched("_thread", "start_new_thread")
+        self._get_ident = unpatched("_thread", "get_ident")
+        self._sleep = unpatched("time", "sleep")
+        self._lock = unpatched("_thread", "allocate_lock")()
+        self._stacks = Counter()
+        self._samples = 0
+        self._running = False
+        self._thread_id = None
+
+    @property
+    def running(self) -> bool:
+        return self._running
+
+    @property
+    def samples(self) -> int:
+        return self._samples
+
+    def start(self):
+        """Starts sampling on a new OS thread.
+
+        :raises RuntimeError:
+            The sampler is already running.
+        """
+        if self._running:
+            raise RuntimeError("The sampler is already running.")
+        self._running = True
+        self._start_new_thread(self._run, ())
+
+    def stop(self):
+        """Asks the sampling thread to stop. It finishes at most one interval later; it does not wait for that, since
+        blocking the calling greenlet on an OS thread would stall the whole gevent hub.
+        """
+        self._running = False
+
+    def _run(self):
+        self._thread_id = self._get_ident()
+        while self._running:
+            self._sample()
+            self._sleep(self._interval)
+
+    def _sample(self):
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == self._thread_id:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                frame = frame.f_back
+            stack = ";".join(reversed(labels))
+            with self._lock:
+                self._stacks[stack] += 1
+        with self._lock:
+            self._samples += 1
+
+    def collapsed(self) -> str:
+        """The stacks so far, one "frame;frame;frame count" line per unique stack, most frequent first."""
+        with self._lock:
+            items = self._stacks.most_common()
+        return "".join("{} {}\n".format(stack, count) for stack, count in items)
+
+
+def profile_for(seconds: float, interval: float = DEFAULT_INTERVAL) -> str:
+    """Samples the process for the given time and returns the collapsed stacks. The caller waits with time.sleep, which
+    is cooperative on a monkey patched gevent worker, so other requests keep being served (and sampled) meanwhile.
+    """
+    sampler = StackSampler(interval)
+    sampler.start()
+    try:
+        time.sleep(seconds)
+    finally:
+        sampler.stop()
+    logger.info("Profiled for %ss, %s samples.", seconds, sampler.samples)
+    return sampler.collapsed()
+
+
+def profile_until_exit(path: str, interval: float = DEFAULT_INTERVAL) -> Callable[[], None]:
+    """Starts sampling this process and returns a function that stops and writes the collapsed stacks to path. The
+    function is also registered with atexit, calling it more than once only writes the first time.
+    """
+    sampler = StackSampler(interval)
+    sampler.start()
+
+    def write():
+        if not sampler.running:
+            return
+        sampler.stop()
+        with open(path, "w") as f:
+            f.write(sampler.collapsed())
+        logger.info("Wrote %s profile samples to %s.", sampler.samples, path)
+
+    atexit.register(write)
+    return write
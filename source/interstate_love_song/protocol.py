@@ -1,12 +1,23 @@
+import asyncio
+import inspect
+import queue
+import secrets
 import socket
 import logging
+import threading
+from abc import ABC, abstractmethod
+from collections import deque
 from dataclasses import dataclass, field
 from enum import Enum
+from functools import lru_cache
 from typing import Mapping, Sequence, Tuple, Optional, Callable
 
 from interstate_love_song import agent
+from interstate_love_song.affinity import HostAffinity
 from interstate_love_song.agent import AllocateSessionStatus
+from interstate_love_song.compat import spawn
 from interstate_love_song.mapping import Mapper, Resource, MapperStatus
+from interstate_love_song.metrics import Metrics, metrics as default_metrics
 from interstate_love_song.transport import (
     Message,
     HelloRequest,
@@ -48,67 +59,59 @@ class ProtocolSession:
     domain: Optional[str] = None
     state: ProtocolState = ProtocolState.WAITING_FOR_HELLO
     resources: Mapping[str, Resource] = field(default_factory=lambda: {})
+    # Tells apart the logins of a user, set on the hello.
+    session_id: Optional[str] = None
 
 
 ProtocolAction = Tuple[Optional[ProtocolSession], Optional[Message]]
 ProtocolHandler = Callable[[Message, Optional[ProtocolSession]], ProtocolAction]
 
 
+@lru_cache(maxsize=None)
+def _broker_hostname() -> str:
+    """The hostname doesn't change while we run, and asking the OS for it on every hello is a syscall wasted."""
+    return socket.gethostname()
+
+
 def _assert_session_exist(s: Optional[ProtocolSession]):
     if s is None:
         raise ValueError("session was expected to be non-None. This is a bug.")
 
 
-class BrokerProtocolHandler:
-    """Implements the logical level of the broker protocol. It is implemented as a state machine where state
-    transitions happen based on the values of the message and the broker session.
-
-    This means that the handler is completely stateless in itself, it only depends on inputs and is almost deterministic,
-    the exceptions are:
-        - when asked to allocate a resource, since it depends upon the answer from the Teradici resource.
-        - the mapper may not be deterministic.
+class _BrokerProtocolMachine(ABC):
+    """The state machine of the broker protocol, without the calls to the mapper and the agents, which the sync and async
+    handlers make each their own way. Both go through the same states and give the same responses.
     """
 
-    def __init__(self, mapper: Mapper, allocate_session=agent.allocate_session):
+    def __init__(
+        self,
+        mapper: Mapper,
+        allocate_session: Callable,
+        affinity: Optional[HostAffinity] = None,
+        metrics: Metrics = default_metrics,
+        hedge_delay: float = 2.0,
+    ):
         """
         :param mapper:
             A mapper to use for authentication and resource assignment.
+        :param affinity:
+            Remembers the host each user was allocated, which is then passed to the mapper as their previous host.
+        :param hedge_delay:
+            Seconds to wait for a host of a pooled resource before also trying the next one.
         :raises ValueError:
         """
         if not isinstance(mapper, Mapper):
             raise ValueError("Expected a Mapper instance.")
         if not callable(allocate_session):
             raise ValueError("Expected allocate_session to be a callable.")
+        if hedge_delay < 0:
+            raise ValueError("hedge_delay must not be negative.")
         self._mapper = mapper
         self._allocate_session = allocate_session
-
-    @property
-    def mapper(self) -> Mapper:
-        return self._mapper
-
-    def __call__(self, msg: Message, session: Optional[ProtocolSession]) -> ProtocolAction:
-        """Handles the message and returns the new state, session data and the response.
-
-        :param msg:
-            The message to handle.
-        :param session:
-            A slot that allows the protocol handler to register and read the session.
-
-        :return: An optional session data and a response message. If a session is active but this returns
-            None as the current session data, the session should be removed from store.
-        """
-        if not isinstance(msg, Message):
-            raise ValueError("msg must inherit from Message.")
-        if session is not None and not isinstance(session, ProtocolSession):
-            raise ValueError("session must be either None or ProtocolSession.")
-
-        msg_type = type(msg)
-
-        # treat bye as a general abort
-        if msg_type is ByeRequest:
-            return None, ByeResponse()
-
-        routing_table = {
+        self._affinity = affinity
+        self._metrics = metrics
+        self._hedge_delay = hedge_delay
+        self._routing_table = {
             ProtocolState.WAITING_FOR_HELLO: (HelloRequest, self._hello),
             ProtocolState.WAITING_FOR_AUTHENTICATE: (
                 AuthenticateRequest,
@@ -122,23 +125,42 @@ class BrokerProtocolHandler:
                 AllocateResourceRequest,
                 self._allocate_resource,
             ),
+            # Bye is handled in any state, anything else is unexpected.
+            ProtocolState.WAITING_FOR_BYE: (ByeRequest, None),
         }
 
+    @property
+    def mapper(self) -> Mapper:
+        return self._mapper
+
+    def _route(self, msg: Message, session: Optional[ProtocolSession]) -> Tuple[Optional[Callable], ProtocolAction]:
+        """The handler for the message in the state of the session, or None and the action to take right away."""
+        if not isinstance(msg, Message):
+            raise ValueError("msg must inherit from Message.")
+        if session is not None and not isinstance(session, ProtocolSession):
+            raise ValueError("session must be either None or ProtocolSession.")
+
+        msg_type = type(msg)
+
+        # treat bye as a general abort
+        if msg_type is ByeRequest:
+            return None, (None, ByeResponse())
+
         state = ProtocolState.WAITING_FOR_HELLO if session is None else session.state
 
-        assert state in routing_table  # check that we have implemented this state.
-        accepted_msg, handler = routing_table[state]
+        assert state in self._routing_table  # check that we have implemented this state.
+        accepted_msg, handler = self._routing_table[state]
 
         if msg_type is accepted_msg:
-            return handler(msg, session)
+            return handler, (None, None)
         else:
             logger.info(
                 "Got an unexpected message (%s) for this state (%s), expected %s",
-                str(msg_type),
-                str(state),
-                str(accepted_msg),
+                msg_type,
+                state,
+                accepted_msg,
             )
-            return None, None
+            return None, (None, None)
 
     def _hello(self, msg: HelloRequest, session: Optional[ProtocolSession]) -> ProtocolAction:
         """We may get two hello messages in this situation.
@@ -146,27 +168,33 @@ class BrokerProtocolHandler:
           directly with a machine or a broker.
         - A hello with the clients real product name, that's when we want our session to start.
         """
-        hostname = socket.gethostname()
-        response = HelloResponse(hostname, domains=self.mapper.domains)
+        response = HelloResponse(_broker_hostname(), domains=self.mapper.domains)
         # The PCOIP-client sends a hello with this as the product name to check if we are connecting to a broker
         # or to a machine. We want to stay in the WAITING_FOR_HELLO state in those cases.
         if msg.client_product_name == "QueryBrokerClient":
             return None, response
         else:
             return (
-                ProtocolSession(state=ProtocolState.WAITING_FOR_AUTHENTICATE),
+                ProtocolSession(state=ProtocolState.WAITING_FOR_AUTHENTICATE, session_id=secrets.token_hex(16)),
                 response,
             )
 
-    def _authenticate(self, msg: AuthenticateRequest, session: Optional[ProtocolSession]) -> ProtocolAction:
-        """We only expect authenticate messages here. When we get one, we ask the mapper to authenticate and return
-        the assigned resources.
+    @abstractmethod
+    def _authenticate(self, msg: AuthenticateRequest, session: Optional[ProtocolSession]):
+        pass
 
-        If authentication fails, the PCOIP client may try again, so this may transition back to itself.
-        """
+    @abstractmethod
+    def _allocate_resource(self, msg: AllocateResourceRequest, session: Optional[ProtocolSession]):
+        pass
+
+    def _previous_host(self, msg: AuthenticateRequest, session: Optional[ProtocolSession]) -> Optional[str]:
         _assert_session_exist(session)
+        return self._affinity.recall(msg.username) if self._affinity is not None else None
 
-        mapper_status, resources = self.mapper.map((msg.username, msg.password))
+    def _authenticated(
+        self, msg: AuthenticateRequest, session: ProtocolSession, mapper_status: MapperStatus, resources
+    ) -> ProtocolAction:
+        """If authentication fails, the PCOIP client may try again, so this may transition back to itself."""
         if mapper_status == MapperStatus.SUCCESS:
             session.username = msg.username
             session.password = msg.password
@@ -195,23 +223,48 @@ class BrokerProtocolHandler:
             ),
         )
 
-    def _allocate_resource(self, msg: AllocateResourceRequest, session: Optional[ProtocolSession]) -> ProtocolAction:
-        """The client should now ask us to allocate a session on a chosen machine. So we need to communicate with the
-        machine and obtain a session.
-        """
+    def _resource(self, msg: AllocateResourceRequest, session: Optional[ProtocolSession]) -> Resource:
         _assert_session_exist(session)
+        return session.resources[msg.resource_id]
 
-        hostname = session.resources[msg.resource_id].hostname
-        status, agent_session = self._allocate_session(
-            msg.resource_id,
+    def _allocate_on(self, resource_id: str, hostname: str, session: ProtocolSession):
+        """Calls allocate_session for the user of the session on hostname, and returns what it does."""
+        return self._allocate_session(
+            resource_id,
             hostname,
             session.username,
             session.password,
             session.domain,
+            client_session_id=session.session_id,
         )
 
+    def _hostnames(self, resource: Resource, session: ProtocolSession) -> Sequence[str]:
+        """The hosts to try for the resource, its own first, and last one that holds a session the user wasn't handed."""
+        hostnames = [resource.hostname] + [host for host in resource.candidates if host != resource.hostname]
+        stranded = self._affinity.stranded(session.username) if self._affinity is not None else None
+        if stranded in hostnames:
+            hostnames.remove(stranded)
+            hostnames.append(stranded)
+        return hostnames
+
+    def _lost_race(self, session: ProtocolSession, hostname: str):
+        """Another host was faster, the session allocated on hostname is not handed out."""
+        logger.info("Another host was faster, the session allocated on %s for %s is not used.", hostname, session.username)
+        self._metrics.inc("agent.allocations.abandoned")
+        if self._affinity is not None:
+            self._affinity.strand(session.username, hostname)
+
+    def _allocated(
+        self,
+        session: ProtocolSession,
+        hostname: str,
+        status: AllocateSessionStatus,
+        agent_session: Optional[agent.AgentSession],
+    ) -> ProtocolAction:
         if status == AllocateSessionStatus.SUCCESSFUL:
             session.state = ProtocolState.WAITING_FOR_BYE
+            if self._affinity is not None:
+                self._affinity.remember(session.username, hostname)
 
             return (
                 session,
@@ -229,4 +282,216 @@ class BrokerProtocolHandler:
             result_id = "FAILED_USER_AUTH"
             if status == AllocateSessionStatus.FAILED_ANOTHER_SESSION_STARTED:
                 result_id = "FAILED_ANOTHER_SESION_STARTED"
+            elif status == AllocateSessionStatus.OVERLOADED:
+                # Not a credentials problem, the client shouldn't ask for the password again.
+                result_id = "FAILED_UNSPECIFIED"
             return session, AllocateResourceFailureResponse(result_id=result_id)
+
+
+class BrokerProtocolHandler(_BrokerProtocolMachine):
+    """Implements the logical level of the broker protocol. It is implemented as a state machine where state
+    transitions happen based on the values of the message and the broker session.
+
+    This means that the handler is completely stateless in itself, it only depends on inputs and is almost deterministic,
+    the exceptions are:
+        - when asked to allocate a resource, since it depends upon the answer from the Teradici resource.
+        - the mapper may not be deterministic.
+    """
+
+    def __init__(
+        self,
+        mapper: Mapper,
+        allocate_session=agent.allocate_session,
+        affinity: Optional[HostAffinity] = None,
+        metrics: Metrics = default_metrics,
+        hedge_delay: float = 2.0,
+    ):
+        super().__init__(mapper, allocate_session, affinity, metrics, hedge_delay)
+
+    def __call__(self, msg: Message, session: Optional[ProtocolSession]) -> ProtocolAction:
+        """Handles the message and returns the new state, session data and the response.
+
+        :param msg:
+            The message to handle.
+        :param session:
+            A slot that allows the protocol handler to register and read the session.
+
+        :return: An optional session data and a response message. If a session is active but this returns
+            None as the current session data, the session should be removed from store.
+        """
+        handler, action = self._route(msg, session)
+        return action if handler is None else handler(msg, session)
+
+    def _authenticate(self, msg: AuthenticateRequest, session: Optional[ProtocolSession]) -> ProtocolAction:
+        """We only expect authenticate messages here. When we get one, we ask the mapper to authenticate and return
+        the assigned resources.
+        """
+        previous_host = self._previous_host(msg, session)
+        mapper_status, resources = self.mapper.map((msg.username, msg.password), previous_host)
+        return self._authenticated(msg, session, mapper_status, resources)
+
+    def _race_allocations(
+        self, resource_id: str, resource: Resource, session: ProtocolSession
+    ) -> Tuple[AllocateSessionStatus, Optional[agent.AgentSession], str]:
+        """Allocates a session on the hostname of a pooled resource, hedged on its candidates: the next host is tried
+        when one fails, or when none has answered for hedge_delay seconds, and the first success is handed out. The hosts
+        not tried by then never are. An attempt still running can't be stopped, a session it allocates is not used.
+
+        :returns: The status, the session on success, and the host it is on. If all fail, the status of the hostname.
+        """
+        results = queue.Queue()
+        # Held to check the race is open and enter the result, so no result is entered once it is decided.
+        lock = threading.Lock()
+        decided = threading.Event()
+
+        def attempt(hostname):
+            try:
+                status, agent_session = self._allocate_on(resource_id, hostname, session)
+            except Exception:
+                logger.exception("Failed to allocate a session on %s.", hostname)
+                status, agent_session = AllocateSessionStatus.CONNECTION_ERROR, None
+            with lock:
+                if not decided.is_set():
+                    results.put((hostname, status, agent_session))
+                    return
+            if status == AllocateSessionStatus.SUCCESSFUL:
+                self._lost_race(session, hostname)
+
+        def start_next():
+            if waiting:
+                spawn(attempt, waiting.popleft())
+                return 1
+            return 0
+
+        self._metrics.inc("agent.allocations.raced")
+        waiting = deque(self._hostnames(resource, session))
+        running = start_next()
+        statuses = {}
+        while running:
+            try:
+                hostname, status, agent_session = results.get(timeout=self._hedge_delay if waiting else None)
+            except queue.Empty:
+                self._metrics.inc("agent.allocations.hedged")
+                running += start_next()
+                continue
+            running -= 1
+            if status == AllocateSessionStatus.SUCCESSFUL:
+                with lock:
+                    decided.set()
+                # Attempts that answered at the same time.
+                while not results.empty():
+                    other_hostname, other_status, _ = results.get_nowait()
+                    if other_status == AllocateSessionStatus.SUCCESSFUL:
+                        self._lost_race(session, other_hostname)
+                return status, agent_session, hostname
+            statuses[hostname] = status
+            running += start_next()
+        return statuses[resource.hostname], None, resource.hostname
+
+    def _allocate_resource(self, msg: AllocateResourceRequest, session: Optional[ProtocolSession]) -> ProtocolAction:
+        """The client should now ask us to allocate a session on a chosen machine. So we need to communicate with the
+        machine and obtain a session.
+        """
+        resource = self._resource(msg, session)
+        if resource.candidates:
+            status, agent_session, hostname = self._race_allocations(msg.resource_id, resource, session)
+        else:
+            hostname = resource.hostname
+            status, agent_session = self._allocate_on(msg.resource_id, hostname, session)
+        return self._allocated(session, hostname, status, agent_session)
+
+
+class AsyncBrokerProtocolHandler(_BrokerProtocolMachine):
+    """The same protocol as BrokerProtocolHandler, as a coroutine: it awaits the mapper, through Mapper.map_async, and
+    allocate_session, which must return an awaitable, so a worker can serve many logins while they wait on them.
+    """
+
+    def __init__(
+        self,
+        mapper: Mapper,
+        allocate_session=agent.allocate_session_async,
+        affinity: Optional[HostAffinity] = None,
+        metrics: Metrics = default_metrics,
+        hedge_delay: float = 2.0,
+    ):
+        super().__init__(mapper, allocate_session, affinity, metrics, hedge_delay)
+
+    async def __call__(self, msg: Message, session: Optional[ProtocolSession]) -> ProtocolAction:
+        """See BrokerProtocolHandler.__call__."""
+        handler, action = self._route(msg, session)
+        if handler is None:
+            return action
+        action = handler(msg, session)
+        if inspect.isawaitable(action):
+            action = await action
+        return action
+
+    async def _authenticate(self, msg: AuthenticateRequest, session: Optional[ProtocolSession]) -> ProtocolAction:
+        previous_host = self._previous_host(msg, session)
+        mapper_status, resources = await self.mapper.map_async((msg.username, msg.password), previous_host)
+        return self._authenticated(msg, session, mapper_status, resources)
+
+    async def _attempt(
+        self, resource_id: str, hostname: str, session: ProtocolSession
+    ) -> Tuple[AllocateSessionStatus, Optional[agent.AgentSession]]:
+        try:
+            return await self._allocate_on(resource_id, hostname, session)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("Failed to allocate a session on %s.", hostname)
+            return AllocateSessionStatus.CONNECTION_ERROR, None
+
+    async def _race_allocations(
+        self, resource_id: str, resource: Resource, session: ProtocolSession
+    ) -> Tuple[AllocateSessionStatus, Optional[agent.AgentSession], str]:
+        """See BrokerProtocolHandler._race_allocations. The attempts still running when one succeeds are cancelled."""
+        waiting = deque(self._hostnames(resource, session))
+        tasks, pending = {}, set()
+
+        def start_next():
+            if waiting:
+                hostname = waiting.popleft()
+                task = asyncio.ensure_future(self._attempt(resource_id, hostname, session))
+                tasks[task] = hostname
+                pending.add(task)
+
+        self._metrics.inc("agent.allocations.raced")
+        start_next()
+        statuses = {}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, timeout=self._hedge_delay if waiting else None, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    self._metrics.inc("agent.allocations.hedged")
+                    start_next()
+                    continue
+                won = None
+                for task in done:
+                    status, agent_session = task.result()
+                    if status != AllocateSessionStatus.SUCCESSFUL:
+                        statuses[tasks[task]] = status
+                    elif won is None:
+                        won = status, agent_session, tasks[task]
+                    else:
+                        # Attempts that answered at the same time.
+                        self._lost_race(session, tasks[task])
+                if won is not None:
+                    return won
+                for _ in done:
+                    start_next()
+        finally:
+            for task in pending:
+                task.cancel()
+        return statuses[resource.hostname], None, resource.hostname
+
+    async def _allocate_resource(self, msg: AllocateResourceRequest, session: Optional[ProtocolSession]) -> ProtocolAction:
+        resource = self._resource(msg, session)
+        if resource.candidates:
+            status, agent_session, hostname = await self._race_allocations(msg.resource_id, resource, session)
+        else:
+            hostname = resource.hostname
+            status, agent_session = await self._allocate_on(msg.resource_id, hostname, session)
+        return self._allocated(session, hostname, status, agent_session)
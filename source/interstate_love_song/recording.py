@@ -0,0 +1,209 @@
+import glob
+import hashlib
+import hmac
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from enum import Enum
+from typing import Iterable, Iterator, Optional
+from xml.etree.ElementTree import Element, tostring
+
+import falcon
+
+from .metrics import Metrics, metrics as default_metrics
+from .serialization import serialize_message
+
+logger = logging.getLogger(__name__)
+
+# The elements whose text identifies a user or grants a session.
+_REQUEST_SECRETS = {"username": "user", "password": "pass"}
+_RESPONSE_SECRETS = {"session-id": "session", "connect-tag": "tag"}
+
+
+class Redaction(Enum):
+    """How the recorder hides the usernames, passwords and session ids it records.
+
+    TOKENIZE replaces each value with a keyed digest of it, the same value always gets the same token in a recording,
+    so a replay still has the same users logging in, retrying with the wrong password, or reconnecting. REDACT replaces
+    them all with the same placeholder.
+    """
+
+    TOKENIZE = "TOKENIZE"
+    REDACT = "REDACT"
+
+
+@dataclass
+class Exchange:
+    """One recorded request to the broker and its response.
+
+    :ivar time: When the request arrived, seconds since the epoch.
+    :ivar duration: Seconds it took to handle.
+    :ivar client: The token of the client session, None if the request had none.
+    :ivar header_session: Whether the session came from the CLIENT-LOG-ID header rather than a cookie.
+    :ivar status: The HTTP status code of the response.
+    :ivar request: The redacted request XML, None if it wasn't XML.
+    :ivar request_bytes: The size of the request body.
+    :ivar response: The redacted response XML, None for an error response.
+    """
+
+    time: float
+    duration: float
+    client: Optional[str]
+    header_session: bool
+    status: int
+    request: Optional[str]
+    request_bytes: int
+    response: Optional[str]
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {
+                "t": round(self.time, 6),
+                "d": round(self.duration, 6),
+                "c": self.client,
+                "h": self.header_session,
+                "s": self.status,
+                "q": self.request,
+                "n": self.request_bytes,
+                "r": self.response,
+            },
+            separators=(",", ":"),
+        )
+
+    @classmethod
+    def from_json(cls, line: str) -> "Exchange":
+        """:raises ValueError: The line is not a recorded exchange."""
+        try:
+            data = json.loads(line)
+            return cls(data["t"], data["d"], data["c"], data["h"], data["s"], data["q"], data["n"], data["r"])
+        except (KeyError, TypeError) as e:
+            raise ValueError("Not a recorded exchange: {}".format(e))
+
+
+class TrafficRecorder:
+    """Records the requests to the broker, their responses and timing, one JSON line per request, for replaying as a
+    benchmark workload with benchmarks/replay.py.
+
+    Usernames, passwords, session ids and connect tags are tokenized or redacted before they are written, so are the
+    client session ids. Each process writes its own file, path.<pid>; create the recorder before the server forks, so
+    all the workers tokenize with the same key.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        redaction: Redaction = Redaction.TOKENIZE,
+        key: bytes = b"",
+        metrics: Metrics = default_metrics,
+    ):
+        """
+        :param path:
+            The prefix of the recording files.
+        :param key:
+            The key of the tokens, a random one if empty. With a fixed key the tokens are the same across recordings.
+        """
+        self._path = path
+        self._redaction = redaction
+        self._key = key or secrets.token_bytes(32)
+        self._metrics = metrics
+        self._lock = threading.Lock()
+        self._file = None
+        self._pid = None
+
+    def token(self, kind: str, value: Optional[str]) -> Optional[str]:
+        """The token that stands for value in the recording."""
+        if value is None:
+            return None
+        if self._redaction == Redaction.REDACT:
+            return "REDACTED"
+        digest = hmac.new(self._key, value.encode("utf-8"), hashlib.blake2b).hexdigest()
+        return "{}-{}".format(kind, digest[:16])
+
+    def _redact(self, xml: Element, tags) -> str:
+        for element in xml.iter():
+            if element.tag in tags and element.text:
+                element.text = self.token(tags[element.tag], element.text)
+        return tostring(xml, encoding="unicode")
+
+    @contextmanager
+    def exchange(self, req, resp):
+        """Records the request handled in the block, when it leaves it, with what BrokerResource left in req.context."""
+        start, started = time.time(), time.perf_counter()
+        status = None
+        try:
+            yield
+        except falcon.HTTPError as e:
+            status = e.status
+            raise
+        except Exception:
+            status = falcon.HTTP_INTERNAL_SERVER_ERROR
+            raise
+        finally:
+            self.record(req, status or resp.status, start, time.perf_counter() - started)
+
+    def record(self, req, status: str, start: float, duration: float):
+        context = req.context
+        session = req.env.get("beaker.session")
+        # A Beaker session that was never accessed would only be created to give us its id.
+        loaded = session is not None and getattr(session, "accessed", lambda: True)()
+        client_id = session.id if loaded else None
+        request_xml = getattr(context, "broker_request_xml", None)
+        response_msg = getattr(context, "broker_response", None)
+        try:
+            exchange = Exchange(
+                start,
+                duration,
+                self.token("client", client_id),
+                bool(req.get_header("CLIENT-LOG-ID")),
+                int(status.split(" ", 1)[0]),
+                self._redact(request_xml, _REQUEST_SECRETS) if request_xml is not None else None,
+                len(getattr(context, "broker_request_body", b"")),
+                self._redact(serialize_message(response_msg), _RESPONSE_SECRETS) if response_msg is not None else None,
+            )
+        except Exception:
+            logger.exception("Failed to record a request.")
+            self._metrics.inc("recording.errors")
+            return
+        self._write(exchange.to_json() + "\n")
+
+    def _write(self, line: str):
+        with self._lock:
+            try:
+                if self._pid != os.getpid():
+                    # A forked worker must not share the file of its parent.
+                    self._pid = os.getpid()
+                    self._file = open("{}.{}".format(self._path, self._pid), "a", encoding="utf-8")
+                self._file.write(line)
+                self._file.flush()
+            except OSError as e:
+                logger.error("Failed to write the recording: %s", e)
+                self._metrics.inc("recording.errors")
+                return
+        self._metrics.inc("recording.exchanges")
+
+
+def read_recording(paths: Iterable[str]) -> Iterator[Exchange]:
+    """The exchanges in the recording files, the files of all the workers, in the order the requests arrived. A path may
+    be a glob. A truncated last line, from a worker that was killed mid-write, is skipped.
+
+    :raises ValueError: A line, other than the last of a file, is not a recorded exchange.
+    """
+    exchanges = []
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            with open(path, "r", encoding="utf-8") as f:
+                lines = f.read().splitlines()
+            for number, line in enumerate(lines):
+                try:
+                    exchanges.append(Exchange.from_json(line))
+                except ValueError:
+                    if number != len(lines) - 1:
+                        raise
+                    logger.warning("Skipped the truncated last line of %s.", path)
+    exchanges.sort(key=lambda exchange: exchange.time)
+    return iter(exchanges)
@@ -0,0 +1,138 @@
+import logging
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Optional, Sequence
+
+from .metrics import Metrics, metrics as default_metrics
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class _Entry:
+    addresses: Sequence[str]
+    error: Optional[socket.gaierror]
+    expires: float
+    refresh_at: float
+
+
+class CachingResolver:
+    """Caches the addresses of hostnames, so a slow resolver only delays the first call to a host in a while rather
+    than every one of them.
+
+    An answer is kept for ttl seconds, a failure for negative_ttl seconds. An answer used in the last refresh_ahead
+    seconds before it expires is resolved again in the background, while the cached one is still served, so the hosts in
+    use never expire. A failed background refresh leaves the answer in place until it expires.
+
+    The cache is per process; filled before a fork, the children start with it.
+    """
+
+    def __init__(
+        self,
+        ttl: float = 60.0,
+        negative_ttl: float = 5.0,
+        refresh_ahead: float = 10.0,
+        port: int = 0,
+        metrics: Metrics = default_metrics,
+    ):
+        """
+        :param ttl:
+            Seconds to keep an answer.
+        :param negative_ttl:
+            Seconds to keep a failure.
+        :param refresh_ahead:
+            Seconds before an answer expires to refresh it, at most ttl.
+        :param port:
+            Passed to getaddrinfo, which only matters for its service lookup.
+        """
+        if ttl <= 0 or negative_ttl < 0 or refresh_ahead < 0:
+            raise ValueError("ttl must be positive, negative_ttl and refresh_ahead not negative.")
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._refresh_ahead = min(refresh_ahead, ttl)
+        self._port = port
+        self._metrics = metrics
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _lookup(self, hostname: str) -> _Entry:
+        start = time.perf_counter()
+        try:
+            infos = socket.getaddrinfo(hostname, self._port, type=socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys(info[4][0] for info in infos))
+            error = None
+        except socket.gaierror as e:
+            addresses, error = [], e
+        elapsed = time.perf_counter() - start
+        self._metrics.inc("agent.dns.lookups")
+        self._metrics.inc("agent.dns.lookup_seconds", elapsed)
+        if elapsed > self._metrics.get("agent.dns.max_lookup_seconds", 0.0):
+            self._metrics.set("agent.dns.max_lookup_seconds", elapsed)
+
+        now = time.monotonic()
+        if error is not None:
+            self._metrics.inc("agent.dns.failures")
+            return _Entry(addresses, error, now + self._negative_ttl, now + self._negative_ttl)
+        return _Entry(addresses, None, now + self._ttl, now + self._ttl - self._refresh_ahead)
+
+    def _refresh(self, hostname: str):
+        try:
+            entry = self._lookup(hostname)
+            if entry.error is None:
+                self._entries[hostname] = entry
+            else:
+                logger.info("Failed to refresh the address of %s, keeping the cached one: %s", hostname, entry.error)
+        finally:
+            with self._lock:
+                self._refreshing.discard(hostname)
+
+    def _refresh_in_background(self, hostname: str):
+        with self._lock:
+            if hostname in self._refreshing:
+                return
+            self._refreshing.add(hostname)
+        self._metrics.inc("agent.dns.refreshes")
+        threading.Thread(target=self._refresh, args=(hostname,), daemon=True).start()
+
+    def resolve(self, hostname: str) -> Sequence[str]:
+        """The addresses of a hostname.
+
+        :raises socket.gaierror:
+            The hostname could not be resolved, now or within the last negative_ttl seconds.
+        """
+        now = time.monotonic()
+        entry = self._entries.get(hostname)
+        if entry is None or now >= entry.expires:
+            self._metrics.inc("agent.dns.misses")
+            entry = self._lookup(hostname)
+            self._entries[hostname] = entry
+        else:
+            self._metrics.inc("agent.dns.hits")
+            if now >= entry.refresh_at and entry.error is None:
+                self._refresh_in_background(hostname)
+        if entry.error is not None:
+            raise entry.error
+        return entry.addresses
+
+    def prefetch(self, hostnames: Iterable[str], concurrency: int = 16) -> int:
+        """Resolves the hostnames into the cache, a few at a time, and waits for them.
+
+        :returns: The number of hostnames that resolved.
+        """
+        hostnames = list(dict.fromkeys(hostnames))
+        if not hostnames:
+            return 0
+
+        def fetch(hostname):
+            entry = self._lookup(hostname)
+            self._entries[hostname] = entry
+            return entry.error is None
+
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(hostnames))) as executor:
+            resolved = sum(executor.map(fetch, hostnames))
+        logger.info("Resolved %s of %s agent hostnames.", resolved, len(hostnames))
+        return resolved
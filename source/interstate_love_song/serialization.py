@@ -1,15 +1,23 @@
-from typing import Any, Optional
+from typing import Any, Optional, Sequence
 
 from .transport import *
 
 from defusedxml.ElementTree import fromstring as xml_fromstring
-from xml.etree.ElementTree import ElementTree, Element, SubElement
+from xml.etree.ElementTree import ElementTree, Element, SubElement, tostringlist
 
 
 class UnsupportedMessage(Exception):
     pass
 
 
+XML_DECLARATION = b"<?xml version='1.0' encoding='utf-8'?>\n"
+
+# Responses that carry nothing about the user or their session, their documents can be reused.
+_REUSABLE_RESPONSES = (HelloResponse, AuthenticateSuccessResponse, AuthenticateFailedResponse, ByeResponse)
+_ENCODED_CACHE_SIZE = 64
+_encoded = {}
+
+
 def serialize_message(msg: Message) -> Element:
     """Serializes a message to XML. Only serializes *Response messages.
 
@@ -22,22 +30,37 @@ def serialize_message(msg: Message) -> Element:
     if not isinstance(msg, Message):
         raise ValueError("msg must be an instance of Message.")
 
-    msg_type = type(msg)
-
-    routing_table = {
-        HelloResponse: _serialize_hello_response,
-        AuthenticateSuccessResponse: _serialize_authenticate_response,
-        AuthenticateFailedResponse: _serialize_authenticate_failed_response,
-        GetResourceListResponse: _serialize_get_resource_list_response,
-        AllocateResourceSuccessResponse: _serialize_allocate_resource_success_response,
-        AllocateResourceFailureResponse: _serialize_allocate_resource_failure_response,
-        ByeResponse: _serialize_bye_response,
-    }
-
-    if msg_type in routing_table:
-        return routing_table[msg_type](msg)
-    else:
+    serializer = _SERIALIZERS.get(type(msg))
+    if serializer is None:
         raise UnsupportedMessage()
+    return serializer(msg)
+
+
+def encode_element(xml: Element) -> Sequence[bytes]:
+    """Encodes XML as a UTF-8 document with a declaration, as the chunks of a WSGI response body.
+
+    ElementTree writes the pieces straight into a list and they are joined once; a chunk per piece would cost the
+    server a write each.
+    """
+    pieces = tostringlist(xml, encoding="utf-8")
+    pieces.insert(0, XML_DECLARATION)
+    return (b"".join(pieces),)
+
+
+def encode_message(msg: Message) -> Sequence[bytes]:
+    """Serializes and encodes a message, see serialize_message and encode_element. Responses that are the same for
+    everyone, like hello and bye, are only encoded the first time.
+    """
+    if not isinstance(msg, _REUSABLE_RESPONSES):
+        return encode_element(serialize_message(msg))
+
+    key = (type(msg), repr(msg))
+    encoded = _encoded.get(key)
+    if encoded is None:
+        if len(_encoded) >= _ENCODED_CACHE_SIZE:
+            _encoded.clear()
+        encoded = _encoded[key] = encode_element(serialize_message(msg))
+    return encoded
 
 
 def _get_common_root() -> Element:
@@ -192,18 +215,10 @@ def deserialize_message(xml: Element) -> Message:
         return BadMessage("expected 1 and only 1 child to pcoip-client")
     request = xml[0]
 
-    routing_table = {
-        "hello": _deserialize_hello,
-        "authenticate": _deserialize_authenticate,
-        "get-resource-list": _deserialize_message_get_resource_list,
-        "allocate-resource": _deserialize_message_allocate_resource,
-        "bye": _deserialize_bye,
-    }
-
-    if request.tag not in routing_table:
+    deserializer = _DESERIALIZERS.get(request.tag)
+    if deserializer is None:
         return BadMessage()
-
-    return routing_table[request.tag](request)
+    return deserializer(request)
 
 
 def _get_version(root: Element) -> Optional[str]:
@@ -254,3 +269,23 @@ def _deserialize_message_allocate_resource(request_xml: Element) -> Message:
 
 def _deserialize_bye(request_xml: Element) -> Message:
     return ByeRequest()
+
+
+# The dispatch tables are built once, at import, rather than on every call.
+_SERIALIZERS = {
+    HelloResponse: _serialize_hello_response,
+    AuthenticateSuccessResponse: _serialize_authenticate_response,
+    AuthenticateFailedResponse: _serialize_authenticate_failed_response,
+    GetResourceListResponse: _serialize_get_resource_list_response,
+    AllocateResourceSuccessResponse: _serialize_allocate_resource_success_response,
+    AllocateResourceFailureResponse: _serialize_allocate_resource_failure_response,
+    ByeResponse: _serialize_bye_response,
+}
+
+_DESERIALIZERS = {
+    "hello": _deserialize_hello,
+    "authenticate": _deserialize_authenticate,
+    "get-resource-list": _deserialize_message_get_resource_list,
+    "allocate-resource": _deserialize_message_allocate_resource,
+    "bye": _deserialize_bye,
+}
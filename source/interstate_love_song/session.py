@@ -1,7 +1,504 @@
-from abc import ABC, abstractmethod
+import fcntl
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import time
 from dataclasses import dataclass
 from typing import Optional
 
+from beaker import util
+from beaker.cache import clsmap
+from beaker.container import NamespaceManager, FileNamespaceManager, OpenResourceNamespaceManager
+from beaker.synchronization import FileSynchronizer, SynchronizerImpl, file_synchronizer
+
+from .compat import unpatched
+from .metrics import Metrics, metrics as default_metrics
+
+logger = logging.getLogger(__name__)
+
 
 class SessionError(Exception):
     pass
+
+
+SQLITE_FILENAME = "interstate_love_song_sessions.sqlite"
+SQLITE_LOCK_DIRNAME = "container_sqlite_lock"
+
+SESSION_DIRNAME = "sessions"
+# Where Beaker's own file store keeps its files, the janitor cleans these up too.
+LEGACY_DIRNAMES = ("container_file", "container_file_lock")
+CACHE_EXTENSION = ".cache"
+LOCK_EXTENSION = ".lock"
+# Three hex digits give 4096 shard directories; a million live sessions is still only ~250 files per directory.
+SHARD_WIDTH = 3
+SWEEP_BATCH_SIZE = 500
+# SQLite waits for a lock inside its C call, which on a gevent worker stalls every greenlet, so it only waits briefly
+# and _execute retries with a sleep in between, which yields on a monkey patched worker.
+SQLITE_BUSY_TIMEOUT = 0.05
+SQLITE_LOCK_TIMEOUT = 10.0
+SQLITE_RETRY_DELAY = 0.001
+SQLITE_MAX_RETRY_DELAY = 0.05
+
+# Constant statements, so sqlite3's per-connection statement cache prepares each of them once.
+_CREATE_TABLE = """CREATE TABLE IF NOT EXISTS beaker_sessions (
+    id INTEGER PRIMARY KEY,
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value BLOB NOT NULL,
+    expires REAL NOT NULL,
+    UNIQUE (namespace, key)
+)"""
+_CREATE_INDEX = "CREATE INDEX IF NOT EXISTS beaker_sessions_expires ON beaker_sessions (expires)"
+_SELECT = "SELECT value FROM beaker_sessions WHERE namespace = ? AND key = ? AND expires >= ?"
+_SELECT_KEYS = "SELECT key FROM beaker_sessions WHERE namespace = ? AND expires >= ?"
+_UPSERT = "INSERT OR REPLACE INTO beaker_sessions (namespace, key, value, expires) VALUES (?, ?, ?, ?)"
+_DELETE = "DELETE FROM beaker_sessions WHERE namespace = ? AND key = ?"
+_DELETE_NAMESPACE = "DELETE FROM beaker_sessions WHERE namespace = ?"
+_DELETE_EXPIRED = """DELETE FROM beaker_sessions WHERE id IN (
+    SELECT id FROM beaker_sessions WHERE expires < ? LIMIT ?
+)"""
+
+
+def _execute(connection: sqlite3.Connection, sql: str, parameters=()) -> sqlite3.Cursor:
+    """Runs a statement, retrying for up to SQLITE_LOCK_TIMEOUT seconds while the database is locked.
+
+    :raises sqlite3.OperationalError:
+        The statement failed, or the database was still locked.
+    """
+    deadline = None
+    delay = SQLITE_RETRY_DELAY
+    while True:
+        try:
+            return connection.execute(sql, parameters)
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e):
+                raise
+            now = time.monotonic()
+            if deadline is None:
+                deadline = now + SQLITE_LOCK_TIMEOUT
+            elif now >= deadline:
+                raise
+            time.sleep(delay)
+            delay = min(delay * 2, SQLITE_MAX_RETRY_DELAY)
+
+
+class _Connections:
+    """One connection per OS thread and process. Greenlets on a gevent worker all share their thread's connection,
+    which is safe since a statement never yields; _execute only sleeps between statements.
+    """
+
+    def __init__(self):
+        self._local = unpatched("threading", "local")()
+
+    def get(self, path: str) -> sqlite3.Connection:
+        local = self._local
+        if getattr(local, "pid", None) != os.getpid():
+            # Connections must not cross a fork, the child opens its own.
+            local.pid = os.getpid()
+            local.connections = {}
+        connection = local.connections.get(path)
+        if connection is None:
+            connection = local.connections[path] = _connect(path)
+        return connection
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+    # WAL lets the other workers read while one writes; NORMAL sync is durable across a process crash.
+    _execute(connection, "PRAGMA journal_mode=WAL")
+    _execute(connection, "PRAGMA synchronous=NORMAL")
+    _execute(connection, _CREATE_TABLE)
+    _execute(connection, _CREATE_INDEX)
+    return connection
+
+
+_connections = _Connections()
+
+
+class SqliteNamespaceManager(NamespaceManager):
+    """A Beaker session store in a single SQLite database in WAL mode, shared by all workers on the host.
+
+    Every row has an expiry time, reads ignore expired rows and writes now and then delete a bounded batch of them. Each
+    operation is a single statement, and thus atomic, so the Beaker access locks are not needed. A statement that finds
+    the database locked by another worker sleeps and retries rather than blocking in SQLite, so on a gevent worker the
+    other greenlets keep running meanwhile. The creation locks, which Beaker takes when it computes a missing value, are
+    file locks in data_dir, like those of its own stores.
+
+    Select it with the session type "sqlite", the database is created in data_dir.
+    """
+
+    DEFAULT_TTL = 3600
+    PURGE_INTERVAL = 60.0
+    PURGE_BATCH_SIZE = 500
+
+    _next_purge = 0.0
+
+    def __init__(self, namespace, data_dir=None, ttl=None, **kwargs):
+        """
+        :param data_dir:
+            Directory of the database file.
+        :param ttl:
+            Seconds a session lives after it was last written.
+        :raises SessionError:
+            data_dir was not set.
+        """
+        super().__init__(namespace)
+        if not data_dir:
+            raise SessionError("The sqlite session store needs a data_dir.")
+        self._path = os.path.join(data_dir, SQLITE_FILENAME)
+        self._lock_dir = os.path.join(data_dir, SQLITE_LOCK_DIRNAME)
+        self._ttl = float(ttl or SqliteNamespaceManager.DEFAULT_TTL)
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        return _connections.get(self._path)
+
+    def get_creation_lock(self, key):
+        return file_synchronizer("sqlitecontainer/funclock/{}/{}".format(self.namespace, key), lock_dir=self._lock_dir)
+
+    def __getitem__(self, key):
+        row = _execute(self._connection, _SELECT, (self.namespace, key, time.time())).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(row[0])
+
+    def __contains__(self, key):
+        return _execute(self._connection, _SELECT, (self.namespace, key, time.time())).fetchone() is not None
+
+    def __setitem__(self, key, value):
+        now = time.time()
+        _execute(
+            self._connection, _UPSERT, (self.namespace, key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), now + self._ttl)
+        )
+        if now >= SqliteNamespaceManager._next_purge:
+            SqliteNamespaceManager._next_purge = now + SqliteNamespaceManager.PURGE_INTERVAL
+            purge_expired(self._connection, now)
+
+    def __delitem__(self, key):
+        _execute(self._connection, _DELETE, (self.namespace, key))
+
+    def do_remove(self):
+        _execute(self._connection, _DELETE_NAMESPACE, (self.namespace,))
+
+    def keys(self):
+        return [row[0] for row in _execute(self._connection, _SELECT_KEYS, (self.namespace, time.time()))]
+
+
+def purge_expired(
+    connection: sqlite3.Connection, now: Optional[float] = None, batch_size: int = SqliteNamespaceManager.PURGE_BATCH_SIZE
+) -> int:
+    """Deletes expired sessions in batches, so no single transaction holds the write lock for long.
+
+    :returns: The number of sessions deleted.
+    """
+    now = time.time() if now is None else now
+    deleted = 0
+    while True:
+        count = _execute(connection, _DELETE_EXPIRED, (now, batch_size)).rowcount
+        deleted += count
+        if count < batch_size:
+            break
+    if deleted:
+        logger.info("Purged %s expired sessions.", deleted)
+    return deleted
+
+
+class HeaderSession:
+    """A minimal session keyed by a value the client sends in a header, for clients whose cookies we can't rely on.
+
+    It loads from the store at most once, on first access, and writes at most once, in persist, and only if save was
+    called. There are no cookies and no access times. It offers the part of the Beaker session interface
+    BeakerSessionSetter uses: get, item assignment, save and namespace.
+    """
+
+    def __init__(self, key: str, options: dict):
+        """
+        :param key:
+            The header value. It is hashed into the session id, so it can't escape data_dir in a file store.
+        :param options:
+            The Beaker session options, without the "session." prefix.
+        """
+        self.id = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        self._options = options
+        self._data = None
+        self._dirty = False
+        self.namespace = None
+
+    def _load(self) -> dict:
+        if self._data is None:
+            namespace_class = self._options.get("namespace_class") or clsmap[self._options.get("type") or "file"]
+            self.namespace = namespace_class(
+                self.id,
+                data_dir=self._options.get("data_dir"),
+                digest_filenames=False,
+                ttl=self._options.get("ttl"),
+            )
+            self.namespace.acquire_read_lock()
+            try:
+                self._data = self.namespace["session"]
+            except KeyError:
+                self._data = {}
+            finally:
+                self.namespace.release_read_lock()
+        return self._data
+
+    def get(self, key, default=None):
+        return self._load().get(key, default)
+
+    def __getitem__(self, key):
+        return self._load()[key]
+
+    def __setitem__(self, key, value):
+        self._load()[key] = value
+
+    def save(self):
+        self._dirty = True
+
+    def persist(self):
+        """Writes the session if save was called."""
+        if not self._dirty:
+            return
+        self.namespace.acquire_write_lock(replace=True)
+        try:
+            self.namespace["session"] = self._data
+        finally:
+            self.namespace.release_write_lock()
+        self._dirty = False
+
+
+class _PathSynchronizer(FileSynchronizer):
+    """A FileSynchronizer for a given lock file path, Beaker's always derives one in a tree of its own."""
+
+    def __init__(self, path: str):
+        SynchronizerImpl.__init__(self)
+        self._filedescriptor = util.ThreadLocal()
+        self.filename = path
+        self.lock_dir = os.path.dirname(path)
+
+
+class ShardedFileNamespaceManager(FileNamespaceManager):
+    """Beaker's file store, laid out for sweeping. A session lives in data_dir/sessions/abc/<digest>.cache with its lock
+    file beside it, where digest is the SHA-1 of the session id and abc its first three digits. Beaker spreads them over
+    two trees of 256 directories, and never removes a lock file. The creation locks, Beaker's own, are files in the
+    shard directory too, which the janitor sweeps when they are old.
+
+    Select it with the session type "file", it is the default.
+    """
+
+    def __init__(self, namespace, data_dir=None, **kwargs):
+        """
+        :param data_dir:
+            Directory of the session tree.
+        :raises SessionError:
+            data_dir was not set.
+        """
+        if not data_dir:
+            raise SessionError("The file session store needs a data_dir.")
+        digest = hashlib.sha1(str(namespace).encode("utf-8")).hexdigest()
+        self.file_dir = self.lock_dir = os.path.join(data_dir, SESSION_DIRNAME, digest[:SHARD_WIDTH])
+        util.verify_directory(self.file_dir)
+        self.file = os.path.join(self.file_dir, digest + CACHE_EXTENSION)
+        # The base class creates the access lock, so the path must be known first.
+        self._lock_file = os.path.join(self.file_dir, digest + LOCK_EXTENSION)
+        OpenResourceNamespaceManager.__init__(self, namespace)
+        self.hash = {}
+
+    def get_access_lock(self):
+        return _PathSynchronizer(self._lock_file)
+
+    def get_creation_lock(self, key):
+        return file_synchronizer("dbmcontainer/funclock/{}/{}".format(self.namespace, key), lock_dir=self.lock_dir)
+
+
+@dataclass
+class SweepResult:
+    scanned: int = 0
+    removed: int = 0
+
+
+def _mtime(path: str) -> Optional[float]:
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def _expired(path: str, deadline: float) -> bool:
+    mtime = _mtime(path)
+    return mtime is not None and mtime < deadline
+
+
+def sweep_file_sessions(
+    data_dir: str,
+    ttl: float,
+    now: Optional[float] = None,
+    batch_size: int = SWEEP_BATCH_SIZE,
+    pause: float = 0.0,
+) -> SweepResult:
+    """Removes the files of sessions that were last written more than ttl seconds ago, from the sharded tree and from
+    Beaker's own layout. A lock file goes once it is that old and its session is gone or expired too, and so do the
+    temporary files of interrupted writes.
+
+    :param batch_size:
+        Files to remove before pausing.
+    :param pause:
+        Seconds to pause between batches, so a big backlog doesn't saturate the disk.
+    """
+    deadline = (time.time() if now is None else now) - ttl
+    sleep = unpatched("time", "sleep")
+    result = SweepResult()
+    roots = [os.path.join(data_dir, name) for name in (SESSION_DIRNAME,) + LEGACY_DIRNAMES]
+    for root in roots:
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                result.scanned += 1
+                path = os.path.join(directory, filename)
+                if not _expired(path, deadline):
+                    continue
+                if filename.endswith(LOCK_EXTENSION):
+                    session_mtime = _mtime(path[: -len(LOCK_EXTENSION)] + CACHE_EXTENSION)
+                    if session_mtime is not None and session_mtime >= deadline:
+                        continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                result.removed += 1
+                if pause and result.removed % batch_size == 0:
+                    sleep(pause)
+    return result
+
+
+class SessionJanitor:
+    """Expires abandoned sessions in the background, in either store.
+
+    It sweeps on a real OS thread, so the file system work never stalls a gevent worker. Every worker may start one,
+    but only one process per data_dir sweeps: the janitor that gets the flock on data_dir/janitor.lock keeps it until
+    its process exits, the others try again every interval and one of them takes over then.
+    """
+
+    LOCK_FILENAME = "janitor.lock"
+
+    def __init__(
+        self,
+        type: str,
+        data_dir: str,
+        ttl: float,
+        interval: float = 60.0,
+        batch_size: int = SWEEP_BATCH_SIZE,
+        pause: float = 0.01,
+        metrics: Metrics = default_metrics,
+    ):
+        """
+        :param type:
+            The session store type, "sqlite" or a file store.
+        :param ttl:
+            Seconds a session lives after it was last written.
+        :param interval:
+            Seconds between sweeps.
+        :raises ValueError:
+            interval or batch_size is not positive.
+        """
+        if interval <= 0 or batch_size <= 0:
+            raise ValueError("interval and batch_size must be positive.")
+        self._type = type
+        self._data_dir = data_dir
+        self._ttl = ttl
+        self._interval = interval
+        self._batch_size = batch_size
+        self._pause = pause
+        self._metrics = metrics
+        self._lock_fd = None
+        self._stop = None
+
+    @property
+    def leader(self) -> bool:
+        """Whether this janitor is the one that sweeps."""
+        return self._lock_fd is not None
+
+    def _try_lead(self) -> bool:
+        if self._lock_fd is None:
+            os.makedirs(self._data_dir, exist_ok=True)
+            fd = os.open(os.path.join(self._data_dir, SessionJanitor.LOCK_FILENAME), os.O_CREAT | os.O_RDWR)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            self._lock_fd = fd
+            self._metrics.set("sessions.janitor.leader", 1)
+            logger.info("Session janitor %s sweeps %s.", os.getpid(), self._data_dir)
+        return True
+
+    def _resign(self):
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+            self._metrics.set("sessions.janitor.leader", 0)
+
+    def sweep(self) -> SweepResult:
+        """Sweeps once, whether this janitor leads or not, and records the result in the metrics."""
+        start = time.perf_counter()
+        if self._type == "sqlite":
+            connection = _connections.get(os.path.join(self._data_dir, SQLITE_FILENAME))
+            removed = purge_expired(connection, batch_size=self._batch_size)
+            # The purge only visits expired rows, through the expiry index.
+            result = SweepResult(scanned=removed, removed=removed)
+        else:
+            result = sweep_file_sessions(self._data_dir, self._ttl, batch_size=self._batch_size, pause=self._pause)
+        duration = time.perf_counter() - start
+
+        self._metrics.inc("sessions.janitor.sweeps")
+        self._metrics.inc("sessions.janitor.scanned", result.scanned)
+        self._metrics.inc("sessions.janitor.removed", result.removed)
+        self._metrics.set("sessions.janitor.last_scanned", result.scanned)
+        self._metrics.set("sessions.janitor.last_removed", result.removed)
+        self._metrics.set("sessions.janitor.last_duration_seconds", duration)
+        logger.log(
+            logging.INFO if result.removed else logging.DEBUG,
+            "Swept sessions in %.3fs, %s scanned, %s removed.",
+            duration,
+            result.scanned,
+            result.removed,
+        )
+        return result
+
+    def run_once(self) -> Optional[SweepResult]:
+        """Sweeps if this janitor leads, or can take the lead now.
+
+        :returns: The result, or None if another process sweeps.
+        """
+        if not self._try_lead():
+            return None
+        return self.sweep()
+
+    def start(self):
+        """Starts sweeping every interval on a new OS thread, beginning right away.
+
+        :raises RuntimeError:
+            The janitor is already running.
+        """
+        if self._stop is not None:
+            raise RuntimeError("The janitor is already running.")
+        self._stop = unpatched("_thread", "allocate_lock")()
+        self._stop.acquire()
+        unpatched("_thread", "start_new_thread")(self._run, (self._stop,))
+
+    def stop(self):
+        """Asks the janitor to stop; the thread lets go of the lead when the sweep in progress, if any, finishes."""
+        if self._stop is not None:
+            self._stop.release()
+            self._stop = None
+
+    def _run(self, stop):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("The session sweep failed.")
+            if stop.acquire(timeout=self._interval):
+                break
+        self._resign()
@@ -11,6 +11,7 @@ import argparse
 from .mapping.base import Mapper
 from .plugins import create_plugin_from_settings
 from .plugins.simple import SimpleMapper, SimpleMapperSettings
+from .recording import Redaction
 
 logger = logging.getLogger(__name__)
 
@@ -105,6 +106,9 @@ class BeakerSettings:
 
     type: str = "file"
     data_dir: str = "/tmp"
+    ttl: int = 3600
+    janitor_interval: float = 60.0
+    janitor_batch_size: int = 500
 
 
 class LoggingLevel(Enum):
@@ -117,6 +121,73 @@ class LoggingSettings:
     level: LoggingLevel = LoggingLevel.INFO
 
 
+@dataclass
+class AdminSettings:
+    """The admin endpoints are disabled unless a token is set."""
+
+    token: str = ""
+    max_profile_seconds: float = 60.0
+
+
+@dataclass
+class HttpSettings:
+    max_body_bytes: int = 65536
+    read_timeout_seconds: float = 10.0
+
+
+@dataclass
+class AgentSettings:
+    """How the agents are called, and the limits on the calls, per worker."""
+
+    max_concurrent: int = 64
+    max_per_host: int = 8
+    max_waiting: int = 256
+    max_waiting_per_host: int = 32
+    max_wait_seconds: float = 10.0
+    verify: bool = False
+    ca_bundle: str = ""
+    dns_ttl_seconds: float = 60.0
+    dns_negative_ttl_seconds: float = 5.0
+    dns_refresh_ahead_seconds: float = 10.0
+    allocation_result_ttl_seconds: float = 5.0
+    hedge_delay_seconds: float = 2.0
+
+
+@dataclass
+class RateLimitSettings:
+    """Token bucket budgets, in messages per second and messages in a burst. A rate of 0 turns a budget off. Off by
+    default: behind a proxy, without client_ip_header, every client would share the proxy's buckets.
+    """
+
+    enabled: bool = False
+    client_cheap_rate: float = 20.0
+    client_cheap_burst: float = 100.0
+    client_expensive_rate: float = 2.0
+    client_expensive_burst: float = 20.0
+    user_rate: float = 0.5
+    user_burst: float = 10.0
+    client_ip_header: str = ""
+    slots: int = 65536
+
+
+@dataclass
+class AffinitySettings:
+    """Sending users back to the host they were last allocated."""
+
+    enabled: bool = True
+    ttl_seconds: float = 28800.0
+    slots: int = 16384
+
+
+@dataclass
+class RecordingSettings:
+    """Recording the broker traffic, off unless a path is set."""
+
+    path: str = ""
+    redaction: Redaction = Redaction.TOKENIZE
+    key: str = ""
+
+
 @dataclass
 class DefaultMapper:
     plugin: Type[SimpleMapper] = SimpleMapper
@@ -134,6 +205,12 @@ class Settings:
     mapper: Union[Type[Mapper], DefaultMapper] = field(init=False, default=DefaultMapper)
     logging: LoggingSettings = LoggingSettings()
     beaker: BeakerSettings = BeakerSettings()
+    admin: AdminSettings = AdminSettings()
+    rate_limit: RateLimitSettings = RateLimitSettings()
+    agent: AgentSettings = AgentSettings()
+    http: HttpSettings = HttpSettings()
+    affinity: AffinitySettings = AffinitySettings()
+    recording: RecordingSettings = RecordingSettings()
 
     @classmethod
     def load_dict(cls, data: Mapping[str, Any]):
@@ -148,8 +225,18 @@ def load_settings_json(json_str: str) -> Settings:
     """Loads the settings from a JSON string. The JSON should be structured as follows:
     {
         "mapper": ?,
-        "beaker": {"type": ?, "data_dir": ?},
+        "beaker": {"type": ?, "data_dir": ?, "ttl": ?, "janitor_interval": ?, "janitor_batch_size": ?},
         "logging": {"level": ?},
+        "admin": {"token": ?, "max_profile_seconds": ?},
+        "rate_limit": {"enabled": ?, "client_cheap_rate": ?, "client_cheap_burst": ?, "client_expensive_rate": ?,
+                       "client_expensive_burst": ?, "user_rate": ?, "user_burst": ?, "client_ip_header": ?, "slots": ?},
+        "agent": {"max_concurrent": ?, "max_per_host": ?, "max_waiting": ?, "max_waiting_per_host": ?,
+                  "max_wait_seconds": ?, "verify": ?, "ca_bundle": ?,
+                  "dns_ttl_seconds": ?, "dns_negative_ttl_seconds": ?, "dns_refresh_ahead_seconds": ?,
+                  "allocation_result_ttl_seconds": ?, "hedge_delay_seconds": ?},
+        "http": {"max_body_bytes": ?, "read_timeout_seconds": ?},
+        "affinity": {"enabled": ?, "ttl_seconds": ?, "slots": ?},
+        "recording": {"path": ?, "redaction": ?, "key": ?},
     }
     """
     data = json.loads(json_str)
@@ -0,0 +1,201 @@
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import secrets
+import struct
+import time
+from typing import Callable, List, Optional, Sequence, Tuple, TypeVar
+
+logger = logging.getLogger(__name__)
+
+R = TypeVar("R")
+Values = Tuple
+Updater = Callable[[Optional[Values], float], Tuple[Values, R]]
+
+_HEADER = "Qd"
+# The key hashes that mark a slot that was never taken, and one whose entry was deleted.
+_EMPTY, _TOMBSTONE = 0, 1
+
+
+class SharedTableError(Exception):
+    pass
+
+
+class SharedTable:
+    """A fixed size hash table of fixed size records in anonymous shared memory, shared by all the processes forked
+    after it was created, i.e. all the gunicorn workers if it is created before the server starts.
+
+    Keys are strings, stored as a keyed 64 bit hash. Each key probes a few neighbouring slots; when they are all taken
+    the least recently updated entry is evicted, so memory stays bounded whatever the keys. A deleted entry leaves a
+    tombstone, so the keys probed past it are still found, and a new key takes it over. Values are tuples packed with a
+    struct format.
+
+    A process-shared lock serializes the updates. It is only held for a few microseconds, but it is a real lock, a
+    gevent worker blocks on it rather than yield.
+    """
+
+    LOCK_TIMEOUT = 1.0
+
+    def __init__(self, slots: int, value_format: str, probes: int = 8):
+        """
+        :param slots:
+            The number of entries the table holds.
+        :param value_format:
+            The struct format of the values, e.g. "d" for a single float.
+        :param probes:
+            Slots to try for a key, the more the fewer evictions on collisions and the slower the lookups.
+        :raises ValueError:
+            slots or probes is not positive.
+        """
+        if slots <= 0 or probes <= 0:
+            raise ValueError("slots and probes must be positive.")
+        self._record = struct.Struct("=" + _HEADER + value_format)
+        self._slots = slots
+        self._probes = min(probes, slots)
+        # An anonymous mapping is MAP_SHARED, the forked processes write to the same pages.
+        self._memory = mmap.mmap(-1, slots * self._record.size)
+        self._lock = multiprocessing.Lock()
+        # Keyed, so the slots a key lands in can't be predicted from outside.
+        self._secret = secrets.token_bytes(16)
+
+    @property
+    def slots(self) -> int:
+        return self._slots
+
+    def _hash(self, key: str) -> int:
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8, key=self._secret).digest()
+        return max(int.from_bytes(digest, "little"), _TOMBSTONE + 1)
+
+    def _find(self, key_hash: int) -> Tuple[int, Optional[tuple]]:
+        """The offset of the key's entry and the entry, or the offset of the slot to take for it and None."""
+        unpack_from, size = self._record.unpack_from, self._record.size
+        start = key_hash % self._slots
+        tombstone, victim, victim_stamp = None, None, None
+        for i in range(self._probes):
+            offset = ((start + i) % self._slots) * size
+            entry = unpack_from(self._memory, offset)
+            if entry[0] == key_hash:
+                return offset, entry
+            if entry[0] == _EMPTY:
+                # No key was ever probed past an empty slot.
+                return offset if tombstone is None else tombstone, None
+            if entry[0] == _TOMBSTONE:
+                if tombstone is None:
+                    tombstone = offset
+            elif victim is None or entry[1] < victim_stamp:
+                victim, victim_stamp = offset, entry[1]
+        return victim if tombstone is None else tombstone, None
+
+    def _acquire(self):
+        if not self._lock.acquire(timeout=SharedTable.LOCK_TIMEOUT):
+            # Only a process that died while holding it could keep it this long.
+            raise SharedTableError("Timed out waiting for the shared table lock.")
+
+    def get(self, key: str) -> Optional[Values]:
+        """The values of the key, or None."""
+        key_hash = self._hash(key)
+        self._acquire()
+        try:
+            _, entry = self._find(key_hash)
+        finally:
+            self._lock.release()
+        return None if entry is None else entry[2:]
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[Tuple[Values, float]]]:
+        """The values of each key and the seconds since they were last updated, or None, read under a single lock."""
+        key_hashes = [self._hash(key) for key in keys]
+        self._acquire()
+        try:
+            entries = [self._find(key_hash)[1] for key_hash in key_hashes]
+        finally:
+            self._lock.release()
+        now = time.monotonic()
+        return [None if entry is None else (entry[2:], now - entry[1]) for entry in entries]
+
+    def update(self, key: str, updater: Updater) -> R:
+        """Atomically replaces the values of a key.
+
+        :param updater:
+            Called with the current values, or None, and the seconds since they were last updated; returns the new
+            values and a result.
+        :returns: The result of updater.
+        :raises SharedTableError:
+            The lock could not be acquired.
+        """
+        key_hash = self._hash(key)
+        now = time.monotonic()
+        self._acquire()
+        try:
+            offset, entry = self._find(key_hash)
+            values, result = updater(None if entry is None else entry[2:], 0.0 if entry is None else now - entry[1])
+            self._record.pack_into(self._memory, offset, key_hash, now, *values)
+        finally:
+            self._lock.release()
+        return result
+
+    def delete(self, key: str):
+        key_hash = self._hash(key)
+        self._acquire()
+        try:
+            offset, entry = self._find(key_hash)
+            if entry is not None:
+                self._memory[offset : offset + self._record.size] = bytes(self._record.size)
+                struct.pack_into("=Q", self._memory, offset, _TOMBSTONE)
+        finally:
+            self._lock.release()
+
+
+class TokenBuckets:
+    """Token buckets by key in a SharedTable. A key that isn't in the table, or was evicted, has a full bucket."""
+
+    def __init__(self, slots: int):
+        self._table = SharedTable(slots, "d")
+
+    def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        """Takes cost tokens from the key's bucket, which holds up to burst tokens and refills at rate per second.
+
+        :returns: 0 if the tokens were taken, otherwise the seconds until there are enough.
+        """
+
+        def updater(values, elapsed):
+            tokens = burst if values is None else min(burst, values[0] + elapsed * rate)
+            if tokens >= cost:
+                return (tokens - cost,), 0.0
+            return (tokens,), (cost - tokens) / rate
+
+        return self._table.update(key, updater)
+
+
+class DecayingCounters:
+    """Counters by key in a SharedTable that halve every half_life seconds, e.g. an estimate of the sessions still open
+    on each host. A key that isn't in the table, or was evicted, counts 0.
+    """
+
+    def __init__(self, slots: int, half_life: float):
+        """
+        :raises ValueError:
+            half_life or slots is not positive.
+        """
+        if half_life <= 0:
+            raise ValueError("half_life must be positive.")
+        self._table = SharedTable(slots, "d")
+        self._half_life = half_life
+
+    def _decayed(self, value: float, elapsed: float) -> float:
+        return value * 0.5 ** (elapsed / self._half_life)
+
+    def add(self, key: str, amount: float = 1.0) -> float:
+        """Adds amount to the counter of key.
+
+        :returns: The new count.
+        """
+
+        def updater(values, elapsed):
+            count = amount if values is None else self._decayed(values[0], elapsed) + amount
+            return (count,), count
+
+        return self._table.update(key, updater)
+
+    def get_many(self, keys: Sequence[str]) -> List[float]:
+        return [0.0 if entry is None else self._decayed(entry[0][0], entry[1]) for entry in self._table.get_many(keys)]
@@ -0,0 +1,135 @@
+import logging
+import socket
+import ssl
+from typing import Optional
+
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPSConnection
+from urllib3.connectionpool import HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NewConnectionError
+
+from .metrics import Metrics, metrics as default_metrics
+from .resolver import CachingResolver
+
+logger = logging.getLogger(__name__)
+
+
+class _ResumableSSLSocket(ssl.SSLSocket):
+    def close(self):
+        # With TLS 1.3 the session ticket arrives after the handshake, the session is only worth keeping by now.
+        remember = getattr(self.context, "remember_session", None)
+        if remember is not None:
+            remember(self)
+        super().close()
+
+
+class ResumingSSLContext(ssl.SSLContext):
+    """A client SSLContext that offers each host the TLS session of its last connection to it, so reconnecting to an
+    agent skips the full handshake and the certificate checks. The sessions are only valid in this process.
+    """
+
+    sslsocket_class = _ResumableSSLSocket
+    MAX_SESSIONS = 4096
+
+    def __init__(self, protocol=ssl.PROTOCOL_TLS_CLIENT, metrics: Metrics = default_metrics):
+        super().__init__()
+        self._sessions = {}
+        self._metrics = metrics
+
+    def wrap_socket(self, sock, *args, server_hostname=None, session=None, **kwargs):
+        if session is None and server_hostname:
+            session = self._sessions.get(server_hostname)
+        ssl_sock = super().wrap_socket(sock, *args, server_hostname=server_hostname, session=session, **kwargs)
+        if ssl_sock.session_reused:
+            self._metrics.inc("agent.tls.resumed")
+        else:
+            self._metrics.inc("agent.tls.handshakes")
+        self.remember_session(ssl_sock)
+        return ssl_sock
+
+    def remember_session(self, ssl_sock: ssl.SSLSocket):
+        try:
+            session = ssl_sock.session
+        except (OSError, ValueError):
+            return
+        if session is None or not ssl_sock.server_hostname:
+            return
+        if len(self._sessions) >= ResumingSSLContext.MAX_SESSIONS and ssl_sock.server_hostname not in self._sessions:
+            self._sessions.clear()
+        self._sessions[ssl_sock.server_hostname] = session
+
+
+def create_agent_ssl_context(verify: bool, ca_bundle: str = "", metrics: Metrics = default_metrics) -> ResumingSSLContext:
+    """The SSLContext to call the agents with.
+
+    :param verify:
+        Whether to verify the certificates of the agents, and their hostnames.
+    :param ca_bundle:
+        A PEM file with the certificates to trust, the CAs that signed the agent certificates or the agent certificates
+        themselves; the system CAs if empty.
+    :raises OSError:
+        The bundle could not be read.
+    :raises ssl.SSLError:
+        The bundle is invalid.
+    """
+    context = ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT, metrics=metrics)
+    if verify:
+        if ca_bundle:
+            context.load_verify_locations(ca_bundle)
+        else:
+            context.load_default_certs()
+    else:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+class _ResolvingHTTPSConnection(HTTPSConnection):
+    resolver: CachingResolver = None
+
+    def _new_conn(self):
+        """Connects to each address of the host in turn, like socket.create_connection, until one answers."""
+        hostname = self._dns_host
+        try:
+            addresses = self.resolver.resolve(hostname)
+        except socket.gaierror as e:
+            raise NewConnectionError(self, "Failed to establish a new connection: {}".format(e))
+        error = None
+        try:
+            for address in addresses:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except (NewConnectionError, ConnectTimeoutError) as e:
+                    logger.warning("Failed to connect to %s at %s: %s", hostname, address, e)
+                    error = e
+        finally:
+            # host is _dns_host, and SNI and the certificate check must still use the hostname.
+            self._dns_host = hostname
+        raise error
+
+
+class AgentAdapter(HTTPAdapter):
+    """A requests adapter that connects with the given SSLContext, which alone decides how certificates are checked, and
+    looks the hosts up through the resolver, if given.
+    """
+
+    def __init__(self, ssl_context: ssl.SSLContext, resolver: Optional[CachingResolver] = None, **kwargs):
+        self._ssl_context = ssl_context
+        self._resolver = resolver
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["ssl_context"] = self._ssl_context
+        super().init_poolmanager(*args, **kwargs)
+        if self._resolver is not None:
+            connection_cls = type("ResolvingHTTPSConnection", (_ResolvingHTTPSConnection,), {"resolver": self._resolver})
+            pool_cls = type("ResolvingHTTPSConnectionPool", (HTTPSConnectionPool,), {"ConnectionCls": connection_cls})
+            self.poolmanager.pool_classes_by_scheme = dict(self.poolmanager.pool_classes_by_scheme, https=pool_cls)
+
+    def cert_verify(self, conn, url, verify, cert):
+        # requests would have the CA bundle loaded into the context again for every connection.
+        if url.lower().startswith("https"):
+            conn.cert_reqs = "CERT_NONE" if self._ssl_context.verify_mode == ssl.CERT_NONE else "CERT_REQUIRED"
+            conn.ca_certs = None
+            conn.ca_cert_dir = None
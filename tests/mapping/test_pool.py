@@ -0,0 +1,150 @@
+import collections
+import time
+
+import pytest
+
+from interstate_love_song.agent import AgentSession, AllocateSessionStatus
+from interstate_love_song.mapping import MapperStatus, Resource
+from interstate_love_song.plugins import create_plugin_from_settings
+from interstate_love_song.plugins.pool import PoolMapper
+from interstate_love_song.plugins.simple import SimpleMapper, hash_pass
+from interstate_love_song.settings import SettingsError
+
+POOLS = {"render": ["r1.example.com", "r2.example.com", "r3.example.com"]}
+
+
+def _pool_mapper(**kwargs):
+    resources = [Resource("Render node", "render"), Resource("Desk", "desk.example.com")]
+    return PoolMapper(SimpleMapper("noether", hash_pass("Emmy"), resources, ["example.com"]), POOLS, **kwargs)
+
+
+def _allocate(mapper, hostname, status=AllocateSessionStatus.SUCCESSFUL):
+    def allocate_session(resource_id, agent_hostname, *args, **kwargs):
+        return status, AgentSession("1.2.3.4", agent_hostname, 4172, "id", "tag", resource_id)
+
+    mapper.mapper.allocate_session = allocate_session
+    return mapper.allocate_session("0", hostname, "noether", "Emmy", "example.com")
+
+
+def test_pool_mapper_constructor():
+    simple = SimpleMapper("noether", hash_pass("Emmy"), [], [])
+    with pytest.raises(ValueError):
+        PoolMapper("not a mapper", POOLS)
+    with pytest.raises(ValueError):
+        PoolMapper(simple, {"render": []})
+    with pytest.raises(ValueError):
+        PoolMapper(simple, {"render": "r1.example.com"})
+    with pytest.raises(ValueError):
+        PoolMapper(simple, POOLS, half_life=0)
+
+
+def test_pool_mapper_map():
+    mapper = _pool_mapper(slots=64)
+
+    assert mapper.domains == ["example.com"]
+    assert mapper.hostnames == POOLS["render"] + ["desk.example.com"]
+    assert mapper.map(("noether", "Amalie")) == (MapperStatus.AUTHENTICATION_FAILED, {})
+
+    status, resources = mapper.map(("noether", "Emmy"))
+    assert status == MapperStatus.SUCCESS
+    assert resources["0"].name == "Render node"
+    assert resources["0"].hostname in POOLS["render"]
+    assert resources["1"] == Resource("Desk", "desk.example.com")
+
+
+def test_pool_mapper_least_loaded():
+    mapper = _pool_mapper(slots=64)
+
+    for _ in range(3):
+        _allocate(mapper, "r1.example.com")
+    for _ in range(2):
+        _allocate(mapper, "r2.example.com")
+    _allocate(mapper, "r3.example.com", AllocateSessionStatus.FAILED_ANOTHER_SESSION_STARTED)
+
+    assert [round(load) for load in mapper.load(POOLS["render"])] == [3, 2, 0]
+    assert {mapper.map(("noether", "Emmy"))[1]["0"].hostname for _ in range(20)} == {"r3.example.com"}
+
+
+def test_pool_mapper_spreads_equal_loads():
+    mapper = _pool_mapper(slots=64)
+
+    hosts = collections.Counter(mapper.least_loaded("render") for _ in range(300))
+    assert set(hosts) == set(POOLS["render"])
+
+
+def test_pool_mapper_sessions_spread_evenly():
+    mapper = _pool_mapper(slots=64)
+
+    for _ in range(30):
+        _allocate(mapper, mapper.map(("noether", "Emmy"))[1]["0"].hostname)
+
+    assert max(mapper.load(POOLS["render"])) - min(mapper.load(POOLS["render"])) < 2
+
+
+def test_pool_mapper_load_decays():
+    mapper = _pool_mapper(slots=64, half_life=0.05)
+
+    _allocate(mapper, "r1.example.com")
+    time.sleep(0.1)
+    assert mapper.load(["r1.example.com"])[0] <= 0.3
+
+
+def test_pool_mapper_previous_host():
+    mapper = _pool_mapper(slots=64)
+    for _ in range(5):
+        _allocate(mapper, "r2.example.com")
+
+    resource = mapper.map(("noether", "Emmy"), previous_host="r2.example.com")[1]["0"]
+    assert resource.hostname == "r2.example.com"
+    assert len(resource.candidates) == 1 and resource.candidates[0] != "r2.example.com"
+
+
+def test_pool_mapper_candidates():
+    mapper = _pool_mapper(slots=64, fan_out=3)
+    for _ in range(4):
+        _allocate(mapper, "r1.example.com")
+    for _ in range(2):
+        _allocate(mapper, "r3.example.com")
+
+    resource = mapper.map(("noether", "Emmy"))[1]["0"]
+    assert resource.hostname == "r2.example.com"
+    assert resource.candidates == ("r3.example.com", "r1.example.com")
+
+    mapper = _pool_mapper(slots=64, fan_out=1)
+    assert mapper.map(("noether", "Emmy"))[1]["0"].candidates == ()
+    with pytest.raises(ValueError):
+        _pool_mapper(fan_out=0)
+
+
+def test_pool_mapper_from_settings():
+    mapper = create_plugin_from_settings(
+        {
+            "plugin": "PoolMapper",
+            "settings": {
+                "mapper": {
+                    "plugin": "SimpleMapper",
+                    "settings": {
+                        "username": "noether",
+                        "password_hash": hash_pass("Emmy"),
+                        "resources": [{"name": "Render node", "hostname": "render"}],
+                        "domains": [],
+                    },
+                },
+                "pools": POOLS,
+                "slots": 64,
+            },
+        }
+    )
+    assert isinstance(mapper, PoolMapper)
+    assert mapper.map(("noether", "Emmy"))[1]["0"].hostname in POOLS["render"]
+
+    with pytest.raises(SettingsError):
+        PoolMapper.create_from_dict(
+            {
+                "mapper": {
+                    "plugin": "SimpleMapper",
+                    "settings": {"username": "a", "password_hash": "b", "resources": [], "domains": []},
+                },
+                "pools": {"render": []},
+            }
+        )
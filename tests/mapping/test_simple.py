@@ -18,6 +18,7 @@ def test_simple_mapper_constructor():
     assert mapper.password_hash == "123"
     assert list(mapper.resources) == [Resource("kolmogorov", "kolmogorov.ru")]
     assert mapper.domains == ["example.com"]
+    assert mapper.hostnames == ["kolmogorov.ru"]
 
 
 def test_simple_mapper_constructor_accepts_no_resources():
@@ -56,3 +57,14 @@ def test_simple_mapper_map():
 
     assert status == MapperStatus.SUCCESS
     assert hosts == dict((str(k), v) for k, v in enumerate(expected_hosts))
+
+
+def test_simple_mapper_map_previous_host_first():
+    hosts = [Resource(host, host) for host in ("abc.gov", "123.edu", "xyz.org")]
+    mapper = SimpleMapper("Euler", hash_pass("Leonhard"), hosts, [])
+
+    status, resources = mapper.map(("Euler", "Leonhard"), previous_host="123.edu")
+    assert status == MapperStatus.SUCCESS
+    assert list(resources.items()) == [("0", hosts[1]), ("1", hosts[0]), ("2", hosts[2])]
+
+    assert list(mapper.map(("Euler", "Leonhard"), previous_host="gone.net")[1].values()) == hosts
@@ -0,0 +1,170 @@
+import json
+import os
+import time
+
+import pytest
+
+from interstate_love_song.mapping import MapperStatus, Resource
+from interstate_love_song.plugins import create_plugin_from_settings
+from interstate_love_song.plugins.simple import hash_pass
+from interstate_love_song.plugins.userfile import FileMapper, load_user_table, set_user
+from interstate_love_song.settings import SettingsError
+
+
+def _write(path, data, age=0):
+    path.write_text(json.dumps(data))
+    mtime = time.time() - age
+    os.utime(str(path), (mtime, mtime))
+
+
+def _user_file():
+    data = {
+        "groups": {
+            "mathematicians": {
+                "resources": [{"name": "Euler", "hostname": "euler.ch"}, {"name": "Gauss", "hostname": "gauss.de"}]
+            }
+        },
+        "users": {},
+    }
+    set_user(data, "noether", "Emmy", ["mathematicians"])
+    data["users"]["noether"]["resources"] = [
+        {"name": "Hilbert", "hostname": "hilbert.de"},
+        {"name": "Gauss", "hostname": "gauss.de"},
+    ]
+    set_user(data, "hardy", "Godfrey")
+    return data
+
+
+def test_load_user_table():
+    table = load_user_table(_user_file())
+
+    assert set(table) == {"noether", "hardy"}
+    assert list(table["noether"].resources.values()) == [
+        Resource("Euler", "euler.ch"),
+        Resource("Gauss", "gauss.de"),
+        Resource("Hilbert", "hilbert.de"),
+    ]
+    assert table["hardy"].resources == {}
+    assert table["noether"].salt != table["hardy"].salt
+    assert table["noether"].password_hash == hash_pass("Emmy", table["noether"].salt)
+
+    with pytest.raises(SettingsError):
+        load_user_table({"users": {"hardy": {"salt": "x", "password_hash": "y", "groups": ["nope"]}}})
+    with pytest.raises(SettingsError):
+        load_user_table({"users": {"hardy": {"salt": "x"}}})
+
+
+def test_file_mapper_map(tmp_path):
+    path = tmp_path / "users.json"
+    _write(path, _user_file())
+    mapper = FileMapper(str(path), ["example.com"])
+
+    assert mapper.ready
+    assert mapper.users == 2
+    assert mapper.domains == ["example.com"]
+    assert mapper.hostnames == ["euler.ch", "gauss.de", "hilbert.de"]
+
+    status, resources = mapper.map(("noether", "Emmy"))
+    assert status == MapperStatus.SUCCESS
+    assert resources["2"] == Resource("Hilbert", "hilbert.de")
+    resources.clear()
+    assert len(mapper.map(("noether", "Emmy"))[1]) == 3
+    assert list(mapper.map(("noether", "Emmy"), previous_host="hilbert.de")[1].values()) == [
+        Resource("Hilbert", "hilbert.de"),
+        Resource("Euler", "euler.ch"),
+        Resource("Gauss", "gauss.de"),
+    ]
+
+    assert mapper.map(("noether", "Amalie")) == (MapperStatus.AUTHENTICATION_FAILED, {})
+    assert mapper.map(("hardy", "Godfrey")) == (MapperStatus.NO_MACHINE, {})
+    with pytest.raises(ValueError):
+        mapper.map(("hardy", 1729))
+
+
+def test_file_mapper_unknown_user_takes_as_long(tmp_path, monkeypatch):
+    path = tmp_path / "users.json"
+    _write(path, _user_file())
+    mapper = FileMapper(str(path), [])
+
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    assert mapper.map(("ramanujan", "Srinivasa")) == (MapperStatus.AUTHENTICATION_FAILED, {})
+    assert len(sleeps) == 1 and sleeps[0] > 0
+
+
+def _reload(mapper, path, data):
+    """Writes the user file and waits for the mapper to load it, in the background of a call."""
+    _write(path, data)
+    stamp = mapper._stamp
+    deadline = time.monotonic() + 5
+    while mapper._stamp == stamp and time.monotonic() < deadline:
+        mapper.map(("nobody", ""))
+        time.sleep(0.01)
+
+
+def test_file_mapper_reload(tmp_path):
+    path = tmp_path / "users.json"
+    data = _user_file()
+    _write(path, data, age=10)
+    mapper = FileMapper(str(path), [], reload_interval=0)
+
+    set_user(data, "ramanujan", "Srinivasa")
+    _reload(mapper, path, data)
+    assert mapper.map(("ramanujan", "Srinivasa")) == (MapperStatus.NO_MACHINE, {})
+    assert mapper.users == 3
+
+    # A broken file leaves the users we have.
+    path.write_text("{")
+    mapper.map(("ramanujan", "Srinivasa"))
+    assert mapper.map(("ramanujan", "Srinivasa")) == (MapperStatus.NO_MACHINE, {})
+
+
+def test_file_mapper_reload_builds_only_changed_users(tmp_path):
+    path = tmp_path / "users.json"
+    data = _user_file()
+    set_user(data, "ramanujan", "Srinivasa", ["mathematicians"])
+    _write(path, data, age=10)
+    mapper = FileMapper(str(path), [], reload_interval=0)
+    before = dict(mapper._users)
+
+    set_user(data, "hardy", "Harold")
+    _reload(mapper, path, data)
+    assert mapper._users["hardy"] is not before["hardy"]
+    assert mapper._users["noether"] is before["noether"]
+    assert mapper._users["ramanujan"] is before["ramanujan"]
+    assert mapper.map(("hardy", "Harold")) == (MapperStatus.NO_MACHINE, {})
+
+    # A changed group changes its users, and only them.
+    hardy = mapper._users["hardy"]
+    data["groups"]["mathematicians"]["resources"].append({"name": "Riemann", "hostname": "riemann.de"})
+    _reload(mapper, path, data)
+    assert mapper._users["hardy"] is hardy
+    assert Resource("Riemann", "riemann.de") in mapper.map(("noether", "Emmy"))[1].values()
+    assert Resource("Riemann", "riemann.de") in mapper.map(("ramanujan", "Srinivasa"))[1].values()
+
+    # A group still in use gone fails the load, the users we have stay.
+    del data["groups"]["mathematicians"]
+    _write(path, data)
+    with mapper._reload_lock:
+        mapper._reload()
+    assert mapper.users == 3
+    assert mapper.map(("noether", "Emmy"))[0] == MapperStatus.SUCCESS
+
+
+def test_file_mapper_missing_file(tmp_path):
+    mapper = FileMapper(str(tmp_path / "users.json"), [], reload_interval=0)
+    assert not mapper.ready
+    assert mapper.map(("hardy", "Godfrey")) == (MapperStatus.INTERNAL_ERROR, {})
+
+    _write(tmp_path / "users.json", _user_file())
+    assert mapper.map(("hardy", "Godfrey")) == (MapperStatus.NO_MACHINE, {})
+    assert mapper.ready
+
+
+def test_file_mapper_from_settings(tmp_path):
+    path = tmp_path / "users.json"
+    _write(path, _user_file())
+    mapper = create_plugin_from_settings({"plugin": "FileMapper", "settings": {"path": str(path), "domains": ["example.com"]}})
+
+    assert isinstance(mapper, FileMapper)
+    assert mapper.map(("hardy", "Godfrey"))[0] == MapperStatus.NO_MACHINE
@@ -0,0 +1,48 @@
+from interstate_love_song.admission import AdmissionController, peek_request
+from interstate_love_song.metrics import Metrics
+from interstate_love_song.settings import RateLimitSettings
+
+from .test_http import HELLO_XML, AUTHENTICATE_XML, BYE_XML
+
+
+def test_peek_request():
+    assert peek_request(HELLO_XML.format("Gauss").encode("utf-8")) == b"hello"
+    assert peek_request(AUTHENTICATE_XML.encode("utf-8")) == b"authenticate"
+    assert peek_request(BYE_XML.encode("utf-8")) == b"bye"
+    assert peek_request(b"<hello-resp/>") is None
+    assert peek_request(b" " * 2048 + b"<hello/>") is None
+
+
+def test_admission_controller_budgets():
+    metrics = Metrics()
+    controller = AdmissionController(
+        RateLimitSettings(
+            client_cheap_rate=0.01, client_cheap_burst=3, client_expensive_rate=0.01, client_expensive_burst=1, slots=64
+        ),
+        metrics,
+    )
+    hello, authenticate = HELLO_XML.format("Gauss").encode("utf-8"), AUTHENTICATE_XML.encode("utf-8")
+
+    assert controller.admit_client("10.0.0.1", authenticate) == 0
+    assert controller.admit_client("10.0.0.1", authenticate) > 0
+    # The cheap budget is separate, and so is every address.
+    assert all(controller.admit_client("10.0.0.1", hello) == 0 for _ in range(3))
+    assert controller.admit_client("10.0.0.1", hello) > 0
+    assert controller.admit_client("10.0.0.2", authenticate) == 0
+    assert metrics.get("admission.rejected.client") == 2
+
+
+def test_admission_controller_users():
+    metrics = Metrics()
+    controller = AdmissionController(RateLimitSettings(user_rate=0.01, user_burst=2, slots=64), metrics)
+
+    assert controller.admit_user("noether") == 0
+    assert controller.admit_user("noether") == 0
+    assert controller.admit_user("noether") > 0
+    assert controller.admit_user("hilbert") == 0
+    assert metrics.get("admission.rejected.user") == 1
+
+
+def test_admission_controller_zero_rate_is_off():
+    controller = AdmissionController(RateLimitSettings(client_expensive_rate=0, client_expensive_burst=0, slots=64))
+    assert all(controller.admit_client("10.0.0.1", AUTHENTICATE_XML.encode("utf-8")) == 0 for _ in range(100))
@@ -0,0 +1,87 @@
+import multiprocessing
+import time
+
+from interstate_love_song.affinity import HostAffinity, MAX_HOSTNAME_BYTES
+from interstate_love_song.metrics import Metrics
+from .test_shared import _colliding_keys
+
+
+def test_host_affinity():
+    metrics = Metrics()
+    affinity = HostAffinity(slots=64, metrics=metrics)
+
+    assert affinity.recall("noether") is None
+    affinity.remember("noether", "hilbert.de")
+    affinity.remember("hardy", "trinity.ac.uk")
+    assert affinity.recall("noether") == "hilbert.de"
+    assert affinity.recall("hardy") == "trinity.ac.uk"
+    assert metrics.get("affinity.recalled") == 2
+
+    affinity.remember("noether", "göttingen.de")
+    assert affinity.recall("noether") == "göttingen.de"
+
+    affinity.forget("noether")
+    assert affinity.recall("noether") is None
+
+
+def test_host_affinity_forget_keeps_other_users():
+    affinity = HostAffinity(slots=16, metrics=Metrics())
+    # Users whose entries probe the same slots, each past the one before.
+    users = _colliding_keys(affinity._table, 3)
+    for user in users:
+        affinity.remember(user, "{}.de".format(user))
+
+    affinity.forget(users[1])
+
+    assert affinity.recall(users[1]) is None
+    assert affinity.recall(users[0]) == "{}.de".format(users[0])
+    assert affinity.recall(users[2]) == "{}.de".format(users[2])
+
+
+def test_host_affinity_stranded():
+    metrics = Metrics()
+    affinity = HostAffinity(ttl=60, slots=64, metrics=metrics, stranded_ttl=0.05)
+
+    affinity.remember("noether", "hilbert.de")
+    affinity.strand("noether", "klein.de")
+
+    # Kept apart from the host the user was allocated.
+    assert affinity.stranded("noether") == "klein.de"
+    assert affinity.recall("noether") == "hilbert.de"
+    assert affinity.stranded("hardy") is None
+    assert metrics.get("affinity.recalled") == 1
+
+    time.sleep(0.1)
+    assert affinity.stranded("noether") is None
+    assert affinity.recall("noether") == "hilbert.de"
+
+
+def test_host_affinity_expires():
+    affinity = HostAffinity(ttl=0.05, slots=64, metrics=Metrics())
+
+    affinity.remember("noether", "hilbert.de")
+    time.sleep(0.1)
+    assert affinity.recall("noether") is None
+
+
+def test_host_affinity_ignores_long_hostnames():
+    affinity = HostAffinity(slots=64, metrics=Metrics())
+
+    affinity.remember("noether", "a" * (MAX_HOSTNAME_BYTES + 1))
+    assert affinity.recall("noether") is None
+    affinity.remember("noether", "a" * MAX_HOSTNAME_BYTES)
+    assert affinity.recall("noether") == "a" * MAX_HOSTNAME_BYTES
+
+
+def _remember(affinity):
+    affinity.remember("ramanujan", "madras.in")
+
+
+def test_host_affinity_is_shared_after_fork():
+    affinity = HostAffinity(slots=64, metrics=Metrics())
+    context = multiprocessing.get_context("fork")
+    child = context.Process(target=_remember, args=(affinity,))
+    child.start()
+    child.join()
+
+    assert affinity.recall("ramanujan") == "madras.in"
@@ -1,8 +1,24 @@
+import threading
+import time
+from io import BytesIO
+from xml.etree.ElementTree import Element, SubElement, ElementTree
+
 import pytest
 import httpretty
 from xmldiff.main import diff_texts
 
-from interstate_love_song.agent import allocate_session, AllocateSessionStatus
+from defusedxml import DefusedXmlException
+
+from interstate_love_song.agent import (
+    allocate_session,
+    AllocateSessionStatus,
+    AllocationLimiter,
+    AllocationCoalescer,
+    AgentSession,
+    build_launch_session_request,
+    parse_launch_session_response,
+)
+from interstate_love_song.metrics import Metrics
 
 
 @httpretty.activate
@@ -142,3 +158,339 @@ def test_allocate_session_already_in_use():
     )
 
     assert status == AllocateSessionStatus.FAILED_ANOTHER_SESSION_STARTED
+
+
+def _build_launch_session_with_elementtree(agent_hostname, username, password, domain, client_name, session_type):
+    """The request as allocate_session used to build it."""
+    pcoip_agent = Element("pcoip-agent", version="1.0")
+    launch_session = SubElement(pcoip_agent, "launch-session")
+    for tag, text in [("session-type", session_type), ("ip-address", "127.0.0.1"), ("hostname", agent_hostname)]:
+        SubElement(launch_session, tag).text = text
+    logon = SubElement(launch_session, "logon", method="windows-password")
+    SubElement(logon, "username").text = username
+    SubElement(logon, "password").text = password
+    SubElement(logon, "domain").text = domain
+    for tag, text in [
+        ("client-mac", ""),
+        ("client-ip", ""),
+        ("client-name", client_name),
+        ("license-path", ""),
+        ("session-log-id", ""),
+    ]:
+        SubElement(launch_session, tag).text = text
+
+    body = BytesIO()
+    ElementTree(pcoip_agent).write(body, encoding="utf-8", xml_declaration=True)
+    return body.getvalue()
+
+
+_AWKWARD_TEXTS = ["", None, "Paul", "a&b", "<tag>", "]]>", "\"quoted\" 'single'", "&amp;", "Ünïcødé ☃ 🐍", "\ud800", " spaced \n"]
+
+
+@pytest.mark.parametrize("text", _AWKWARD_TEXTS)
+def test_build_launch_session_request_matches_elementtree(text):
+    for args in [
+        ("euler.edu", text, "Dirac", "bourbaki.org", "WOPR", "UNSPECIFIED"),
+        ("euler.edu", "Paul", text, "bourbaki.org", "WOPR", "UNSPECIFIED"),
+        ("euler.edu", "Paul", "Dirac", text, "WOPR", "UNSPECIFIED"),
+        ("euler.edu", "Paul", "Dirac", "bourbaki.org", text, "UNSPECIFIED"),
+        (text, "Paul", "Dirac", "bourbaki.org", "WOPR", text),
+        (text, text, text, text, text, text),
+    ]:
+        assert build_launch_session_request(*args) == _build_launch_session_with_elementtree(*args)
+
+
+def test_build_launch_session_request_rejects_non_strings():
+    with pytest.raises(TypeError):
+        _build_launch_session_with_elementtree("euler.edu", 1, "Dirac", "bourbaki.org", "WOPR", "UNSPECIFIED")
+    with pytest.raises(TypeError):
+        build_launch_session_request("euler.edu", 1, "Dirac", "bourbaki.org", "WOPR", "UNSPECIFIED")
+
+
+_SUCCESSFUL_RESPONSE = b"""<?xml version="1.0"?>
+<pcoip-agent version="1.0">
+  <launch-session-resp>
+    <result-id>SUCCESSFUL</result-id>
+    <session-info>
+      <ip-address>1.2.3.4</ip-address>
+      <sni>euler.edu</sni>
+      <port>60443</port>
+      <session-id>Session-Id</session-id>
+      <session-tag>Session-Tag</session-tag>
+    </session-info>
+  </launch-session-resp>
+</pcoip-agent>"""
+
+
+def test_parse_launch_session_response():
+    status, session = parse_launch_session_response(_SUCCESSFUL_RESPONSE, "7")
+    assert status == AllocateSessionStatus.SUCCESSFUL
+    assert session == AgentSession("1.2.3.4", "euler.edu", 60443, "Session-Id", "Session-Tag", "7")
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"<pcoip-agent/>",
+        b"<pcoip-agent><launch-session-resp><result-id>SUCCESSFUL</result-id></launch-session-resp></pcoip-agent>",
+        _SUCCESSFUL_RESPONSE.replace(b"<sni>euler.edu</sni>", b""),
+        _SUCCESSFUL_RESPONSE.replace(b"60443", b"port"),
+        # Misplaced, session-info is not inside launch-session-resp.
+        _SUCCESSFUL_RESPONSE.replace(b"<launch-session-resp>", b"").replace(b"</launch-session-resp>", b""),
+        b"<pcoip-agent><launch-session-resp><result-id>NOT_A_RESULT</result-id></launch-session-resp></pcoip-agent>",
+    ],
+)
+def test_parse_launch_session_response_invalid(body):
+    assert parse_launch_session_response(body, "7") == (AllocateSessionStatus.XML_ERROR, None)
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'<?xml version="1.0"?><!DOCTYPE a [<!ENTITY a "aaaa">]><pcoip-agent>&a;</pcoip-agent>',
+        b'<?xml version="1.0"?><!DOCTYPE a SYSTEM "file:///etc/passwd"><pcoip-agent/>',
+    ],
+)
+def test_parse_launch_session_response_forbidden(body):
+    with pytest.raises(DefusedXmlException):
+        parse_launch_session_response(body, "7")
+
+
+@httpretty.activate
+@pytest.mark.parametrize(
+    "body",
+    [
+        b'<?xml version="1.0"?><!DOCTYPE lol [<!ENTITY lol "lol"><!ENTITY lol2 "&lol;&lol;">]><pcoip-agent>&lol2;</pcoip-agent>',
+        b"<pcoip-agent><launch-session-resp>",
+    ],
+)
+def test_allocate_session_bad_xml(body):
+    httpretty.register_uri(httpretty.POST, "https://euler.edu:60443/pcoip-agent/xml", status=200, body=body)
+
+    status, result = allocate_session("123", "euler.edu", username="Paul", password="Dirac", domain="bourbaki.org")
+
+    assert status == AllocateSessionStatus.XML_ERROR
+    assert result is None
+
+
+@httpretty.activate
+def test_allocate_session_response_too_large():
+    padding = b"<!--" + b"x" * 1000 + b"-->"
+    httpretty.register_uri(
+        httpretty.POST,
+        "https://euler.edu:60443/pcoip-agent/xml",
+        status=200,
+        body=_SUCCESSFUL_RESPONSE.replace(b"<pcoip-agent", padding + b"<pcoip-agent"),
+    )
+
+    status, result = allocate_session(
+        "123", "euler.edu", username="Paul", password="Dirac", domain="bourbaki.org", max_response_bytes=1000
+    )
+    assert status == AllocateSessionStatus.ENDPOINT_ERROR
+    assert result is None
+
+    status, result = allocate_session("123", "euler.edu", username="Paul", password="Dirac", domain="bourbaki.org")
+    assert status == AllocateSessionStatus.SUCCESSFUL
+
+
+def _run_allocations(limited, hosts):
+    results = [None] * len(hosts)
+
+    def run(i, host):
+        results[i] = limited("0", host, "Paul", "Dirac", "example.com")[0]
+
+    threads = [threading.Thread(target=run, args=(i, host)) for i, host in enumerate(hosts)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_allocation_limiter_constructor():
+    with pytest.raises(ValueError):
+        AllocationLimiter(max_concurrent=0)
+    with pytest.raises(ValueError):
+        AllocationLimiter(max_per_host=0)
+
+
+def test_allocation_limiter_per_host():
+    release = threading.Event()
+    calls = []
+
+    def slow_allocate(resource_id, agent_hostname, *args):
+        calls.append(agent_hostname)
+        if agent_hostname == "slow.edu":
+            release.wait(5)
+        return AllocateSessionStatus.SUCCESSFUL, None
+
+    metrics = Metrics()
+    limiter = AllocationLimiter(max_concurrent=4, max_per_host=2, max_waiting_per_host=1, max_wait=5, metrics=metrics)
+    limited = limiter.limit(slow_allocate)
+
+    threads, results = _run_allocations(limited, ["slow.edu"] * 4)
+    deadline = time.time() + 5
+    while limiter.waiting < 1 and time.time() < deadline:
+        time.sleep(0.01)
+
+    # Two calls are in progress on the slow host, one waits and one was turned away; other hosts are unaffected.
+    assert limiter.active == 2
+    assert limiter.waiting == 1
+    assert limited("0", "fast.edu", "Paul", "Dirac", "example.com")[0] == AllocateSessionStatus.SUCCESSFUL
+
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert sorted(results, key=lambda status: status.value) == [AllocateSessionStatus.SUCCESSFUL] * 3 + [
+        AllocateSessionStatus.OVERLOADED
+    ]
+    assert calls.count("slow.edu") == 3
+    assert limiter.active == 0 and limiter.waiting == 0
+    assert metrics.get("agent.allocations.rejected") == 1
+    assert metrics.get("agent.allocations.waited") == 1
+    assert metrics.get("agent.allocations.wait_seconds") > 0
+
+
+def test_allocation_limiter_wait_timeout():
+    release = threading.Event()
+
+    def slow_allocate(*args):
+        release.wait(5)
+        return AllocateSessionStatus.SUCCESSFUL, None
+
+    limiter = AllocationLimiter(max_concurrent=1, max_waiting=1, max_wait=0.05, metrics=Metrics())
+    limited = limiter.limit(slow_allocate)
+
+    first, first_results = _run_allocations(limited, ["euler.edu"])
+    deadline = time.time() + 5
+    while limiter.active < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    assert limited("0", "gauss.de", "Paul", "Dirac", "example.com")[0] == AllocateSessionStatus.OVERLOADED
+    release.set()
+    first[0].join()
+
+    assert first_results == [AllocateSessionStatus.SUCCESSFUL]
+    assert not limiter.saturated
+
+
+class _CountingAgent:
+    def __init__(self, status=AllocateSessionStatus.SUCCESSFUL):
+        self.status = status
+        self.calls = 0
+        self.release = threading.Event()
+
+    def __call__(self, resource_id, agent_hostname, username, password, domain, **kwargs):
+        self.calls += 1
+        self.release.wait(5)
+        session = AgentSession("1.2.3.4", agent_hostname, 4172, "Session-{}".format(self.calls), "Tag", resource_id)
+        return self.status, session if self.status == AllocateSessionStatus.SUCCESSFUL else None
+
+
+def test_allocation_coalescer_shares_call_in_progress():
+    metrics = Metrics()
+    coalescer = AllocationCoalescer(result_ttl=0, metrics=metrics)
+    agent = _CountingAgent()
+    coalesced = coalescer.coalesce(agent)
+
+    threads, results = _run_allocations(coalesced, ["euler.edu"] * 4)
+    deadline = time.time() + 5
+    while metrics.get("agent.allocations.coalesced") < 3 and time.time() < deadline:
+        time.sleep(0.01)
+    agent.release.set()
+    for thread in threads:
+        thread.join()
+
+    assert agent.calls == 1
+    assert results == [AllocateSessionStatus.SUCCESSFUL] * 4
+    assert metrics.get("agent.allocations.coalesced") == 3
+    assert coalescer.in_flight == 0
+
+    # Nothing kept with result_ttl=0.
+    coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")
+    assert agent.calls == 2
+
+
+def test_allocation_coalescer_keys():
+    agent = _CountingAgent()
+    agent.release.set()
+    coalesced = AllocationCoalescer(result_ttl=60, metrics=Metrics()).coalesce(agent)
+
+    first = coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")
+    assert coalesced("0", "euler.edu", "Paul", "Dirac", "example.com") == first
+    assert agent.calls == 1
+
+    for args in [
+        ("1", "euler.edu", "Paul", "Dirac", "example.com"),
+        ("0", "gauss.de", "Paul", "Dirac", "example.com"),
+        ("0", "euler.edu", "Werner", "Dirac", "example.com"),
+        ("0", "euler.edu", "Paul", "Heisenberg", "example.com"),
+        ("0", "euler.edu", "Paul", "Dirac", "example.org"),
+    ]:
+        assert coalesced(*args)[1].session_id != first[1].session_id
+    assert agent.calls == 6
+
+    # Another login of the same user.
+    login = coalesced("0", "euler.edu", "Paul", "Dirac", "example.com", client_session_id="Bohr")
+    assert login[1].session_id != first[1].session_id
+    assert coalesced("0", "euler.edu", "Paul", "Dirac", "example.com", client_session_id="Bohr") == login
+    assert agent.calls == 7
+
+
+def test_allocation_coalescer_result_ttl():
+    agent = _CountingAgent()
+    agent.release.set()
+    coalescer = AllocationCoalescer(result_ttl=0.05, metrics=Metrics())
+    coalesced = coalescer.coalesce(agent)
+
+    coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")
+    coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")
+    assert agent.calls == 1
+    time.sleep(0.1)
+    coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")
+    assert agent.calls == 2
+    assert coalescer.in_flight == 1
+
+
+def test_allocation_coalescer_does_not_keep_failures():
+    agent = _CountingAgent(AllocateSessionStatus.CONNECTION_ERROR)
+    agent.release.set()
+    coalescer = AllocationCoalescer(result_ttl=60, metrics=Metrics())
+    coalesced = coalescer.coalesce(agent)
+
+    assert coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")[0] == AllocateSessionStatus.CONNECTION_ERROR
+    coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")
+    assert agent.calls == 2
+    assert coalescer.in_flight == 0
+
+
+def test_allocation_coalescer_shares_errors():
+    release = threading.Event()
+    calls = []
+
+    def failing(*args):
+        calls.append(args)
+        release.wait(5)
+        raise RuntimeError("agent exploded")
+
+    metrics = Metrics()
+    coalescer = AllocationCoalescer(metrics=metrics)
+    coalesced = coalescer.coalesce(failing)
+    errors = []
+
+    def run():
+        try:
+            coalesced("0", "euler.edu", "Paul", "Dirac", "example.com")
+        except RuntimeError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    deadline = time.time() + 5
+    while metrics.get("agent.allocations.coalesced") < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert len(errors) == 2
+    assert coalescer.in_flight == 0
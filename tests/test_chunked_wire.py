@@ -0,0 +1,100 @@
+"""Runs the broker on the real servers and checks the responses go out with chunked transfer encoding, which the
+PCoIP client insists on.
+"""
+import importlib
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+from .test_http import HELLO_XML
+
+SERVER_SCRIPT = """
+import sys
+
+from interstate_love_song.__main__ import gunicorn_runner, cherrypy_runner
+from interstate_love_song.http import get_falcon_api, BrokerResource, standard_protocol_creator
+from interstate_love_song.settings import DefaultMapper
+
+server, port = sys.argv[1], int(sys.argv[2])
+wsgi = get_falcon_api(BrokerResource(standard_protocol_creator(DefaultMapper.create_mapper())))
+if server == "gunicorn":
+    gunicorn_runner(wsgi, "127.0.0.1", port, None, None, no_ssl=True, worker_class="sync", workers=1)
+else:
+    cherrypy_runner(wsgi, "127.0.0.1", port, None, None, no_ssl=True)
+"""
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _post(port: int, body: bytes) -> bytes:
+    request = (
+        b"POST /pcoip-broker/xml HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n"
+        b"Content-Type: text/xml\r\nContent-Length: %d\r\n\r\n%s" % (len(body), body)
+    )
+    with socket.create_connection(("127.0.0.1", port), timeout=10) as s:
+        s.sendall(request)
+        response = b""
+        while True:
+            data = s.recv(65536)
+            if not data:
+                return response
+            response += data
+
+
+def _dechunk(body: bytes) -> bytes:
+    chunks = []
+    while True:
+        size, _, body = body.partition(b"\r\n")
+        size = int(size.split(b";")[0], 16)
+        if size == 0:
+            return b"".join(chunks)
+        chunks.append(body[:size])
+        assert body[size : size + 2] == b"\r\n"
+        body = body[size + 2 :]
+
+
+@pytest.mark.parametrize("server", ["gunicorn", "cherrypy"])
+def test_responses_are_chunked(server, tmp_path):
+    if os.environ.get("CI"):
+        # CI installs both servers, a skip there would hide that the test no longer runs.
+        importlib.import_module(server)
+    else:
+        pytest.importorskip(server)
+    port = _free_port()
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    process = subprocess.Popen(
+        [sys.executable, "-c", SERVER_SCRIPT, server, str(port)],
+        cwd=str(tmp_path),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        deadline = time.time() + 20
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                assert process.poll() is None and time.time() < deadline, "The server didn't start."
+                time.sleep(0.1)
+
+        response = _post(port, HELLO_XML.format("QueryBrokerClient").encode("utf-8"))
+    finally:
+        process.terminate()
+        process.wait(10)
+
+    head, _, body = response.partition(b"\r\n\r\n")
+    headers = head.lower().split(b"\r\n")
+    assert headers[0].startswith(b"http/1.1 200")
+    assert b"transfer-encoding: chunked" in headers
+    assert not any(header.startswith(b"content-length:") for header in headers)
+    assert _dechunk(body).startswith(b"<?xml version='1.0' encoding='utf-8'?>\n<pcoip-client")
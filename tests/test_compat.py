@@ -0,0 +1,51 @@
+import sys
+import threading
+import time
+
+import pytest
+
+from interstate_love_song import compat
+from interstate_love_song.compat import cooperative_timeout, spawn
+
+
+def test_cooperative_timeout_without_monkey_patching():
+    with cooperative_timeout(0.001):
+        time.sleep(0.01)
+
+
+def test_cooperative_timeout_on_gevent(monkeypatch):
+    gevent = pytest.importorskip("gevent")
+    monkeypatch.setattr("gevent.monkey.is_module_patched", lambda module: True)
+
+    with pytest.raises(TimeoutError):
+        with cooperative_timeout(0.01):
+            gevent.sleep(1)
+
+
+def test_compat_without_gevent_doesnt_import_per_call(monkeypatch):
+    lookups = []
+
+    class NoGevent:
+        """A finder for a path without gevent on it."""
+
+        @staticmethod
+        def find_spec(name, path=None, target=None):
+            if name.split(".")[0] == "gevent":
+                lookups.append(name)
+                raise ModuleNotFoundError(name)
+            return None
+
+    monkeypatch.setattr(compat, "gevent", None)
+    monkeypatch.setattr(compat, "monkey", None)
+    for name in [name for name in sys.modules if name.split(".")[0] == "gevent"]:
+        monkeypatch.delitem(sys.modules, name)
+    monkeypatch.setattr(sys, "meta_path", [NoGevent()] + sys.meta_path)
+
+    called = threading.Event()
+    for _ in range(10):
+        with cooperative_timeout(0.01):
+            pass
+        spawn(called.set)
+
+    assert called.wait(5)
+    assert lookups == []
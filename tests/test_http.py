@@ -1,14 +1,35 @@
+import gc
+import os
+import sqlite3
+import time
+import tracemalloc
 from argparse import Namespace
+from io import BytesIO
 from typing import Optional
 from xml.etree.ElementTree import Element, tostring
 
 import falcon
 import pytest
+from beaker.container import FileNamespaceManager
 from falcon import API
 from falcon.testing import TestClient as FalconTestClient
 
+import interstate_love_song
+from interstate_love_song.agent import AllocateSessionStatus, AgentSession
+from interstate_love_song.mapping import Resource
+from interstate_love_song.session import SQLITE_FILENAME
 from interstate_love_song.protocol import BrokerProtocolHandler, ProtocolState, ProtocolSession
-from interstate_love_song.http import BrokerResource, get_falcon_api, SessionSetter
+from interstate_love_song.http import (
+    BrokerResource,
+    get_falcon_api,
+    SessionSetter,
+    ReadinessResource,
+    HealthResource,
+    PathScopedMiddleware,
+)
+from interstate_love_song.admission import AdmissionController
+from interstate_love_song.metrics import Metrics
+from interstate_love_song.settings import Settings, AdminSettings, BeakerSettings, RateLimitSettings
 from interstate_love_song.transport import HelloResponse, HelloRequest
 from .test_protocol import DummyMapper
 
@@ -20,16 +41,18 @@ def test_broker_resource_constructor():
         BrokerResource(lambda: BrokerProtocolHandler(), serialize=123)
     with pytest.raises(ValueError):
         BrokerResource(lambda: BrokerProtocolHandler(), deserialize=123)
+    with pytest.raises(ValueError):
+        BrokerResource(lambda: BrokerProtocolHandler(), session_setter=lambda req: None)
 
 
 class DummySessionSetter(SessionSetter):
     def __init__(self):
         self.data = None
 
-    def set_data(self, data: Optional[ProtocolSession]):
+    def set_data(self, request, data: Optional[ProtocolSession]):
         self.data = data
 
-    def get_data(self):
+    def get_data(self, request):
         return self.data
 
 
@@ -53,7 +76,7 @@ def test_broker_resource_on_post_sets_session():
 
     api = get_falcon_api(
         BrokerResource(
-            protocol_creator=lambda: dummy_protocol, session_setter_creator=lambda x: session_setter
+            protocol_creator=lambda: dummy_protocol, session_setter=session_setter
         )
     )
     client = FalconTestClient(api)
@@ -75,7 +98,7 @@ def test_broker_resource_on_post_clears_session():
     api = get_falcon_api(
         BrokerResource(
             protocol_creator=lambda: terminate_protocol,
-            session_setter_creator=lambda x: session_setter,
+            session_setter=session_setter,
         )
     )
     client = FalconTestClient(api)
@@ -85,6 +108,37 @@ def test_broker_resource_on_post_clears_session():
     assert session_setter.data is None
 
 
+def test_broker_resource_rejects_large_bodies():
+    metrics = Metrics()
+    resource = BrokerResource(lambda: BrokerProtocolHandler(DummyMapper()), max_body_bytes=64, metrics=metrics)
+    client = FalconTestClient(get_falcon_api(resource))
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=b"<" * 65)
+    assert resp.status == falcon.HTTP_REQUEST_ENTITY_TOO_LARGE
+
+    # Without a Content-Length we find out while reading.
+    with pytest.raises(falcon.HTTPPayloadTooLarge):
+        resource._read_body(Namespace(content_length=None, bounded_stream=BytesIO(b"<" * 10000)))
+    assert metrics.get("http.rejected.too_large") == 2
+
+    assert resource._read_body(Namespace(content_length=None, bounded_stream=BytesIO(b"<" * 64))) == b"<" * 64
+
+
+def test_broker_resource_rejects_slow_bodies():
+    class SlowStream:
+        def read(self, size):
+            time.sleep(0.02)
+            return b"<"
+
+    metrics = Metrics()
+    resource = BrokerResource(lambda: BrokerProtocolHandler(DummyMapper()), read_timeout=0.01, metrics=metrics)
+
+    with pytest.raises(falcon.HTTPError) as e:
+        resource._read_body(Namespace(content_length=None, bounded_stream=SlowStream()))
+    assert e.value.status == falcon.HTTP_REQUEST_TIMEOUT
+    assert metrics.get("http.rejected.timeout") == 1
+
+
 def test_broker_resource_deserializes():
     msg = HelloRequest("euler.lagrange.edu", "Abel")
 
@@ -104,7 +158,7 @@ def test_broker_resource_deserializes():
         BrokerResource(
             protocol_creator=lambda: terminate_protocol,
             deserialize=deserialize,
-            session_setter_creator=lambda x: session_setter,
+            session_setter=session_setter,
         )
     )
     client = FalconTestClient(api)
@@ -140,7 +194,7 @@ def test_broker_resource_serializes():
             protocol_creator=lambda: terminate_protocol,
             deserialize=deserialize,
             serialize=serialize,
-            session_setter_creator=lambda x: session_setter,
+            session_setter=session_setter,
         )
     )
     client = FalconTestClient(api)
@@ -152,6 +206,63 @@ def test_broker_resource_serializes():
     assert check.serialize_called is True
 
 
+def test_broker_resource_builds_pipeline_once():
+    check = Namespace(protocols_created=0, sessions_read=0)
+
+    def protocol_creator():
+        check.protocols_created += 1
+        return lambda msg, data: (None, HelloResponse("lagrange", ["example.com"]))
+
+    class CountingSessionSetter(DummySessionSetter):
+        instances = 0
+
+        def __init__(self):
+            super().__init__()
+            CountingSessionSetter.instances += 1
+
+        def get_data(self, request):
+            check.sessions_read += 1
+            return super().get_data(request)
+
+    api = get_falcon_api(BrokerResource(protocol_creator, session_setter=CountingSessionSetter()))
+    client = FalconTestClient(api)
+
+    for _ in range(10):
+        resp = client.simulate_post("/pcoip-broker/xml", body="<hello/>")
+        assert resp.status == falcon.HTTP_OK
+
+    assert check.sessions_read == 10
+    assert check.protocols_created == 1
+    assert CountingSessionSetter.instances == 1
+
+
+def test_broker_resource_allocations_stay_flat():
+    resource = BrokerResource(
+        lambda: lambda msg, data: (None, HelloResponse("lagrange", ["example.com"])), session_setter=DummySessionSetter()
+    )
+    client = FalconTestClient(get_falcon_api(resource))
+    # Only what the broker's own code allocated, directly or through the libraries it calls.
+    ours = tracemalloc.Filter(True, os.path.join(os.path.dirname(interstate_love_song.__file__), "*"), all_frames=True)
+
+    def post(count):
+        for _ in range(count):
+            assert client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss")).status == falcon.HTTP_OK
+        gc.collect()
+        return sum(trace.count for trace in tracemalloc.take_snapshot().filter_traces([ours]).statistics("filename"))
+
+    tracemalloc.start(32)
+    try:
+        # The first requests fill the caches, of falcon, the logging and the serializers.
+        post(100)
+        before = post(100)
+        after = post(1000)
+    finally:
+        tracemalloc.stop()
+
+    # A request keeps nothing alive once it has been answered: not a block in a hundred requests.
+    assert after - before < 1000 / 100
+
+
 def test_http_get():
     api = get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(DummyMapper())))
     client = FalconTestClient(api)
@@ -159,3 +270,344 @@ def test_http_get():
     resp = client.simulate_get("/pcoip-broker/xml")
 
     assert resp.status == falcon.HTTP_OK
+
+
+def test_http_admin_profile_disabled_by_default():
+    api = get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(DummyMapper())))
+    client = FalconTestClient(api)
+
+    resp = client.simulate_get("/admin/profile")
+
+    assert resp.status == falcon.HTTP_NOT_FOUND
+
+
+def test_http_admin_profile():
+    settings = Settings()
+    settings.admin = AdminSettings(token="ramanujan")
+    api = get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(DummyMapper())), settings)
+    client = FalconTestClient(api)
+
+    resp = client.simulate_get("/admin/profile", params={"seconds": "0.1"})
+    assert resp.status == falcon.HTTP_UNAUTHORIZED
+
+    resp = client.simulate_get("/admin/profile", params={"seconds": "0.1"}, headers={"Authorization": "Bearer hardy"})
+    assert resp.status == falcon.HTTP_UNAUTHORIZED
+
+    resp = client.simulate_get(
+        "/admin/profile", params={"seconds": "0.1", "interval_ms": "1"}, headers={"Authorization": "Bearer ramanujan"}
+    )
+    assert resp.status == falcon.HTTP_OK
+    assert "on_get (http.py:" in resp.text
+
+    resp = client.simulate_get("/admin/profile", params={"seconds": "1000"}, headers={"Authorization": "Bearer ramanujan"})
+    assert resp.status == falcon.HTTP_BAD_REQUEST
+
+
+def test_http_admin_metrics():
+    settings = Settings()
+    settings.admin = AdminSettings(token="ramanujan")
+    client = FalconTestClient(get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(DummyMapper())), settings))
+
+    assert client.simulate_get("/admin/metrics").status == falcon.HTTP_UNAUTHORIZED
+
+    resp = client.simulate_get("/admin/metrics", headers={"Authorization": "Bearer ramanujan"})
+    assert resp.status == falcon.HTTP_OK
+    assert resp.json["pid"] == os.getpid()
+    assert isinstance(resp.json["metrics"], dict)
+
+
+def test_http_healthz_skips_sessions(tmp_path):
+    settings = Settings()
+    settings.beaker = BeakerSettings(data_dir=str(tmp_path))
+    api = get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(DummyMapper())), settings)
+    client = FalconTestClient(api)
+
+    for _ in range(3):
+        resp = client.simulate_get("/healthz")
+        assert resp.status == falcon.HTTP_OK
+        assert resp.text == "ok\n"
+        assert "set-cookie" not in resp.headers
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_http_readyz():
+    mapper = DummyMapper()
+    client = FalconTestClient(get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(mapper)), mapper=mapper))
+    resp = client.simulate_get("/readyz")
+    assert resp.status == falcon.HTTP_OK
+    assert resp.text == "ready\n"
+
+    class LoadingMapper(DummyMapper):
+        @property
+        def ready(self) -> bool:
+            return False
+
+    mapper = LoadingMapper()
+    client = FalconTestClient(get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(mapper)), mapper=mapper))
+    resp = client.simulate_get("/readyz")
+    assert resp.status == falcon.HTTP_SERVICE_UNAVAILABLE
+    assert resp.text == "not ready: mapper\n"
+
+    # A custom protocol, with no mapper to check, is ready.
+    client = FalconTestClient(get_falcon_api(BrokerResource(lambda: lambda msg, data: (None, None))))
+    assert client.simulate_get("/readyz").status == falcon.HTTP_OK
+
+    client = FalconTestClient(
+        get_falcon_api(
+            BrokerResource(lambda: BrokerProtocolHandler(DummyMapper())), readiness_checks={"allocations": lambda: False}
+        )
+    )
+    resp = client.simulate_get("/readyz")
+    assert resp.status == falcon.HTTP_SERVICE_UNAVAILABLE
+    assert resp.text == "not ready: allocations\n"
+
+
+def test_readiness_resource_checks():
+    readiness = ReadinessResource()
+    with pytest.raises(ValueError):
+        readiness.add_check("bogus", 123)
+    with pytest.raises(ValueError):
+        ReadinessResource({"bogus": 123})
+
+    api = API()
+    api.add_route("/readyz", readiness)
+    client = FalconTestClient(api)
+    assert client.simulate_get("/readyz").status == falcon.HTTP_OK
+
+    check = Namespace(ready=False)
+    readiness.add_check("pool", lambda: check.ready)
+    assert client.simulate_get("/readyz").status == falcon.HTTP_SERVICE_UNAVAILABLE
+    check.ready = True
+    assert client.simulate_get("/readyz").status == falcon.HTTP_OK
+
+
+def test_path_scoped_middleware():
+    class SpyMiddleware:
+        def __init__(self):
+            self.paths = []
+
+        def process_request(self, req, resp):
+            self.paths.append(req.path)
+
+        def process_response(self, req, resp, resource, req_succeeded):
+            self.paths.append(req.path)
+
+    spy = SpyMiddleware()
+    api = API(middleware=PathScopedMiddleware(spy, ["/pcoip-broker/xml"]))
+    api.add_route("/pcoip-broker/xml", BrokerResource(lambda: BrokerProtocolHandler(DummyMapper())))
+    api.add_route("/healthz", HealthResource())
+    client = FalconTestClient(api)
+
+    client.simulate_get("/healthz")
+    assert spy.paths == []
+
+    client.simulate_get("/pcoip-broker/xml")
+    assert spy.paths == ["/pcoip-broker/xml", "/pcoip-broker/xml"]
+
+
+HELLO_XML = """<pcoip-client version="2.1">
+    <hello><client-info><hostname>gauss</hostname><product-name>{}</product-name></client-info></hello>
+</pcoip-client>"""
+AUTHENTICATE_XML = """<pcoip-client version="2.1">
+    <authenticate method="password"><username>user</username><password>pass</password><domain>example.com</domain>
+    </authenticate>
+</pcoip-client>"""
+GET_RESOURCE_LIST_XML = """<pcoip-client version="2.1"><get-resource-list/></pcoip-client>"""
+ALLOCATE_RESOURCE_XML = """<pcoip-client version="2.1"><allocate-resource><resource-id>0</resource-id></allocate-resource>
+</pcoip-client>"""
+BYE_XML = """<pcoip-client version="2.1"><bye/></pcoip-client>"""
+
+
+def test_broker_resource_session_writes(tmp_path, monkeypatch):
+    writes = Namespace(saved=0, removed=0)
+    save, remove = FileNamespaceManager.__setitem__, FileNamespaceManager.do_remove
+
+    def counting_save(self, key, value):
+        writes.saved += 1
+        save(self, key, value)
+
+    def counting_remove(self):
+        writes.removed += 1
+        remove(self)
+
+    monkeypatch.setattr(FileNamespaceManager, "__setitem__", counting_save)
+    monkeypatch.setattr(FileNamespaceManager, "do_remove", counting_remove)
+
+    def allocate_session(*args, **kwargs):
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.1.1.1", "sni", 60443, "id", "tag", "0")
+
+    mapper = DummyMapper("user", "pass", [Resource("Gauss", "gauss.de")])
+    settings = Settings()
+    settings.beaker = BeakerSettings(data_dir=str(tmp_path))
+    client = FalconTestClient(
+        get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(mapper, allocate_session)), settings)
+    )
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("QueryBrokerClient"))
+    assert resp.status == falcon.HTTP_OK
+    assert "set-cookie" not in resp.headers
+    assert writes.saved == 0
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss"))
+    cookie = {"Cookie": "JSESSIONID={}".format(resp.cookies["JSESSIONID"].value)}
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=AUTHENTICATE_XML.replace("pass<", "wrong<"), headers=cookie)
+    assert "AUTH_FAILED" in resp.text
+    saved_after_failure = writes.saved
+
+    for body in (AUTHENTICATE_XML, GET_RESOURCE_LIST_XML, ALLOCATE_RESOURCE_XML):
+        resp = client.simulate_post("/pcoip-broker/xml", body=body, headers=cookie)
+        assert resp.status == falcon.HTTP_OK
+
+    assert "ALLOC_SUCCESSFUL" in resp.text
+    assert writes.removed == 0
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=BYE_XML, headers=cookie)
+    assert "bye-resp" in resp.text
+
+    # One write per state transition, none for the probe or the failed authentication, and a removal on bye.
+    assert saved_after_failure == 1
+    assert writes.saved == 4
+    assert writes.removed == 1
+    assert list(tmp_path.rglob("*.cache")) == []
+
+
+def test_broker_resource_allocates_once_per_login(tmp_path):
+    launches = []
+
+    def allocate_session(*args, **kwargs):
+        launches.append(args)
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.1.1.1", "sni", 60443, "id", "tag", "0")
+
+    mapper = DummyMapper("user", "pass", [Resource("Gauss", "gauss.de")])
+    settings = Settings()
+    settings.beaker = BeakerSettings(data_dir=str(tmp_path))
+    client = FalconTestClient(
+        get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(mapper, allocate_session)), settings)
+    )
+
+    def login(*bodies):
+        resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss"))
+        cookie = {"Cookie": "JSESSIONID={}".format(resp.cookies["JSESSIONID"].value)}
+        return [client.simulate_post("/pcoip-broker/xml", body=body, headers=cookie) for body in bodies]
+
+    # An allocation without asking for the resource list first.
+    responses = login(AUTHENTICATE_XML, ALLOCATE_RESOURCE_XML, ALLOCATE_RESOURCE_XML)
+    assert not any("ALLOC_SUCCESSFUL" in resp.text for resp in responses)
+    assert launches == []
+
+    # The same allocation, again.
+    responses = login(AUTHENTICATE_XML, GET_RESOURCE_LIST_XML, *[ALLOCATE_RESOURCE_XML] * 3)
+    assert ["ALLOC_SUCCESSFUL" in resp.text for resp in responses[2:]] == [True, False, False]
+    assert len(launches) == 1
+
+
+def test_broker_resource_sqlite_sessions(tmp_path):
+    def allocate_session(*args, **kwargs):
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.1.1.1", "sni", 60443, "id", "tag", "0")
+
+    mapper = DummyMapper("user", "pass", [Resource("Gauss", "gauss.de")])
+    settings = Settings()
+    settings.beaker = BeakerSettings(type="sqlite", data_dir=str(tmp_path))
+    client = FalconTestClient(
+        get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(mapper, allocate_session)), settings)
+    )
+    db = sqlite3.connect(str(tmp_path / SQLITE_FILENAME))
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss"))
+    cookie = {"Cookie": "JSESSIONID={}".format(resp.cookies["JSESSIONID"].value)}
+    for body in (AUTHENTICATE_XML, GET_RESOURCE_LIST_XML, ALLOCATE_RESOURCE_XML):
+        resp = client.simulate_post("/pcoip-broker/xml", body=body, headers=cookie)
+    assert "ALLOC_SUCCESSFUL" in resp.text
+    assert db.execute("SELECT COUNT(*) FROM beaker_sessions").fetchone()[0] == 1
+
+    client.simulate_post("/pcoip-broker/xml", body=BYE_XML, headers=cookie)
+    assert db.execute("SELECT COUNT(*) FROM beaker_sessions").fetchone()[0] == 0
+
+
+def test_fallback_sessions(tmp_path, monkeypatch):
+    io = Namespace(loads=0, saves=0)
+    getitem, setitem = FileNamespaceManager.__getitem__, FileNamespaceManager.__setitem__
+
+    def counting_getitem(self, key):
+        io.loads += 1
+        return getitem(self, key)
+
+    def counting_setitem(self, key, value):
+        io.saves += 1
+        setitem(self, key, value)
+
+    monkeypatch.setattr(FileNamespaceManager, "__getitem__", counting_getitem)
+    monkeypatch.setattr(FileNamespaceManager, "__setitem__", counting_setitem)
+
+    def allocate_session(*args, **kwargs):
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.1.1.1", "sni", 60443, "id", "tag", "0")
+
+    mapper = DummyMapper("user", "pass", [Resource("Gauss", "gauss.de")])
+    settings = Settings()
+    settings.beaker = BeakerSettings(data_dir=str(tmp_path))
+    client = FalconTestClient(
+        get_falcon_api(
+            BrokerResource(lambda: BrokerProtocolHandler(mapper, allocate_session)), settings, use_fallback_sessions=True
+        )
+    )
+    header = {"CLIENT-LOG-ID": "../../etc/noether"}
+
+    for requests, body in enumerate((HELLO_XML.format("Gauss"), AUTHENTICATE_XML, GET_RESOURCE_LIST_XML), 1):
+        resp = client.simulate_post("/pcoip-broker/xml", body=body, headers=header)
+        assert resp.status == falcon.HTTP_OK
+        assert "set-cookie" not in resp.headers
+        assert io.loads == requests
+        assert io.saves == requests
+    assert "Khajit has wares" in resp.text
+    assert all(str(tmp_path) in str(path.resolve()) for path in tmp_path.rglob("*"))
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=BYE_XML, headers=header)
+    assert "bye-resp" in resp.text
+    assert io.saves == 3
+    assert list(tmp_path.rglob("*.cache")) == []
+
+    # Without the header we are back to cookies.
+    resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss"))
+    assert "JSESSIONID" in resp.cookies
+
+
+def test_broker_resource_rate_limits(tmp_path, monkeypatch):
+    maps = []
+    mapper = DummyMapper("user", "pass", [Resource("Gauss", "gauss.de")])
+    monkeypatch.setattr(mapper, "map", lambda *args: maps.append(args) or DummyMapper.map(mapper, *args))
+
+    admission = AdmissionController(
+        RateLimitSettings(
+            client_expensive_rate=0.01,
+            client_expensive_burst=2,
+            user_rate=0.01,
+            user_burst=3,
+            client_ip_header="X-Forwarded-For",
+            slots=64,
+        )
+    )
+    settings = Settings()
+    settings.beaker = BeakerSettings(data_dir=str(tmp_path))
+    client = FalconTestClient(
+        get_falcon_api(BrokerResource(lambda: BrokerProtocolHandler(mapper), admission=admission), settings)
+    )
+
+    def login(address):
+        headers = {"X-Forwarded-For": "203.0.113.7, " + address}
+        resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss"), headers=headers)
+        headers["Cookie"] = "JSESSIONID=" + resp.cookies["JSESSIONID"].value
+        return client.simulate_post("/pcoip-broker/xml", body=AUTHENTICATE_XML, headers=headers)
+
+    assert login("10.0.0.1").status == falcon.HTTP_OK
+    assert login("10.0.0.1").status == falcon.HTTP_OK
+    resp = login("10.0.0.1")
+    assert resp.status == falcon.HTTP_TOO_MANY_REQUESTS
+    assert int(resp.headers["retry-after"]) > 0
+    assert len(maps) == 2
+
+    # Another address has its own budget, but the username has one left.
+    assert login("10.0.0.2").status == falcon.HTTP_OK
+    assert login("10.0.0.3").status == falcon.HTTP_TOO_MANY_REQUESTS
+    assert len(maps) == 3
@@ -0,0 +1,100 @@
+import logging
+import os
+import threading
+from contextlib import contextmanager
+
+import pytest
+
+from interstate_love_song import log
+
+
+@contextmanager
+def bare_root_logger():
+    """Strips the root logger of the handlers pytest installs for the duration of a test."""
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    for handler in handlers:
+        root.removeHandler(handler)
+    try:
+        yield root
+    finally:
+        log.stop_logging()
+        for handler in handlers:
+            root.addHandler(handler)
+        root.setLevel(level)
+
+
+def test_configure_logging_writes_through_queue(capsys):
+    with bare_root_logger() as root:
+        log.configure_logging(logging.INFO)
+        log.configure_logging(logging.DEBUG)
+
+        assert root.level == logging.DEBUG
+        assert len(root.handlers) == 1
+
+        logging.getLogger("euler").info("Hello %s.", "Basel")
+        log.stop_logging()
+
+        assert root.handlers == []
+
+    assert "INFO:euler:Hello Basel." in capsys.readouterr().err
+
+
+def test_configure_logging_defers_formatting():
+    class Expensive:
+        formatted = False
+
+        def __str__(self):
+            Expensive.formatted = True
+            return "expensive"
+
+    with bare_root_logger():
+        log.configure_logging(logging.INFO)
+        logging.getLogger("euler").debug("%s", Expensive())
+
+    assert Expensive.formatted is False
+
+
+def test_configure_logging_formats_on_the_listener(capsys):
+    formatted_on = []
+
+    class Expensive:
+        def __str__(self):
+            formatted_on.append(threading.get_ident())
+            return "expensive"
+
+    with bare_root_logger():
+        log.configure_logging(logging.INFO)
+        logging.getLogger("euler").info("%s", Expensive())
+        log.stop_logging()
+
+    assert len(formatted_on) == 1 and formatted_on[0] != threading.get_ident()
+    assert "INFO:euler:expensive" in capsys.readouterr().err
+
+
+def test_configure_logging_leaves_existing_handlers():
+    with bare_root_logger() as root:
+        handler = logging.NullHandler()
+        root.addHandler(handler)
+
+        log.configure_logging(logging.INFO)
+
+        assert root.handlers == [handler]
+        root.removeHandler(handler)
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs fork")
+def test_configure_logging_survives_fork(tmp_path):
+    path = tmp_path / "child.log"
+    with bare_root_logger():
+        log.configure_logging(logging.INFO)
+        log._listener.handlers = (logging.FileHandler(str(path)),)
+
+        pid = os.fork()
+        if pid == 0:
+            logging.getLogger("euler").info("from the child")
+            log.stop_logging()
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+    assert "from the child" in path.read_text()
@@ -3,7 +3,7 @@ from interstate_love_song.plugins import *
 
 
 def test_find_builtin_plugins():
-    assert all(item in get_available_plugins().keys() for item in ["SimpleMapper"])
+    assert all(item in get_available_plugins().keys() for item in ["SimpleMapper", "FileMapper", "PoolMapper"])
 
 
 def test_no_configured_plugin():
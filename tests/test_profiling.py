@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from interstate_love_song.profiling import StackSampler, profile_for, profile_until_exit
+
+
+def _spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_stack_sampler_constructor():
+    with pytest.raises(ValueError):
+        StackSampler(0)
+
+
+def test_stack_sampler_collapses_stacks():
+    sampler = StackSampler(0.001)
+    sampler.start()
+    with pytest.raises(RuntimeError):
+        sampler.start()
+    _spin(0.2)
+    sampler.stop()
+
+    assert sampler.samples > 0
+    lines = sampler.collapsed().splitlines()
+    assert any("_spin (test_profiling.py:" in line for line in lines)
+    for line in lines:
+        stack, count = line.rsplit(" ", 1)
+        assert int(count) > 0
+        assert "_sample (profiling.py:" not in stack
+
+
+def test_profile_for():
+    assert "profile_for (profiling.py:" in profile_for(0.05, 0.001)
+
+
+def test_profile_until_exit(tmp_path):
+    path = tmp_path / "profile.txt"
+    write = profile_until_exit(str(path), 0.001)
+    _spin(0.05)
+    write()
+    write()
+
+    assert "_spin (test_profiling.py:" in path.read_text()
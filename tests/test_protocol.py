@@ -1,11 +1,14 @@
 import socket
+from copy import copy
 from dataclasses import dataclass
 from typing import Optional
 
 import pytest
 
-from interstate_love_song.agent import AgentSession, AllocateSessionStatus
+from interstate_love_song.affinity import HostAffinity
+from interstate_love_song.agent import AgentSession, AllocateSessionStatus, AllocationCoalescer
 from interstate_love_song.mapping import Mapper, Credentials, MapperResult, MapperStatus, Resource
+from interstate_love_song.metrics import Metrics
 from interstate_love_song.protocol import BrokerProtocolHandler, ProtocolState, ProtocolSession
 from interstate_love_song.transport import *
 
@@ -17,7 +20,7 @@ class DummyMapper(Mapper):
 
     @property
     def domains(self):
-        return ['example.com']
+        return ["example.com"]
 
     @classmethod
     def create_from_settings(cls, settings):
@@ -45,7 +48,7 @@ class DummyMapper(Mapper):
 
 @dataclass
 class Fixture:
-    mapper: DummyMapper = DummyMapper("user", "pass", [], 'example.com')
+    mapper: DummyMapper = DummyMapper("user", "pass", [], "example.com")
 
 
 @pytest.fixture
@@ -71,9 +74,7 @@ def test_broker_protocol_handler_call_invalid_message(ctx: Fixture):
 def test_broker_protocol_handler_call_waiting_for_hello_hello(ctx: Fixture):
     bph = BrokerProtocolHandler(ctx.mapper)
 
-    session_data, response = bph(
-        HelloRequest(client_hostname="Lagrange", client_product_name="Abel"), None
-    )
+    session_data, response = bph(HelloRequest(client_hostname="Lagrange", client_product_name="Abel"), None)
     assert session_data.state == ProtocolState.WAITING_FOR_AUTHENTICATE
 
     assert isinstance(response, HelloResponse)
@@ -84,13 +85,14 @@ def test_broker_protocol_handler_call_waiting_for_hello_hello(ctx: Fixture):
     assert session_data.username is None
     assert session_data.password is None
 
+    other_session_data, _ = bph(HelloRequest(client_hostname="Lagrange", client_product_name="Abel"), None)
+    assert session_data.session_id and other_session_data.session_id != session_data.session_id
+
 
 def test_broker_protocol_handler_call_waiting_for_hello_hello_query_broker_client(ctx: Fixture):
     bph = BrokerProtocolHandler(ctx.mapper)
 
-    session_data, response = bph(
-        HelloRequest(client_hostname="Lagrange", client_product_name="QueryBrokerClient"), None
-    )
+    session_data, response = bph(HelloRequest(client_hostname="Lagrange", client_product_name="QueryBrokerClient"), None)
 
     assert isinstance(response, HelloResponse)
     assert response.hostname == socket.gethostname()
@@ -101,9 +103,7 @@ def test_broker_protocol_handler_call_waiting_for_hello_hello_query_broker_clien
 
 def test_broker_protocol_handler_call_waiting_for_hello_bye(ctx: Fixture):
     bph = BrokerProtocolHandler(ctx.mapper)
-    session_data, response = bph(
-        ByeRequest(), ProtocolSession(state=ProtocolState.WAITING_FOR_HELLO)
-    )
+    session_data, response = bph(ByeRequest(), ProtocolSession(state=ProtocolState.WAITING_FOR_HELLO))
 
     assert isinstance(response, ByeResponse)
 
@@ -129,7 +129,11 @@ def test_broker_protocol_handler_call_waiting_for_authenticate_authenticate_succ
     ctx.mapper.resources = [Resource("Kurt", "Gödel")]
 
     session_data, response = bph(
-        AuthenticateRequest(ctx.mapper.username, ctx.mapper.password, ctx.mapper.domain,),
+        AuthenticateRequest(
+            ctx.mapper.username,
+            ctx.mapper.password,
+            ctx.mapper.domain,
+        ),
         ProtocolSession(state=ProtocolState.WAITING_FOR_AUTHENTICATE),
     )
 
@@ -196,9 +200,7 @@ def test_broker_protocol_handler_call_waiting_for_authenticate_authenticate_fail
 
 def test_broker_protocol_handler_call_waiting_for_authenticate_bye(ctx: Fixture):
     bph = BrokerProtocolHandler(ctx.mapper)
-    session_data, response = bph(
-        ByeRequest(), ProtocolSession(state=ProtocolState.WAITING_FOR_AUTHENTICATE)
-    )
+    session_data, response = bph(ByeRequest(), ProtocolSession(state=ProtocolState.WAITING_FOR_AUTHENTICATE))
 
     assert isinstance(response, ByeResponse)
 
@@ -350,6 +352,88 @@ def test_broker_protocol_handler_call_waiting_for_allocateresource_allocateresou
     assert session_data.state == ProtocolState.WAITING_FOR_ALLOCATERESOURCE
 
 
+def test_broker_protocol_handler_call_waiting_for_allocateresource_allocateresource_overloaded(
+    ctx: Fixture,
+):
+    def allocate_session(*args, **kwargs):
+        return AllocateSessionStatus.OVERLOADED, None
+
+    protocol_session = ProtocolSession(
+        "Leonhard",
+        "Euler",
+        state=ProtocolState.WAITING_FOR_ALLOCATERESOURCE,
+        resources={"0": Resource("Hilbert", "hilbert.gov")},
+    )
+
+    bph = BrokerProtocolHandler(ctx.mapper, allocate_session=allocate_session)
+
+    session_data, response = bph(AllocateResourceRequest(resource_id="0"), protocol_session)
+
+    assert isinstance(response, AllocateResourceFailureResponse)
+    assert response.result_id == "FAILED_UNSPECIFIED"
+    assert session_data.state == ProtocolState.WAITING_FOR_ALLOCATERESOURCE
+
+
+def test_broker_protocol_handler_host_affinity():
+    previous_hosts = []
+
+    class RecordingMapper(DummyMapper):
+        def map(self, credentials, previous_host=None):
+            previous_hosts.append(previous_host)
+            return super().map(credentials, previous_host)
+
+    def allocate_session(resource_id, hostname, *args, **kwargs):
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.2.3.4", hostname, 4172, "Catmull", "Rom", resource_id)
+
+    affinity = HostAffinity(slots=64)
+    mapper = RecordingMapper("user", "pass", [Resource("Gauss", "gauss.de"), Resource("Hilbert", "hilbert.de")])
+    bph = BrokerProtocolHandler(mapper, allocate_session=allocate_session, affinity=affinity)
+
+    def authenticate():
+        session = ProtocolSession(state=ProtocolState.WAITING_FOR_AUTHENTICATE)
+        session, response = bph(AuthenticateRequest("user", "pass", "example.com"), session)
+        assert isinstance(response, AuthenticateSuccessResponse)
+        return session
+
+    session = authenticate()
+    session.state = ProtocolState.WAITING_FOR_ALLOCATERESOURCE
+    bph(AllocateResourceRequest(resource_id="1"), session)
+    authenticate()
+    bph(AuthenticateRequest("user", "wrong", "example.com"), ProtocolSession(state=ProtocolState.WAITING_FOR_AUTHENTICATE))
+
+    assert previous_hosts == [None, "hilbert.de", "hilbert.de"]
+    assert affinity.recall("user") == "hilbert.de"
+
+
+def test_broker_protocol_handler_coalesces_within_a_login():
+    calls = []
+
+    def allocate_session(resource_id, hostname, *args, **kwargs):
+        calls.append(kwargs["client_session_id"])
+        session_id = "Session-{}".format(len(calls))
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.2.3.4", hostname, 4172, session_id, "Tag", resource_id)
+
+    mapper = DummyMapper("user", "pass", [Resource("Gauss", "gauss.de")])
+    bph = BrokerProtocolHandler(mapper, allocate_session=AllocationCoalescer(60, Metrics()).coalesce(allocate_session))
+
+    def login():
+        session, _ = bph(HelloRequest(client_hostname="Lagrange", client_product_name="Abel"), None)
+        for msg in (AuthenticateRequest("user", "pass", "example.com"), GetResourceListRequest()):
+            session, _ = bph(msg, session)
+        return session
+
+    def allocate(session):
+        _, response = bph(AllocateResourceRequest(resource_id="0"), copy(session))
+        return response.session_id
+
+    first, second = login(), login()
+    # The client sends the allocation again, it gets the session already allocated for it.
+    assert allocate(first) == allocate(first) == "Session-1"
+    # Another client of the same user gets its own.
+    assert allocate(second) == "Session-2"
+    assert calls == [first.session_id, second.session_id]
+
+
 def test_broker_protocol_handler_call_waiting_for_bye_bye(ctx: Fixture):
     bph = BrokerProtocolHandler(ctx.mapper)
 
@@ -357,3 +441,15 @@ def test_broker_protocol_handler_call_waiting_for_bye_bye(ctx: Fixture):
 
     assert session_data is None
     assert isinstance(response, ByeResponse)
+
+
+def test_broker_protocol_handler_routing_table_built_once(ctx: Fixture):
+    bph = BrokerProtocolHandler(ctx.mapper)
+    routing_table = bph._routing_table
+
+    bph(HelloRequest(client_hostname="Lagrange", client_product_name="Abel"), None)
+    bph(ByeRequest(), None)
+
+    assert bph._routing_table is routing_table
+    # Every state is routed, an unexpected message after the allocation is rejected like in any other.
+    assert set(routing_table) == set(ProtocolState)
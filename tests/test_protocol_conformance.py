@@ -0,0 +1,402 @@
+"""Scenarios that BrokerProtocolHandler and AsyncBrokerProtocolHandler must go through alike: the same sessions, states
+and responses for the same messages.
+"""
+import asyncio
+import time
+
+import pytest
+
+from interstate_love_song.affinity import HostAffinity
+from interstate_love_song.agent import AgentSession, AllocateSessionStatus
+from interstate_love_song.mapping import Resource
+from interstate_love_song.metrics import Metrics
+from interstate_love_song.protocol import (
+    AsyncBrokerProtocolHandler,
+    BrokerProtocolHandler,
+    ProtocolSession,
+    ProtocolState,
+    _BrokerProtocolMachine,
+)
+from interstate_love_song.transport import *
+
+from .test_protocol import DummyMapper
+
+RESOURCES = [Resource("Gauss", "gauss.de"), Resource("Hilbert", "hilbert.de")]
+
+
+class Agents:
+    """The agents of the scenarios: each host answers with its status after its delay, SUCCESSFUL by default."""
+
+    def __init__(self, statuses=None, delays=None):
+        self.statuses = statuses or {}
+        self.delays = delays or {}
+        self.calls = []
+
+    def answer(self, resource_id, hostname, username):
+        self.calls.append((resource_id, hostname, username))
+        status = self.statuses.get(hostname, AllocateSessionStatus.SUCCESSFUL)
+        if status != AllocateSessionStatus.SUCCESSFUL:
+            return status, None
+        return status, AgentSession("1.2.3.4", hostname, 4172, "Catmull", "Rom", resource_id)
+
+    def sync(self, resource_id, hostname, username, password, domain, *args, **kwargs):
+        time.sleep(self.delays.get(hostname, 0.0))
+        return self.answer(resource_id, hostname, username)
+
+    async def async_(self, resource_id, hostname, username, password, domain, *args, **kwargs):
+        await asyncio.sleep(self.delays.get(hostname, 0.0))
+        return self.answer(resource_id, hostname, username)
+
+
+def _sync_handler(mapper, agents, **kwargs):
+    return BrokerProtocolHandler(mapper, allocate_session=agents.sync, **kwargs)
+
+
+def _async_handler(mapper, agents, **kwargs):
+    handler = AsyncBrokerProtocolHandler(mapper, allocate_session=agents.async_, **kwargs)
+    return lambda msg, session: asyncio.run(handler(msg, session))
+
+
+@pytest.fixture(params=[_sync_handler, _async_handler], ids=["sync", "async"])
+def make_handler(request):
+    return request.param
+
+
+def _session(state, **kwargs):
+    return ProtocolSession(state=state, **kwargs)
+
+
+def _allocating(resources=None):
+    resources = dict(enumerate(RESOURCES)) if resources is None else resources
+    return _session(
+        ProtocolState.WAITING_FOR_ALLOCATERESOURCE,
+        username="user",
+        password="pass",
+        domain="example.com",
+        resources=dict((str(k), v) for k, v in resources.items()),
+    )
+
+
+def test_hello(make_handler):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents())
+
+    session, response = handle(HelloRequest(client_hostname="Lagrange", client_product_name="Abel"), None)
+
+    assert isinstance(response, HelloResponse)
+    assert response.domains == ["example.com"]
+    assert session.state == ProtocolState.WAITING_FOR_AUTHENTICATE
+
+
+def test_hello_query_broker_client(make_handler):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents())
+
+    session, response = handle(HelloRequest(client_hostname="Lagrange", client_product_name="QueryBrokerClient"), None)
+
+    assert isinstance(response, HelloResponse)
+    assert session is None
+
+
+@pytest.mark.parametrize("state", list(ProtocolState))
+def test_bye_in_any_state(make_handler, state):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents())
+
+    session, response = handle(ByeRequest(), _session(state))
+
+    assert session is None
+    assert isinstance(response, ByeResponse)
+
+
+def test_unexpected_message(make_handler):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents())
+
+    assert handle(GetResourceListRequest(), _session(ProtocolState.WAITING_FOR_AUTHENTICATE)) == (None, None)
+    assert handle(AuthenticateRequest("user", "pass", "example.com"), None) == (None, None)
+
+
+def test_invalid_input(make_handler):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents())
+
+    with pytest.raises(ValueError):
+        handle(None, None)
+    with pytest.raises(ValueError):
+        handle(ByeRequest(), "session")
+
+
+@pytest.mark.parametrize(
+    "password, resources, expected_response, expected_state",
+    [
+        ("pass", RESOURCES, AuthenticateSuccessResponse, ProtocolState.WAITING_FOR_GETRESOURCELIST),
+        ("wrong", RESOURCES, AuthenticateFailedResponse, ProtocolState.WAITING_FOR_AUTHENTICATE),
+        ("pass", [], AuthenticateFailedResponse, ProtocolState.WAITING_FOR_AUTHENTICATE),
+    ],
+)
+def test_authenticate(make_handler, password, resources, expected_response, expected_state):
+    handle = make_handler(DummyMapper("user", "pass", resources), Agents())
+
+    session, response = handle(
+        AuthenticateRequest("user", password, "example.com"), _session(ProtocolState.WAITING_FOR_AUTHENTICATE)
+    )
+
+    assert isinstance(response, expected_response)
+    assert session.state == expected_state
+    if expected_response is AuthenticateSuccessResponse:
+        assert (session.username, session.password, session.domain) == ("user", "pass", "example.com")
+        assert list(session.resources.values()) == RESOURCES
+    else:
+        assert session.username is None and session.password is None and session.resources == {}
+
+
+def test_get_resource_list(make_handler):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents())
+    session = _allocating()
+    session.state = ProtocolState.WAITING_FOR_GETRESOURCELIST
+
+    session, response = handle(GetResourceListRequest(), session)
+
+    assert session.state == ProtocolState.WAITING_FOR_ALLOCATERESOURCE
+    assert [(r.resource_name, r.resource_id) for r in response.resources] == [("Gauss", "0"), ("Hilbert", "1")]
+
+
+def test_allocate_success(make_handler):
+    agents = Agents()
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), agents)
+
+    session, response = handle(AllocateResourceRequest(resource_id="1"), _allocating())
+
+    assert session.state == ProtocolState.WAITING_FOR_BYE
+    assert isinstance(response, AllocateResourceSuccessResponse)
+    assert (response.hostname, response.resource_id, response.session_id) == ("hilbert.de", "1", "Catmull")
+    assert agents.calls == [("1", "hilbert.de", "user")]
+
+
+@pytest.mark.parametrize(
+    "status, result_id",
+    [
+        (AllocateSessionStatus.CONNECTION_ERROR, "FAILED_USER_AUTH"),
+        (AllocateSessionStatus.FAILED_USER_AUTH, "FAILED_USER_AUTH"),
+        (AllocateSessionStatus.FAILED_ANOTHER_SESSION_STARTED, "FAILED_ANOTHER_SESION_STARTED"),
+        (AllocateSessionStatus.OVERLOADED, "FAILED_UNSPECIFIED"),
+    ],
+)
+def test_allocate_failure(make_handler, status, result_id):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents({"gauss.de": status}))
+
+    session, response = handle(AllocateResourceRequest(resource_id="0"), _allocating())
+
+    assert session.state == ProtocolState.WAITING_FOR_ALLOCATERESOURCE
+    assert isinstance(response, AllocateResourceFailureResponse)
+    assert response.result_id == result_id
+
+
+def test_allocate_unknown_resource(make_handler):
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), Agents())
+
+    with pytest.raises(KeyError):
+        handle(AllocateResourceRequest(resource_id="7"), _allocating())
+
+
+def test_full_session_with_affinity(make_handler):
+    previous_hosts = []
+
+    class RecordingMapper(DummyMapper):
+        def map(self, credentials, previous_host=None):
+            previous_hosts.append(previous_host)
+            return super().map(credentials, previous_host)
+
+    affinity = HostAffinity(slots=64)
+    handle = make_handler(RecordingMapper("user", "pass", RESOURCES), Agents(), affinity=affinity)
+
+    for _ in range(2):
+        session, _ = handle(HelloRequest(client_hostname="Lagrange", client_product_name="Abel"), None)
+        session, _ = handle(AuthenticateRequest("user", "pass", "example.com"), session)
+        session, _ = handle(GetResourceListRequest(), session)
+        session, response = handle(AllocateResourceRequest(resource_id="1"), session)
+        assert isinstance(response, AllocateResourceSuccessResponse)
+        assert handle(ByeRequest(), session) == (None, ByeResponse())
+
+    assert previous_hosts == [None, "hilbert.de"]
+    assert affinity.recall("user") == "hilbert.de"
+
+
+def test_race_takes_first_success(make_handler):
+    metrics = Metrics()
+    agents = Agents(delays={"slow.edu": 1.0})
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), agents, metrics=metrics, hedge_delay=0.05)
+
+    start = time.perf_counter()
+    session, response = handle(
+        AllocateResourceRequest(resource_id="0"), _allocating({0: Resource("Pool", "slow.edu", ("fast.edu",))})
+    )
+
+    assert time.perf_counter() - start < 0.5
+    assert response.hostname == "fast.edu"
+    assert session.state == ProtocolState.WAITING_FOR_BYE
+    assert metrics.get("agent.allocations.raced") == 1
+    assert metrics.get("agent.allocations.hedged") == 1
+
+
+def test_race_hedges_only_slow_hosts(make_handler):
+    metrics = Metrics()
+    agents = Agents(delays={"gauss.de": 0.01})
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), agents, metrics=metrics, hedge_delay=0.5)
+    resources = {0: Resource("Pool", "gauss.de", ("hilbert.de", "riemann.de"))}
+
+    session, response = handle(AllocateResourceRequest(resource_id="0"), _allocating(resources))
+
+    assert response.hostname == "gauss.de"
+    # The candidates were never called, nor took a slot of the limiter.
+    assert [hostname for _, hostname, _ in agents.calls] == ["gauss.de"]
+    assert metrics.get("agent.allocations.hedged", 0) == 0
+
+
+def test_race_tries_candidates_only_when_needed(make_handler):
+    agents = Agents({"gauss.de": AllocateSessionStatus.CONNECTION_ERROR})
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), agents, metrics=Metrics(), hedge_delay=5.0)
+    resources = {0: Resource("Pool", "gauss.de", ("hilbert.de", "riemann.de"))}
+
+    session, response = handle(AllocateResourceRequest(resource_id="0"), _allocating(resources))
+
+    # The preferred host failed right away, the next was tried then, and answered.
+    assert response.hostname == "hilbert.de"
+    assert [hostname for _, hostname, _ in agents.calls] == ["gauss.de", "hilbert.de"]
+
+
+def test_race_all_fail_reports_preferred_host(make_handler):
+    agents = Agents(
+        {
+            "gauss.de": AllocateSessionStatus.CONNECTION_ERROR,
+            "hilbert.de": AllocateSessionStatus.FAILED_ANOTHER_SESSION_STARTED,
+        },
+        delays={"gauss.de": 0.05},
+    )
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), agents, metrics=Metrics())
+
+    session, response = handle(
+        AllocateResourceRequest(resource_id="0"), _allocating({0: Resource("Pool", "gauss.de", ("hilbert.de",))})
+    )
+
+    assert session.state == ProtocolState.WAITING_FOR_ALLOCATERESOURCE
+    assert response.result_id == "FAILED_USER_AUTH"
+
+
+def test_race_cuts_tail_latency(make_handler):
+    """A pool with one host that hangs before failing: picked alone, it decides the wait of a fifth of the users."""
+    hosts = ["r{}.example.com".format(i) for i in range(5)]
+    agents = Agents({hosts[0]: AllocateSessionStatus.CONNECTION_ERROR}, delays={hosts[0]: 0.5})
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), agents, metrics=Metrics(), hedge_delay=0.05)
+
+    def latencies(fan_out):
+        results = []
+        for i in range(len(hosts)):
+            ranked = hosts[i:] + hosts[:i]
+            start = time.perf_counter()
+            _, response = handle(
+                AllocateResourceRequest(resource_id="0"),
+                _allocating({0: Resource("Pool", ranked[0], tuple(ranked[1:fan_out]))}),
+            )
+            results.append((time.perf_counter() - start, response))
+        return sorted(elapsed for elapsed, _ in results), [response for _, response in results]
+
+    single, single_responses = latencies(1)
+    raced, raced_responses = latencies(2)
+
+    assert sum(isinstance(r, AllocateResourceFailureResponse) for r in single_responses) == 1
+    assert all(isinstance(r, AllocateResourceSuccessResponse) for r in raced_responses)
+    assert single[-1] >= 0.5
+    assert raced[-1] < 0.25
+
+
+def test_allocate_session_raising_is_connection_error(make_handler):
+    agents = Agents()
+
+    def broken(*args, **kwargs):
+        raise RuntimeError("The agent is on fire.")
+
+    agents.sync = broken
+
+    async def broken_async(*args, **kwargs):
+        raise RuntimeError("The agent is on fire.")
+
+    agents.async_ = broken_async
+    handle = make_handler(DummyMapper("user", "pass", RESOURCES), agents, metrics=Metrics())
+
+    session, response = handle(
+        AllocateResourceRequest(resource_id="0"), _allocating({0: Resource("Pool", "gauss.de", ("hilbert.de",))})
+    )
+
+    assert response.result_id == "FAILED_USER_AUTH"
+
+
+def test_handler_must_handle_every_call():
+    class _NoAllocations(_BrokerProtocolMachine):
+        def _authenticate(self, msg, session):
+            return None, AuthenticateFailedResponse()
+
+    with pytest.raises(TypeError):
+        _NoAllocations(DummyMapper(), allocate_session=Agents().sync)
+
+
+def test_sync_race_strands_losing_success():
+    """The sync handler can't stop an attempt in progress, the async one cancels it, see below."""
+    metrics = Metrics()
+    affinity = HostAffinity(slots=64, metrics=metrics)
+    agents = Agents(delays={"slow.edu": 0.2})
+    handle = _sync_handler(DummyMapper(), agents, affinity=affinity, metrics=metrics, hedge_delay=0.05)
+    resources = {0: Resource("Pool", "slow.edu", ("fast.edu",))}
+
+    _, response = handle(AllocateResourceRequest(resource_id="0"), _allocating(resources))
+    assert response.hostname == "fast.edu"
+
+    # The slow host allocates a session too, after the race was decided.
+    deadline = time.monotonic() + 5
+    while affinity.stranded("user") is None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert affinity.stranded("user") == "slow.edu"
+    assert metrics.get("agent.allocations.abandoned") == 1
+    assert affinity.recall("user") == "fast.edu"
+
+    # The next login tries it last, rather than have it fail for the session it still holds.
+    agents.calls.clear()
+    _, response = handle(AllocateResourceRequest(resource_id="0"), _allocating(resources))
+    assert response.hostname == "fast.edu"
+    assert [hostname for _, hostname, _ in agents.calls] == ["fast.edu"]
+
+
+def test_async_handler_serves_logins_concurrently():
+    agents = Agents(delays={"gauss.de": 0.2})
+    handler = AsyncBrokerProtocolHandler(DummyMapper("user", "pass", RESOURCES), allocate_session=agents.async_)
+
+    async def allocate_many():
+        return await asyncio.gather(*[handler(AllocateResourceRequest(resource_id="0"), _allocating()) for _ in range(20)])
+
+    start = time.perf_counter()
+    results = asyncio.run(allocate_many())
+
+    assert time.perf_counter() - start < 1.0
+    assert all(isinstance(response, AllocateResourceSuccessResponse) for _, response in results)
+
+
+def test_async_race_cancels_losers():
+    cancelled = []
+
+    async def allocate_session(resource_id, hostname, *args, **kwargs):
+        try:
+            await asyncio.sleep(0.0 if hostname == "fast.edu" else 5.0)
+        except asyncio.CancelledError:
+            cancelled.append(hostname)
+            raise
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.2.3.4", hostname, 4172, "Catmull", "Rom", resource_id)
+
+    handler = AsyncBrokerProtocolHandler(DummyMapper(), allocate_session=allocate_session, metrics=Metrics(), hedge_delay=0.05)
+
+    async def allocate():
+        result = await handler(
+            AllocateResourceRequest(resource_id="0"), _allocating({0: Resource("Pool", "slow.edu", ("fast.edu",))})
+        )
+        await asyncio.sleep(0)
+        return result
+
+    _, response = asyncio.run(allocate())
+
+    assert response.hostname == "fast.edu"
+    assert cancelled == ["slow.edu"]
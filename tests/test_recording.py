@@ -0,0 +1,109 @@
+import falcon
+import pytest
+from falcon.testing import TestClient as FalconTestClient
+
+from interstate_love_song.agent import AllocateSessionStatus, AgentSession
+from interstate_love_song.http import BrokerResource, get_falcon_api
+from interstate_love_song.mapping import Resource
+from interstate_love_song.metrics import Metrics
+from interstate_love_song.protocol import BrokerProtocolHandler
+from interstate_love_song.recording import TrafficRecorder, Redaction, Exchange, read_recording
+from interstate_love_song.settings import Settings, BeakerSettings
+from .test_http import HELLO_XML, AUTHENTICATE_XML, GET_RESOURCE_LIST_XML, ALLOCATE_RESOURCE_XML, BYE_XML
+from .test_protocol import DummyMapper
+
+
+def _client(tmp_path, recorder, use_fallback_sessions=False):
+    def allocate_session(*args, **kwargs):
+        return AllocateSessionStatus.SUCCESSFUL, AgentSession("1.1.1.1", "sni", 60443, "Catmull", "Rom", "0")
+
+    mapper = DummyMapper("user", "pass", [Resource("Gauss", "gauss.de")])
+    settings = Settings()
+    settings.beaker = BeakerSettings(data_dir=str(tmp_path / "sessions"))
+    resource = BrokerResource(lambda: BrokerProtocolHandler(mapper, allocate_session), recorder=recorder)
+    return FalconTestClient(get_falcon_api(resource, settings, use_fallback_sessions=use_fallback_sessions))
+
+
+def _login(client, headers=None):
+    headers = dict(headers or {})
+    resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss"), headers=headers)
+    if "JSESSIONID" in resp.cookies:
+        headers["Cookie"] = "JSESSIONID={}".format(resp.cookies["JSESSIONID"].value)
+    client.simulate_post("/pcoip-broker/xml", body=AUTHENTICATE_XML.replace("pass<", "wrong<"), headers=headers)
+    for body in (AUTHENTICATE_XML, GET_RESOURCE_LIST_XML, ALLOCATE_RESOURCE_XML, BYE_XML):
+        client.simulate_post("/pcoip-broker/xml", body=body, headers=headers)
+
+
+def test_recorder_records_exchanges(tmp_path):
+    metrics = Metrics()
+    recorder = TrafficRecorder(str(tmp_path / "recording"), metrics=metrics)
+    client = _client(tmp_path, recorder)
+
+    _login(client)
+    client.simulate_post("/pcoip-broker/xml", body="Not XML")
+
+    files = list(tmp_path.glob("recording.*"))
+    assert len(files) == 1
+    text = files[0].read_text()
+    for secret in (">user<", ">pass<", ">wrong<", ">Catmull<", ">Rom<"):
+        assert secret not in text
+
+    exchanges = list(read_recording([str(tmp_path / "recording.*")]))
+    assert metrics.get("recording.exchanges") == len(exchanges) == 7
+    assert [e.status for e in exchanges] == [200] * 6 + [400]
+    assert all(e.duration >= 0 for e in exchanges)
+    assert [e.time for e in exchanges] == sorted(e.time for e in exchanges)
+
+    login, bad = exchanges[:6], exchanges[6]
+    # The whole login is one client, and the same user, with a token per password.
+    assert len(set(e.client for e in login)) == 1 and login[0].client.startswith("client-")
+    assert not any(e.header_session for e in exchanges)
+    wrong, right = login[1].request, login[2].request
+    assert recorder.token("user", "user") in wrong and recorder.token("user", "user") in right
+    assert recorder.token("pass", "wrong") in wrong and recorder.token("pass", "pass") in right
+    assert "AUTH_FAILED" in login[1].response and "ALLOC_SUCCESSFUL" in login[4].response
+    assert recorder.token("tag", "Rom") in login[4].response
+
+    assert bad.request is None and bad.response is None and bad.request_bytes == len("Not XML")
+    assert bad.client is None
+
+
+def test_recorder_redacts(tmp_path):
+    recorder = TrafficRecorder(str(tmp_path / "recording"), Redaction.REDACT, metrics=Metrics())
+
+    _login(_client(tmp_path, recorder), {"CLIENT-LOG-ID": "noether"})
+
+    exchanges = list(read_recording([str(tmp_path / "recording.*")]))
+    assert all(e.header_session and e.client == "REDACTED" for e in exchanges)
+    assert "<username>REDACTED</username><password>REDACTED</password>" in exchanges[2].request
+    assert "<connect-tag>REDACTED</connect-tag>" in exchanges[4].response
+
+
+def test_recorder_tokens_with_key():
+    first = TrafficRecorder("unused", key=b"secret", metrics=Metrics())
+    second = TrafficRecorder("unused", key=b"secret", metrics=Metrics())
+
+    assert first.token("user", "gauss") == second.token("user", "gauss") != first.token("user", "riemann")
+    assert first.token("user", "gauss") != TrafficRecorder("unused", metrics=Metrics()).token("user", "gauss")
+    assert first.token("user", None) is None
+
+
+def test_read_recording(tmp_path):
+    exchanges = [Exchange(float(t), 0.01, "client-1", False, 200, "<pcoip-client />", 16, None) for t in (3, 1, 2)]
+    (tmp_path / "recording.1").write_text(exchanges[0].to_json() + "\n" + exchanges[1].to_json()[:20])
+    (tmp_path / "recording.2").write_text(exchanges[1].to_json() + "\n" + exchanges[2].to_json() + "\n")
+
+    assert list(read_recording([str(tmp_path / "recording.*")])) == sorted(exchanges, key=lambda e: e.time)
+
+    (tmp_path / "recording.3").write_text("garbage\n" + exchanges[0].to_json() + "\n")
+    with pytest.raises(ValueError):
+        list(read_recording([str(tmp_path / "recording.3")]))
+
+
+def test_broker_resource_records_nothing_by_default(tmp_path):
+    client = _client(tmp_path, None)
+
+    resp = client.simulate_post("/pcoip-broker/xml", body=HELLO_XML.format("Gauss"))
+
+    assert resp.status == falcon.HTTP_OK
+    assert list(tmp_path.glob("recording.*")) == []
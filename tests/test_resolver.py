@@ -0,0 +1,114 @@
+import socket
+import time
+
+import pytest
+
+from interstate_love_song.metrics import Metrics
+from interstate_love_song.resolver import CachingResolver
+
+
+class FakeDns:
+    def __init__(self, answers):
+        self.answers = answers
+        self.lookups = []
+
+    def getaddrinfo(self, host, port, *args, **kwargs):
+        self.lookups.append(host)
+        answer = self.answers.get(host)
+        if answer is None:
+            raise socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        return [(socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, port)) for address in answer]
+
+
+@pytest.fixture
+def dns(monkeypatch):
+    fake = FakeDns({"euler.ch": ["10.0.0.1", "10.0.0.2", "10.0.0.1"]})
+    monkeypatch.setattr(socket, "getaddrinfo", fake.getaddrinfo)
+    return fake
+
+
+def _wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_caching_resolver_constructor():
+    with pytest.raises(ValueError):
+        CachingResolver(ttl=0)
+    with pytest.raises(ValueError):
+        CachingResolver(negative_ttl=-1)
+
+
+def test_caching_resolver(dns):
+    metrics = Metrics()
+    resolver = CachingResolver(ttl=60, metrics=metrics)
+
+    assert resolver.resolve("euler.ch") == ["10.0.0.1", "10.0.0.2"]
+    assert resolver.resolve("euler.ch") == ["10.0.0.1", "10.0.0.2"]
+    assert dns.lookups == ["euler.ch"]
+    assert metrics.get("agent.dns.misses") == 1
+    assert metrics.get("agent.dns.hits") == 1
+    assert metrics.get("agent.dns.lookups") == 1
+    assert metrics.get("agent.dns.lookup_seconds") >= 0
+
+
+def test_caching_resolver_expires(dns):
+    resolver = CachingResolver(ttl=0.05, refresh_ahead=0, metrics=Metrics())
+
+    resolver.resolve("euler.ch")
+    time.sleep(0.1)
+    dns.answers["euler.ch"] = ["10.0.0.3"]
+    assert resolver.resolve("euler.ch") == ["10.0.0.3"]
+    assert dns.lookups == ["euler.ch", "euler.ch"]
+
+
+def test_caching_resolver_negative(dns):
+    metrics = Metrics()
+    resolver = CachingResolver(negative_ttl=0.1, metrics=metrics)
+
+    for _ in range(3):
+        with pytest.raises(socket.gaierror):
+            resolver.resolve("gauss.de")
+    assert dns.lookups == ["gauss.de"]
+    assert metrics.get("agent.dns.failures") == 1
+
+    dns.answers["gauss.de"] = ["10.0.0.4"]
+    time.sleep(0.15)
+    assert resolver.resolve("gauss.de") == ["10.0.0.4"]
+
+
+def test_caching_resolver_refreshes_ahead(dns):
+    metrics = Metrics()
+    resolver = CachingResolver(ttl=60, refresh_ahead=60, metrics=metrics)
+
+    resolver.resolve("euler.ch")
+    dns.answers["euler.ch"] = ["10.0.0.3"]
+    # Still the cached answer, the new one is looked up in the background.
+    assert resolver.resolve("euler.ch") == ["10.0.0.1", "10.0.0.2"]
+    assert _wait_for(lambda: resolver.resolve("euler.ch") == ["10.0.0.3"])
+    assert metrics.get("agent.dns.refreshes") >= 1
+
+
+def test_caching_resolver_failed_refresh_keeps_answer(dns):
+    resolver = CachingResolver(ttl=60, refresh_ahead=60, metrics=Metrics())
+
+    resolver.resolve("euler.ch")
+    del dns.answers["euler.ch"]
+    resolver.resolve("euler.ch")
+    assert _wait_for(lambda: len(dns.lookups) >= 2)
+    time.sleep(0.05)
+    assert resolver.resolve("euler.ch") == ["10.0.0.1", "10.0.0.2"]
+
+
+def test_caching_resolver_prefetch(dns):
+    resolver = CachingResolver(metrics=Metrics())
+
+    assert resolver.prefetch(["euler.ch", "gauss.de", "euler.ch"]) == 1
+    assert sorted(dns.lookups) == ["euler.ch", "gauss.de"]
+    assert resolver.resolve("euler.ch") == ["10.0.0.1", "10.0.0.2"]
+    with pytest.raises(socket.gaierror):
+        resolver.resolve("gauss.de")
+    assert len(dns.lookups) == 2
+    assert resolver.prefetch([]) == 0
@@ -2,10 +2,11 @@ from io import BytesIO
 
 import pytest
 
-from interstate_love_song.serialization import serialize_message, deserialize_message
+from interstate_love_song.serialization import serialize_message, deserialize_message, encode_message
 from interstate_love_song.transport import *
 
 from defusedxml.ElementTree import tostring, fromstring
+from xml.etree.ElementTree import ElementTree
 from xmldiff.main import diff_texts
 
 
@@ -198,6 +199,36 @@ def test_serialize_message_bye_response():
     assert xml_tree_equal_to_xml_string(xml_et, expected)
 
 
+ENCODED_MESSAGES = [
+    HelloResponse(hostname="euler.test", domains=["example.com"]),
+    AuthenticateSuccessResponse(),
+    AuthenticateFailedResponse(),
+    GetResourceListResponse([TeradiciResource("Gauss & Weber", "0")]),
+    AllocateResourceSuccessResponse("1.1.1.1", "gauss.de", "sni", 60443, "id", "tag<>", "0"),
+    AllocateResourceFailureResponse("FAILED_USER_AUTH"),
+    ByeResponse(),
+]
+
+
+@pytest.mark.parametrize("msg", ENCODED_MESSAGES, ids=lambda msg: type(msg).__name__)
+def test_encode_message(msg):
+    expected = BytesIO()
+    ElementTree(serialize_message(msg)).write(expected, encoding="utf-8", xml_declaration=True)
+
+    chunks = encode_message(msg)
+
+    assert len(chunks) == 1
+    assert b"".join(chunks) == expected.getvalue()
+
+
+def test_encode_message_reuses_common_responses():
+    assert encode_message(ByeResponse()) is encode_message(ByeResponse())
+    assert encode_message(HelloResponse("euler.test", [])) is encode_message(HelloResponse("euler.test", []))
+    assert encode_message(HelloResponse("euler.test", [])) != encode_message(HelloResponse("gauss.test", []))
+    msg = AllocateResourceFailureResponse("FAILED_USER_AUTH")
+    assert encode_message(msg) is not encode_message(msg)
+
+
 def test_deserialize_message_bad_input():
     with pytest.raises(ValueError):
         deserialize_message(123)
@@ -0,0 +1,234 @@
+import os
+import sqlite3
+import time
+
+import pytest
+from beaker.container import Value
+from beaker.session import Session
+
+from interstate_love_song import session
+from interstate_love_song.metrics import Metrics
+from interstate_love_song.session import (
+    SqliteNamespaceManager,
+    SessionError,
+    purge_expired,
+    SQLITE_FILENAME,
+    SQLITE_LOCK_DIRNAME,
+    ShardedFileNamespaceManager,
+    sweep_file_sessions,
+    SessionJanitor,
+)
+
+
+def test_sqlite_namespace_manager_constructor():
+    with pytest.raises(SessionError):
+        SqliteNamespaceManager("euler")
+
+
+def test_sqlite_namespace_manager(tmp_path):
+    store = SqliteNamespaceManager("euler", data_dir=str(tmp_path))
+
+    assert "session" not in store
+    with pytest.raises(KeyError):
+        store["session"]
+
+    store["session"] = {"protocol": ("Leonhard", 1707)}
+    assert "session" in store
+    assert store.keys() == ["session"]
+    assert SqliteNamespaceManager("euler", data_dir=str(tmp_path))["session"] == {"protocol": ("Leonhard", 1707)}
+    assert "session" not in SqliteNamespaceManager("gauss", data_dir=str(tmp_path))
+
+    del store["session"]
+    assert "session" not in store
+
+    store["session"] = {}
+    store.remove()
+    assert "session" not in store
+
+    assert os.path.exists(os.path.join(str(tmp_path), SQLITE_FILENAME))
+
+
+def test_sqlite_namespace_manager_waits_for_lock_by_sleeping(tmp_path, monkeypatch):
+    store = SqliteNamespaceManager("euler", data_dir=str(tmp_path))
+    store["session"] = {}
+    other = sqlite3.connect(str(tmp_path / SQLITE_FILENAME), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+
+    sleeps = []
+    real_sleep = time.sleep
+
+    def sleep(seconds):
+        # Another worker holds the write lock for a few of our retries.
+        sleeps.append(seconds)
+        if len(sleeps) == 5:
+            other.execute("COMMIT")
+        real_sleep(seconds)
+
+    monkeypatch.setattr(session.time, "sleep", sleep)
+    store["session"] = {"protocol": ("Leonhard", 1707)}
+
+    assert len(sleeps) == 5
+    assert store["session"] == {"protocol": ("Leonhard", 1707)}
+
+
+def test_sqlite_namespace_manager_lock_timeout(tmp_path, monkeypatch):
+    store = SqliteNamespaceManager("euler", data_dir=str(tmp_path))
+    store["session"] = {}
+    other = sqlite3.connect(str(tmp_path / SQLITE_FILENAME), isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    monkeypatch.setattr(session, "SQLITE_LOCK_TIMEOUT", 0.2)
+
+    start = time.monotonic()
+    with pytest.raises(sqlite3.OperationalError):
+        store["session"] = {"protocol": ("Leonhard", 1707)}
+
+    assert 0.2 <= time.monotonic() - start < 2.0
+    other.execute("ROLLBACK")
+    assert store["session"] == {}
+
+
+def test_sqlite_namespace_manager_creation_lock(tmp_path):
+    store = SqliteNamespaceManager("euler", data_dir=str(tmp_path))
+
+    # Beaker takes the creation lock to compute a missing value.
+    assert Value("e", store, createfunc=lambda: 2.718).get_value() == 2.718
+    assert store["e"][2] == 2.718
+
+    lock = store.get_creation_lock("e")
+    assert lock.acquire_write_lock(wait=False)
+    lock.release_write_lock()
+    assert list((tmp_path / SQLITE_LOCK_DIRNAME).rglob("*.lock"))
+
+
+def test_sqlite_namespace_manager_expiry(tmp_path):
+    store = SqliteNamespaceManager("euler", data_dir=str(tmp_path), ttl=60)
+    store["session"] = {}
+
+    for i in range(25):
+        SqliteNamespaceManager("expired{}".format(i), data_dir=str(tmp_path), ttl=0.001)["session"] = {}
+    time.sleep(0.01)
+
+    assert "session" not in SqliteNamespaceManager("expired0", data_dir=str(tmp_path))
+    assert purge_expired(store._connection, batch_size=10) == 25
+    assert purge_expired(store._connection, batch_size=10) == 0
+    assert "session" in store
+    assert purge_expired(store._connection, now=time.time() + 61) == 1
+
+
+def _age(path, seconds):
+    mtime = time.time() - seconds
+    os.utime(str(path), (mtime, mtime))
+
+
+def test_sharded_file_namespace_manager(tmp_path):
+    with pytest.raises(SessionError):
+        ShardedFileNamespaceManager("euler")
+
+    options = {"type": "file", "data_dir": str(tmp_path), "namespace_class": ShardedFileNamespaceManager}
+    session = Session({}, use_cookies=False, **options)
+    session["protocol"] = ("Leonhard", 1707)
+    session.save()
+    assert Session({}, id=session.id, use_cookies=False, **options)["protocol"] == ("Leonhard", 1707)
+
+    files = sorted(path.relative_to(tmp_path) for path in tmp_path.rglob("*") if path.is_file())
+    assert [path.suffix for path in files] == [".cache", ".lock"]
+    shard, name = files[0].parts[1:]
+    assert files[0].parts[0] == "sessions"
+    assert len(shard) == 3 and name.startswith(shard)
+    assert files[1].stem == files[0].stem
+
+
+def test_sharded_file_namespace_manager_creation_lock(tmp_path):
+    store = ShardedFileNamespaceManager("euler", data_dir=str(tmp_path))
+
+    # Beaker takes the creation lock to compute a missing value.
+    assert Value("e", store, createfunc=lambda: 2.718).get_value() == 2.718
+
+    lock = store.get_creation_lock("e")
+    assert lock.acquire_write_lock(wait=False)
+    lock.release_write_lock()
+    locks = [path for path in tmp_path.rglob("*.lock") if str(path) != store._lock_file]
+    assert locks and all(str(path).startswith(store.lock_dir) for path in locks)
+
+    _age(locks[0], 7200)
+    sweep_file_sessions(str(tmp_path), ttl=3600)
+    assert not locks[0].exists()
+
+
+def test_sweep_file_sessions(tmp_path):
+    for i in range(10):
+        store = ShardedFileNamespaceManager("session{}".format(i), data_dir=str(tmp_path))
+        store.acquire_write_lock()
+        try:
+            store["session"] = {}
+        finally:
+            store.release_write_lock()
+    caches = sorted(tmp_path.rglob("*.cache"))
+    locks = sorted(tmp_path.rglob("*.lock"))
+
+    # Expired sessions and their locks go, a fresh session keeps an old lock and a removed session leaves one behind.
+    for path in caches[:4] + locks[:6]:
+        _age(path, 120)
+    caches[5].unlink()
+    legacy = tmp_path / "container_file" / "a" / "ab"
+    legacy.mkdir(parents=True)
+    (legacy / "abc.cache").write_bytes(b"")
+    _age(legacy / "abc.cache", 120)
+
+    result = sweep_file_sessions(str(tmp_path), ttl=60, batch_size=2)
+
+    assert result.scanned == 20
+    assert result.removed == 4 + 4 + 1 + 1
+    assert len(list(tmp_path.rglob("*.cache"))) == 5
+    assert len(list(tmp_path.rglob("*.lock"))) == 5
+    assert sweep_file_sessions(str(tmp_path), ttl=60).removed == 0
+    assert sweep_file_sessions(str(tmp_path), ttl=60, now=time.time() + 61).removed == 10
+
+
+def test_session_janitor(tmp_path):
+    with pytest.raises(ValueError):
+        SessionJanitor("file", str(tmp_path), 60, interval=0)
+
+    store = ShardedFileNamespaceManager("euler", data_dir=str(tmp_path))
+    store.acquire_write_lock()
+    try:
+        store["session"] = {}
+    finally:
+        store.release_write_lock()
+    for path in tmp_path.rglob("*.*"):
+        _age(path, 120)
+
+    metrics = Metrics()
+    leader = SessionJanitor("file", str(tmp_path), 60, metrics=metrics)
+    other = SessionJanitor("file", str(tmp_path), 60, metrics=Metrics())
+
+    assert leader.run_once().removed == 2
+    assert leader.leader
+    assert other.run_once() is None
+    assert not other.leader
+    assert metrics.get("sessions.janitor.leader") == 1
+    assert metrics.get("sessions.janitor.sweeps") == 1
+    assert metrics.get("sessions.janitor.removed") == 2
+    assert metrics.get("sessions.janitor.last_scanned") == 2
+
+    leader._resign()
+    assert other.run_once().removed == 0
+
+
+def test_session_janitor_sqlite(tmp_path):
+    for i in range(3):
+        SqliteNamespaceManager("expired{}".format(i), data_dir=str(tmp_path), ttl=0.001)["session"] = {}
+    time.sleep(0.01)
+
+    metrics = Metrics()
+    janitor = SessionJanitor("sqlite", str(tmp_path), 60, interval=0.01, metrics=metrics)
+    janitor.start()
+    with pytest.raises(RuntimeError):
+        janitor.start()
+    deadline = time.time() + 5
+    while metrics.get("sessions.janitor.sweeps") < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    janitor.stop()
+
+    assert metrics.get("sessions.janitor.removed") == 3
+    assert metrics.get("sessions.janitor.sweeps") >= 2
@@ -186,6 +186,12 @@ def test_load_settings_json():
     ]
 
 
+def test_rate_limit_is_off_by_default():
+    # Behind a proxy, without client_ip_header, all clients would share one bucket.
+    assert settings.Settings().rate_limit.enabled is False
+    assert settings.load_dict_into_dataclass(settings.RateLimitSettings, {}).enabled is False
+
+
 def test_load_settings_json_missing_database():
     with pytest.raises(settings.SettingsError) as excinfo:
         raw_settings_json = "{}"
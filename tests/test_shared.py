@@ -0,0 +1,113 @@
+import itertools
+import multiprocessing
+
+import pytest
+
+from interstate_love_song.shared import SharedTable, TokenBuckets, DecayingCounters
+
+
+def test_shared_table_constructor():
+    with pytest.raises(ValueError):
+        SharedTable(0, "d")
+    with pytest.raises(ValueError):
+        SharedTable(16, "d", probes=0)
+
+
+def test_shared_table():
+    table = SharedTable(16, "dq")
+
+    assert table.get("euler") is None
+    assert table.update("euler", lambda values, elapsed: ((1.5, 1707), values)) is None
+    assert table.get("euler") == (1.5, 1707)
+    assert table.update("euler", lambda values, elapsed: ((values[0] * 2, values[1]), elapsed)) >= 0
+    assert table.get("euler") == (3.0, 1707)
+
+    table.delete("euler")
+    assert table.get("euler") is None
+
+
+def _colliding_keys(table, count):
+    """Keys that all start probing at the same slot."""
+    by_slot = {}
+    for i in itertools.count():
+        keys = by_slot.setdefault(table._hash(str(i)) % table.slots, [])
+        keys.append(str(i))
+        if len(keys) == count:
+            return keys
+
+
+def test_shared_table_delete_keeps_probe_chains():
+    table = SharedTable(16, "q")
+    first, middle, last = _colliding_keys(table, 3)
+    for value, key in enumerate((first, middle, last)):
+        table.update(key, lambda values, elapsed: ((value,), None))
+
+    table.delete(middle)
+
+    assert table.get(middle) is None
+    assert table.get(first) == (0,) and table.get(last) == (2,)
+    # An update finds the key past the tombstone, rather than taking the tombstone for a second entry of it.
+    assert table.update(last, lambda values, elapsed: ((values[0] + 1,), values)) == (2,)
+    table.delete(last)
+    assert table.get(last) is None
+
+    assert table.update(middle, lambda values, elapsed: ((1,), values)) is None
+    assert table.get(middle) == (1,) and table.get(first) == (0,)
+
+
+def test_shared_table_is_bounded():
+    table = SharedTable(4, "q")
+    for i in range(100):
+        table.update(str(i), lambda values, elapsed: ((i,), None))
+
+    assert table.get("99") == (99,)
+    assert sum(table.get(str(i)) is not None for i in range(100)) <= 4
+
+
+def _take_all(buckets, key, results):
+    results.put(sum(buckets.take(key, rate=0.001, burst=10) == 0 for _ in range(10)))
+
+
+def test_shared_table_is_shared_after_fork():
+    buckets = TokenBuckets(64)
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    workers = [context.Process(target=_take_all, args=(buckets, "noether", results)) for _ in range(3)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    # The three workers drew from one bucket of 10.
+    assert sum(results.get() for _ in workers) == 10
+    assert buckets.take("noether", rate=0.001, burst=10) > 0
+
+
+def test_token_buckets():
+    buckets = TokenBuckets(64)
+
+    assert all(buckets.take("gauss", rate=1.0, burst=3) == 0 for _ in range(3))
+    wait = buckets.take("gauss", rate=1.0, burst=3)
+    assert 0 < wait <= 1.0
+    assert buckets.take("riemann", rate=1.0, burst=3) == 0
+    assert buckets.take("gauss", rate=1e9, burst=3) == 0
+
+
+def test_shared_table_get_many():
+    table = SharedTable(64, "d")
+    table.update("a", lambda values, elapsed: ((1.0,), None))
+    table.update("c", lambda values, elapsed: ((3.0,), None))
+
+    a, b, c = table.get_many(["a", "b", "c"])
+    assert a[0] == (1.0,) and c[0] == (3.0,) and b is None
+    assert 0 <= a[1] < 5
+
+
+def test_decaying_counters():
+    with pytest.raises(ValueError):
+        DecayingCounters(64, 0)
+
+    counters = DecayingCounters(64, half_life=3600)
+    assert counters.add("gauss") == 1
+    assert counters.add("gauss", 2) == pytest.approx(3, abs=1e-3)
+    assert counters.get_many(["gauss", "riemann"]) == [pytest.approx(3, abs=1e-3), 0.0]
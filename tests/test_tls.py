@@ -0,0 +1,142 @@
+import multiprocessing
+import shutil
+import socket
+import ssl
+import subprocess
+import threading
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+import requests
+
+from interstate_love_song.agent import AgentConnections
+from interstate_love_song.metrics import Metrics
+from interstate_love_song.resolver import CachingResolver
+from interstate_love_song.tls import create_agent_ssl_context
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # HTTP/1.0 closes the connection after each response, every request is a new TLS connection.
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"ok")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory):
+    if shutil.which("openssl") is None:
+        pytest.skip("openssl is needed to make a certificate.")
+    directory = tmp_path_factory.mktemp("tls")
+    cert, key = str(directory / "cert.pem"), str(directory / "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost"]
+        + ["-addext", "subjectAltName=DNS:localhost", "-keyout", key, "-out", cert],
+        check=True,
+        capture_output=True,
+    )
+    return cert, key
+
+
+@pytest.fixture
+def agent_url(certificate):
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(*certificate)
+    server = HTTPServer(("localhost", 0), _Handler)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield "https://localhost:{}/".format(server.server_address[1])
+    server.shutdown()
+    server.server_close()
+
+
+def test_agent_connections_verify_and_resume(certificate, agent_url):
+    metrics = Metrics()
+    connections = AgentConnections(verify=True, ca_bundle=certificate[0], metrics=metrics)
+
+    for _ in range(3):
+        assert connections.session().get(agent_url, timeout=5).content == b"ok"
+
+    assert metrics.get("agent.tls.handshakes") == 1
+    assert metrics.get("agent.tls.resumed") == 2
+
+
+def test_agent_connections_reject_untrusted(agent_url):
+    connections = AgentConnections(verify=True, metrics=Metrics())
+
+    with pytest.raises(requests.exceptions.SSLError):
+        connections.session().get(agent_url, timeout=5)
+
+
+def test_agent_connections_without_verify(agent_url):
+    connections = AgentConnections(verify=False, metrics=Metrics())
+
+    assert connections.session().get(agent_url, timeout=5).content == b"ok"
+
+
+def test_agent_connections_with_resolver(certificate, agent_url, monkeypatch):
+    getaddrinfo = socket.getaddrinfo
+    lookups = []
+
+    def counting_getaddrinfo(host, *args, **kwargs):
+        lookups.append(host)
+        return getaddrinfo(host, *args, **kwargs)
+
+    resolver = CachingResolver(metrics=Metrics())
+    monkeypatch.setattr(socket, "getaddrinfo", counting_getaddrinfo)
+    resolver.prefetch(["localhost"])
+    connections = AgentConnections(verify=True, ca_bundle=certificate[0], resolver=resolver, metrics=Metrics())
+
+    # The certificate is only valid for localhost, it is checked against the hostname rather than the address.
+    for _ in range(2):
+        assert connections.session().get(agent_url, timeout=5).content == b"ok"
+    assert lookups.count("localhost") == 1
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        connections.session().get(agent_url.replace("localhost", "unknown.invalid"), timeout=5)
+
+
+def test_agent_connections_try_every_address(certificate, agent_url, monkeypatch):
+    resolver = CachingResolver(metrics=Metrics())
+    # Nothing listens on 127.0.0.2, the agent does on 127.0.0.1.
+    monkeypatch.setattr(resolver, "resolve", lambda hostname: ["127.0.0.2", "127.0.0.1"])
+    connections = AgentConnections(verify=True, ca_bundle=certificate[0], resolver=resolver, metrics=Metrics())
+
+    assert connections.session().get(agent_url, timeout=5).content == b"ok"
+
+    monkeypatch.setattr(resolver, "resolve", lambda hostname: ["127.0.0.2", "127.0.0.3"])
+    with pytest.raises(requests.exceptions.ConnectionError):
+        AgentConnections(resolver=resolver, metrics=Metrics()).session().get(agent_url, timeout=5)
+
+
+def test_create_agent_ssl_context(certificate):
+    assert create_agent_ssl_context(False).verify_mode == ssl.CERT_NONE
+
+    context = create_agent_ssl_context(True, certificate[0])
+    assert context.verify_mode == ssl.CERT_REQUIRED and context.check_hostname
+
+    with pytest.raises(OSError):
+        create_agent_ssl_context(True, certificate[0] + ".missing")
+
+
+def _same_session(connections, session_id, results):
+    results.put(id(connections.session()) == session_id)
+
+
+def test_agent_connections_after_fork():
+    connections = AgentConnections(metrics=Metrics())
+    session = connections.session()
+    assert connections.session() is session
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    child = context.Process(target=_same_session, args=(connections, id(session), results))
+    child.start()
+    child.join()
+
+    assert results.get() is False